@@ -719,10 +719,8 @@ class LCDClient():
         def on_con(client):
             self.value_list = client.list_values(10)
 
-            for name in watchlist:
-                client.watch(name)
-            for request in self.initial_gets:
-                client.get(request)
+            client.watch(watchlist)
+            client.get(self.initial_gets)
 
         try:
             self.client = SignalKClient(on_con, host)
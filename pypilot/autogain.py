@@ -7,7 +7,10 @@
 # License as published by the Free Software Foundation; either
 # version 3 of the License, or (at your option) any later version.  
 
-import sys, time
+# searches autopilot gains on a running autopilot, or with -r offline
+# on recordings replayed in parallel (see replay_search)
+
+import sys, os, time, getopt, math, contextlib
 from signalk.client import SignalKClient
 
 # list must be already sorted
@@ -175,6 +178,153 @@ class autogain(object):
             self.print_results(self.results[var], self.search, {})
             print('')
 
+# the offline search replays recordings (see replay.py) with the loop
+# closed by a ResponseModel, evaluating gains of the basic pilot in a
+# process pool.  Each round tries a step up and down of every gain in
+# parallel, moves to the best and halves the steps when none is better.
+# The cost is heading error rms plus weight times mean servo watts.
+#
+#   python -m pypilot.autogain -r [-p processes] [-g P,D] [-w weight] [-s name=value] [FILE]...
+
+replay_data = False
+replay_settings = {}
+
+def replay_init(filenames, settings):
+    global replay_data, replay_settings
+    from signalk import recorder
+    replay_data = recorder.read(filenames)
+    replay_settings = settings
+
+# each replay prints the loading messages of the autopilot
+@contextlib.contextmanager
+def quiet():
+    stdout = sys.stdout
+    sys.stdout = open(os.devnull, 'w')
+    try:
+        yield
+    finally:
+        sys.stdout.close()
+        sys.stdout = stdout
+
+# value, min and max of the basic pilot gains, and settings not found
+def replay_gains():
+    with quiet():
+        from pypilot import replay
+        r = replay.Replay(replay_data, replay_settings)
+    gains = {}
+    for name, value in r.server.values.items():
+        if name.startswith('ap.pilot.basic.') and 'AutopilotGain' in value.type():
+            gains[name[15:]] = value.value, value.min_value, value.max_value
+    return gains, [name for name in replay_settings if not name in r.server.values]
+
+# heading error rms and mean servo watts while enabled
+def replay_evaluate(gains):
+    import numpy
+    settings = dict(replay_settings)
+    for name in gains:
+        settings['ap.pilot.basic.' + name] = gains[name]
+    with quiet():
+        from pypilot import replay
+        r = replay.Replay(replay_data, settings, replay.ResponseModel())
+        results = r.run(['ap.enabled', 'ap.heading_error', 'servo.current', 'servo.voltage'])
+    enabled = results['ap.enabled'] > 0
+    if not numpy.any(enabled):
+        return False
+    watts = results['servo.current']*results['servo.voltage']
+    return replay.rms(results['ap.heading_error'][enabled]), float(numpy.nanmean(watts[enabled]))
+
+def replay_search():
+    import multiprocessing
+    try:
+        opts, args = getopt.getopt(sys.argv[1:], 'rp:g:w:s:n:h', ['replay', 'help'])
+    except getopt.GetoptError as e:
+        print(e)
+        opts, args = [('-h', '')], []
+
+    processes = multiprocessing.cpu_count()
+    names = ['P', 'D']
+    weight = .1
+    settings = {}
+    max_rounds = 20
+    for o, a in opts:
+        if o == '-p':
+            processes = int(a)
+        elif o == '-g':
+            names = a.split(',')
+        elif o == '-w':
+            weight = float(a)
+        elif o == '-n':
+            max_rounds = int(a)
+        elif o == '-s':
+            from pypilot import replay
+            name, value = a.split('=', 1)
+            settings[name] = replay.parse_value(value)
+        elif o in ['-h', '--help']:
+            print('usage: python -m pypilot.autogain -r [-p processes] [-g P,D] [-w weight] [-n rounds] [-s name=value]... [FILE]...')
+            print('searches basic pilot gains on recordings, by default all of them')
+            exit(0)
+
+    pool = multiprocessing.Pool(processes, replay_init, (args, settings))
+    gains, unknown = pool.apply(replay_gains)
+    for name in unknown:
+        print('replay: unknown value', name)
+    for name in names:
+        if not name in gains:
+            print('unknown gain', name, 'try one of', sorted(gains))
+            exit(1)
+
+    results = {}
+    def cost(key):
+        if not results[key]:
+            return float('inf')
+        error, watts = results[key]
+        return error + weight*watts
+
+    def evaluate(keys):
+        keys = [key for key in set(keys) if not key in results]
+        t0 = time.time()
+        for key, result in zip(keys, pool.map(replay_evaluate, [dict(zip(names, key)) for key in keys])):
+            results[key] = result
+        return time.time() - t0
+
+    # keys are rounded well below the smallest step, so sums of steps
+    # reaching the same gains are one key
+    digits = [9 - int(math.floor(math.log10(max(gains[name][2] - gains[name][1], 1e-9)))) for name in names]
+    best = tuple(round(gains[name][0], digits[i]) for i, name in enumerate(names))
+    steps = [(gains[name][2] - gains[name][1])/8 for name in names]
+    evaluate([best])
+    if not results[best]:
+        print('autopilot never enabled in recordings, try -s ap.enabled=true')
+        exit(1)
+
+    for r in range(max_rounds):
+        candidates = []
+        for i in range(len(names)):
+            for d in [-steps[i], steps[i]]:
+                key = list(best)
+                key[i] = round(min(max(key[i] + d, gains[names[i]][1]), gains[names[i]][2]), digits[i])
+                candidates.append(tuple(key))
+        dt = evaluate(candidates)
+        move = min(candidates, key=cost)
+        if cost(move) < cost(best):
+            best = move
+        else:
+            steps = [step/2 for step in steps]
+        print('round', r, 'best', dict(zip(names, best)), 'cost %.4f' % cost(best),
+              '%d evaluations in %.1fs' % (len(candidates), dt))
+        if all(map(lambda i : steps[i] < (gains[names[i]][2] - gains[names[i]][1])/256, range(len(names)))):
+            break
+    pool.close()
+
+    print('')
+    print(''.join(['%10s' % name for name in names]) + '%14s%10s%10s' % ('heading rms', 'watts', 'cost'))
+    for key in sorted(filter(lambda key : results[key], results), key=cost):
+        error, watts = results[key]
+        print(''.join(['%10.4f' % value for value in key]) + '%14.3f%10.2f%10.4f' % (error, watts, cost(key)))
+
 if __name__ == '__main__':
-    ag = autogain()
-    ag.run()
+    if '-r' in sys.argv[1:] or '--replay' in sys.argv[1:]:
+        replay_search()
+    else:
+        ag = autogain()
+        ag.run()
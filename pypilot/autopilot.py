@@ -27,6 +27,8 @@ from resolv import *
 import tacking, servo
 from pypilot.version import strversion
 from pypilot.sensors import Sensors
+from scheduler import LoopScheduler
+from signalk import tracing
 
 def minmax(value, r):
     return min(max(value, -r), r)
@@ -162,7 +164,9 @@ class HeadingOffset(object):
   
 import pilots
 class Autopilot(object):
-  def __init__(self):
+  # replay (see replay.py) supplies the server and scheduler, and feeds
+  # the imu, sensors and servo from a recording on a virtual clock
+  def __init__(self, replay=False):
     super(Autopilot, self).__init__()
 
     # setup all processes to exit on any signal
@@ -184,16 +188,22 @@ class Autopilot(object):
         print('got SIGPIPE, ignoring')
 
     import signal
-    for s in range(1, 16):
-        if s == 13:
-            signal.signal(s, printpipewarning)
-        elif s != 9:
-            signal.signal(s, cleanup)
-
-#    self.server = SignalKServer()
-    self.server = SignalKPipeServer()
-    self.boatimu = BoatIMU(self.server)
-    self.sensors = Sensors(self.server)
+    if replay:
+        self.server = replay.server
+    else:
+        for s in range(1, 16):
+            if s == 13:
+                signal.signal(s, printpipewarning)
+            elif s != 9:
+                signal.signal(s, cleanup)
+
+        # before forking so child processes inherit the dump signal handler
+        tracing.init('autopilot')
+
+#        self.server = SignalKServer()
+        self.server = SignalKPipeServer()
+    self.boatimu = BoatIMU(self.server, replay)
+    self.sensors = Sensors(self.server, replay)
     self.servo = servo.Servo(self.server, self.sensors)
 
     self.version = self.Register(Value, 'version', 'pypilot' + ' ' + strversion)
@@ -239,8 +249,15 @@ class Autopilot(object):
 
     self.runtime = self.Register(TimeValue, 'runtime') #, persistent=True)
 
-    device = '/dev/watchdog0'
+    self.lastdata = False
+    self.lasttime = self.starttime = time.time()
     self.watchdog_device = False
+    self.trace = False
+    if replay:
+        self.scheduler = replay.scheduler
+        return
+
+    device = '/dev/watchdog0'
     try:
         self.watchdog_device = open(device, 'w')
     except:
@@ -249,18 +266,18 @@ class Autopilot(object):
     if os.system('sudo chrt -pf 1 %d 2>&1 > /dev/null' % os.getpid()):
       print('warning, failed to make autopilot process realtime')
 
-    self.starttime = time.time()
-    self.times = 4*[0]
+    self.scheduler = LoopScheduler(self.server, self.boatimu.period,
+                                   ['imu', 'autopilot', 'servo', 'sensors', 'server'])
 
     self.childpids = [self.boatimu.imu_process.pid, self.boatimu.auto_cal.process.pid,
                  self.server.process.pid, self.sensors.nmea.process.pid, self.sensors.gps.process.pid]
     signal.signal(signal.SIGCHLD, cleanup)
+
+    if tracing.tracer:
+        self.trace = tracing.TraceValues(self.server, ['autopilot', 'server', 'nmea'])
     import atexit
     atexit.register(lambda : cleanup('atexit'))
     
-    self.lastdata = False
-    self.lasttime = time.time()
-
     # read initial value from imu as this takes time
 #    while not self.boatimu.IMURead():
 #        time.sleep(.1)
@@ -382,19 +399,15 @@ class Autopilot(object):
                                         (self.heading_error.value/1500)*dt, 1))
           
   def iteration(self):
-      data = False
-      t00 = time.time()
-      for tries in range(14): # try 14 times to read from imu 
-          data = self.boatimu.IMURead()
-          if data:
-              break
-          time.sleep(self.boatimu.period/10)
+      # wait for data from the imu near the next deadline
+      self.scheduler.wait(self.boatimu.ring.fileno())
+      data = self.boatimu.IMURead()
 
       if not data and self.lastdata:
           print('autopilot failed to read imu at time:', time.time())
 
       self.lastdata = data
-      t0 = time.time()
+      self.scheduler.stage('imu')
 
       # set autopilot timestamp
       self.server.TimeStamp('ap', time.time()-self.starttime)
@@ -432,41 +445,30 @@ class Autopilot(object):
       # servo can only disengage under manual control
       self.servo.force_engaged = self.enabled.value
 
-      t1 = time.time()
-      if t1-t0 > self.boatimu.period/2:
-          print('Autopilot routine is running too _slowly_', t1-t0, self.boatimu.period/2)
+      self.scheduler.stage('autopilot')
 
       self.servo.poll()
-      t2 = time.time()
-      if t2-t1 > self.boatimu.period/2:
-          print('servo is running too _slowly_', t2-t1)
+      self.scheduler.stage('servo')
 
       self.sensors.poll()
-
-      t4 = time.time()
-      if t4 - t2 > self.boatimu.period/2:
-          print('sensors is running too _slowly_', t4-t2)
+      self.scheduler.stage('sensors')
 
       self.server.HandleRequests()
-      t5 = time.time()
-      if t5 - t4 > self.boatimu.period/2:
-          print('server is running too _slowly_', t5-t4)
+      self.scheduler.stage('server')
+
+      if self.trace:
+          self.trace.poll(self.childpids)
 
-      times = t1-t0, t2-t1, t4-t2
-      #self.times = map(lambda x, y : .975*x + .025*y, self.times, times)
-      #print('times', map(lambda t : '%.2f' % (t*1000), self.times))
-      
       if self.watchdog_device:
           self.watchdog_device.write('c')
 
-      while True:
-          dt = self.boatimu.period - (time.time() - t00)
-          if dt <= 0 or dt >= self.boatimu.period:
-              break
-          time.sleep(dt)
+      self.scheduler.finish()
 
 
 def main():
+  if '--simulate' in sys.argv:
+    import simulator
+    simulator.enabled = True # before the imu process forks
   ap = Autopilot()
   ap.run()
 
@@ -16,12 +16,16 @@ from __future__ import print_function
 import os, sys
 import time, math, multiprocessing, select
 from signalk.pipeserver import NonBlockingPipe
+from signalk import tracing
 
 sys.path.append(os.path.dirname(os.path.abspath(__file__)))
 import autopilot
 import calibration_fit
 import vector
 import quaternion
+from imuring import IMURing
+from imufilter import IMUFilter
+import simulator
 from signalk.server import SignalKServer
 from signalk.pipeserver import SignalKPipeServer
 from signalk.values import *
@@ -32,18 +36,20 @@ except ImportError:
   RTIMU = False
   print('RTIMU library not detected, please install it')
 
-def imu_process(pipe, cal_pipe, accel_cal, compass_cal, gyrobias, period):
-    if not RTIMU:
+def imu_process(ring, cal_pipe, accel_cal, compass_cal, gyrobias, period):
+    rtimulib = simulator if simulator.enabled else RTIMU
+    if not rtimulib:
       while True:
         time.sleep(10)
   
     #print 'imu on', os.getpid()
+    tracing.init('imu')
     if os.system('sudo chrt -pf 2 %d 2>&1 > /dev/null' % os.getpid()):
       print('warning, failed to make imu process realtime')
 
     #os.system("sudo renice -10 %d" % os.getpid())
     SETTINGS_FILE = "RTIMULib"
-    s = RTIMU.Settings(SETTINGS_FILE)
+    s = rtimulib.Settings(SETTINGS_FILE)
     s.FusionType = 1
     s.CompassCalValid = False
 
@@ -76,7 +82,7 @@ def imu_process(pipe, cal_pipe, accel_cal, compass_cal, gyrobias, period):
     while True:
       print("Using settings file " + SETTINGS_FILE + ".ini")
       s.IMUType = 0 # always autodetect imu
-      rtimu = RTIMU.RTIMU(s)
+      rtimu = rtimulib.RTIMU(s)
       if rtimu.IMUName() == 'Null IMU':
         print('no IMU detected... try again')
         time.sleep(1)
@@ -102,16 +108,32 @@ def imu_process(pipe, cal_pipe, accel_cal, compass_cal, gyrobias, period):
       cal_poller = select.poll()
       cal_poller.register(cal_pipe, select.POLLIN)
 
+      # filter at the sensor rate for the autopilot rate
+      imufilter = IMUFilter(rate, 1.0/period)
+      lastread = time.time()
+
       while True:
         t0 = time.time()
         
-        if rtimu.IMURead():
+        # every sample the imu has, limited in case it never runs out
+        ts = tracing.start()
+        samples = []
+        for i in range(rate//10):
+          if not rtimu.IMURead():
+            break
           data = rtimu.getIMUData()
           data['accel.residuals'] = list(rtimu.getAccelResiduals())
           data['gyrobias'] = s.GyroBias
-          data['timestamp'] = t0 # imu timestamp is perfectly accurate
-          pipe.send(data, False)
-        else:
+          samples.append(data)
+        # the last sample is the newest, earlier ones a sample period apart
+        n = len(samples)
+        for i in range(n):
+          samples[i]['timestamp'] = t0 - float(n-1-i)/rate
+          ring.write(imufilter.process(samples[i]))
+          lastread = t0
+        tracing.end('imu.read', ts)
+
+        if t0 - lastread > 1:
           print('failed to read IMU!!!!!!!!!!!!!!')
           break # reinitialize imu
 
@@ -127,15 +149,13 @@ def imu_process(pipe, cal_pipe, accel_cal, compass_cal, gyrobias, period):
           elif r[0] == 'compass':
             s.CompassCalEllipsoidValid = True
             s.CompassCalEllipsoidOffset = tuple(r[1][0][:3])
+          elif r[0] == 'filter':
+            imufilter.configure(1.0/period, r[1], r[2])
           #rtimu.resetFusion()
         
-        dt = time.time() - t0
-        t = period - dt # 10hz
-
-        if t > 0 and t < period:
+        t = poll_interval/1000.0 - (time.time() - t0)
+        if t > 0:
           time.sleep(t)
-        else:
-          print('imu process failed to keep time', t)
 
 class LoopFreqValue(Value):
     def __init__(self, name, initial):
@@ -217,6 +237,9 @@ class AgeValue(StringValue):
           self.lastupdate_value = t
           self.send()
 
+    def cache_key(self):
+        return None # output changes with time
+
     def get_signalk(self):
         dt = max(0, time.time() - self.value)
         if abs(dt - self.dt) > 1:
@@ -249,7 +272,9 @@ def heading_filter(lp, a, b):
     return result
 
 class BoatIMU(object):
-  def __init__(self, server, *args, **keywords):
+  # with replay, frames are written to self.ring by replay.py
+  # and there is no imu or calibration process
+  def __init__(self, server, replay=False):
     self.server = server
 
     self.rate = self.Register(EnumProperty, 'rate', 10, [10, 25], persistent=True)
@@ -274,18 +299,24 @@ class BoatIMU(object):
     self.accel_calibration = calibration('accel', [[0, 0, 0, 1], 1])
     self.compass_calibration = calibration('compass', [[0, 0, 0, 30, 0], [1, 1], 0])
     
-    self.imu_pipe, imu_pipe = NonBlockingPipe('imu_pipe')
+    self.ring = IMURing()
     imu_cal_pipe = NonBlockingPipe('imu_cal_pipe')
+    self.imu_cal_pipe = imu_cal_pipe[1]
 
-    self.poller = select.poll()
-    self.poller.register(self.imu_pipe, select.POLLIN)
+    # anti-aliasing filter in the imu process, order 2 or 4 butterworth
+    # with cutoff as a fraction of the nyquist frequency of imu.rate
+    self.filter_order = self.Register(EnumProperty, 'filter.order', 2, [2, 4], persistent=True)
+    self.filter_bandwidth = self.Register(RangeProperty, 'filter.bandwidth', .8, .2, 1, persistent=True)
+    self.last_filter = False
 
-    self.auto_cal = calibration_fit.IMUAutomaticCalibration(imu_cal_pipe[1], self.accel_calibration.value[0], self.compass_calibration.value[0])
+    self.auto_cal = False
+    if not replay:
+      self.auto_cal = calibration_fit.IMUAutomaticCalibration(self.imu_cal_pipe, self.accel_calibration.value[0], self.compass_calibration.value[0])
 
     self.lastqpose = False
     self.FirstTimeStamp = False
 
-    self.headingrate = self.heel = 0
+    self.heel = 0
     self.heading_lowpass_constant = self.Register(RangeProperty, 'heading_lowpass_constant', .1, .01, 1)
     self.headingrate_lowpass_constant = self.Register(RangeProperty, 'headingrate_lowpass_constant', .1, .01, 1)
     self.headingraterate_lowpass_constant = self.Register(RangeProperty, 'headingraterate_lowpass_constant', .1, .01, 1)
@@ -308,16 +339,18 @@ class BoatIMU(object):
     sensornames += ['gyrobias']
     self.SensorValues['gyrobias'] = self.Register(SensorValue, 'gyrobias', timestamp, persistent=True)
 
-    self.imu_process = multiprocessing.Process(target=imu_process, args=(imu_pipe,imu_cal_pipe[0], self.accel_calibration.value[0], self.compass_calibration.value[0], self.SensorValues['gyrobias'].value, self.period))
-    self.imu_process.start()
+    self.imu_process = False
+    if not replay:
+      self.imu_process = multiprocessing.Process(target=imu_process, args=(self.ring,imu_cal_pipe[0], self.accel_calibration.value[0], self.compass_calibration.value[0], self.SensorValues['gyrobias'].value, self.period))
+      self.imu_process.start()
 
     self.last_imuread = time.time()
-    self.lasttimestamp = 0
     self.last_heading_off = 3000 # invalid
 
   def __del__(self):
-    print('terminate imu process')
-    self.imu_process.terminate()
+    if self.imu_process:
+      print('terminate imu process')
+      self.imu_process.terminate()
 
   def Register(self, _type, name, *args, **kwargs):
     value = _type(*(['imu.' + name] + list(args)), **kwargs)
@@ -329,13 +362,19 @@ class BoatIMU(object):
     off = self.heading_off.value - heading_offset
     o = quaternion.angvec2quat(off*math.pi/180, [0, 0, 1])
     self.alignmentQ.update(quaternion.normalize(quaternion.multiply(q, o)))
-    self.auto_cal.SetNorm(quaternion.rotvecquat([0, 0, 1], self.alignmentQ.value))
+    if self.auto_cal:
+      self.auto_cal.SetNorm(quaternion.rotvecquat([0, 0, 1], self.alignmentQ.value))
 
   def IMURead(self):    
-    data = False
+    # every sample since the last read is filtered and used for
+    # calibration, the latest sets the sensors
+    self.frames = self.ring.read()
+    data = self.frames[-1] if self.frames else False
 
-    while self.poller.poll(0): # read all the data from the pipe
-      data = self.imu_pipe.recv()
+    imufilter = self.filter_order.value//2, self.filter_bandwidth.value
+    if imufilter != self.last_filter and self.imu_process:
+      self.imu_cal_pipe.send(('filter',) + imufilter)
+      self.last_filter = imufilter
 
     if not data:
       if time.time() - self.last_imuread > 1 and self.loopfreq.value:
@@ -353,65 +392,79 @@ class BoatIMU(object):
     self.last_imuread = time.time()
     self.loopfreq.strobe()
 
-    if not self.FirstTimeStamp:
-      self.FirstTimeStamp = data['timestamp']
-
-    data['timestamp'] -= self.FirstTimeStamp
-
     #data['accel_comp'] = quaternion.rotvecquat(vector.sub(data['accel'], down), self.alignmentQ.value)
 
-    # apply alignment calibration
+    # headingrate and headingraterate are from the imu process at full rate
     gyro_q = quaternion.rotvecquat(data['gyro'], data['fusionQPose'])
+    data['pitchrate'], data['rollrate'] = map(math.degrees, gyro_q[:2])
 
-    data['pitchrate'], data['rollrate'], data['headingrate'] = map(math.degrees, gyro_q)
+    data['gyro'] = list(map(math.degrees, data['gyro']))
+    data['gyrobias'] = list(map(math.degrees, data['gyrobias']))
 
-    origfusionQPose = data['fusionQPose']
-    aligned = quaternion.multiply(data['fusionQPose'], self.alignmentQ.value)
-    data['fusionQPose'] = quaternion.normalize(aligned) # floating point precision errors
+    # every sample is filtered, the constants are per read so
+    # convert them to per sample for the same response
+    count = len(self.frames)
+    def per_sample(llp):
+      return 1 - (1 - llp)**(1.0/count)
+    heel_lp = per_sample(.03)
+    heading_lp = per_sample(self.heading_lowpass_constant.value)
+    headingrate_lp = per_sample(self.headingrate_lowpass_constant.value)
+    headingraterate_lp = per_sample(self.headingraterate_lowpass_constant.value)
+
+    heading_lowpass = self.SensorValues['heading_lowpass'].value
+    headingrate_lowpass = self.SensorValues['headingrate_lowpass'].value
+    headingraterate_lowpass = self.SensorValues['headingraterate_lowpass'].value
+
+    accel_locked = self.accel_calibration.locked.value
+    compass_locked = self.compass_calibration.locked.value
+    points = []
+    for frame in self.frames:
+      if vector.norm(frame['accel']) == 0:
+        continue
 
-    data['roll'], data['pitch'], data['heading'] = map(math.degrees, quaternion.toeuler(data['fusionQPose']))
+      if not self.FirstTimeStamp:
+        self.FirstTimeStamp = frame['timestamp']
+      frame['timestamp'] -= self.FirstTimeStamp
 
-    if data['heading'] < 0:
-      data['heading'] += 360
+      # apply alignment calibration
+      origfusionQPose = frame['fusionQPose']
+      aligned = quaternion.multiply(frame['fusionQPose'], self.alignmentQ.value)
+      frame['fusionQPose'] = quaternion.normalize(aligned) # floating point precision errors
 
-    dt = data['timestamp'] - self.lasttimestamp
-    self.lasttimestamp = data['timestamp']
-    if dt > .02 and dt < .5:
-      data['headingraterate'] = (data['headingrate'] - self.headingrate) / dt
-    else:
-      data['headingraterate'] = 0
+      frame['roll'], frame['pitch'], frame['heading'] = map(math.degrees, quaternion.toeuler(frame['fusionQPose']))
 
-    self.headingrate = data['headingrate']
+      if frame['heading'] < 0:
+        frame['heading'] += 360
 
-    data['heel'] = self.heel = data['roll']*.03 + self.heel*.97
-    #data['roll'] -= data['heel']
-
-    data['gyro'] = list(map(math.degrees, data['gyro']))
-    data['gyrobias'] = list(map(math.degrees, data['gyrobias']))
+      self.heel = frame['roll']*heel_lp + self.heel*(1-heel_lp)
+      #frame['roll'] -= self.heel
 
-    # lowpass heading and rate
-    llp = self.heading_lowpass_constant.value
-    data['heading_lowpass'] = heading_filter(llp, data['heading'], self.SensorValues['heading_lowpass'].value)
+      # lowpass heading and rate
+      heading_lowpass = heading_filter(heading_lp, frame['heading'], heading_lowpass)
+      headingrate_lowpass = headingrate_lp*frame['headingrate'] + (1-headingrate_lp)*headingrate_lowpass
+      headingraterate_lowpass = headingraterate_lp*frame['headingraterate'] + (1-headingraterate_lp)*headingraterate_lowpass
 
-    llp = self.headingrate_lowpass_constant.value
-    data['headingrate_lowpass'] = llp*data['headingrate'] + (1-llp)*self.SensorValues['headingrate_lowpass'].value
+      compass, accel, down = False, False, False
+      if not accel_locked:
+        accel = list(frame['accel'])
+      if not compass_locked:
+        down = quaternion.rotvecquat([0, 0, 1], quaternion.conjugate(origfusionQPose))
+        compass = list(frame['compass']) + down
+      if accel or compass:
+        points.append((accel, compass, down))
 
-    llp = self.headingraterate_lowpass_constant.value
-    data['headingraterate_lowpass'] = llp*data['headingraterate'] + (1-llp)*self.SensorValues['headingraterate_lowpass'].value
+    data['heel'] = self.heel
+    data['heading_lowpass'] = heading_lowpass
+    data['headingrate_lowpass'] = headingrate_lowpass
+    data['headingraterate_lowpass'] = headingraterate_lowpass
 
     # set sensors
     self.server.TimeStamp('imu', data['timestamp'])
     for name in self.SensorValues:
       self.SensorValues[name].set(data[name])
 
-    compass, accel, down = False, False, False
-    if not self.accel_calibration.locked.value:
-      accel = list(data['accel'])
-    if not self.compass_calibration.locked.value:
-      down = quaternion.rotvecquat([0, 0, 1], quaternion.conjugate(origfusionQPose))
-      compass = list(data['compass']) + down
-    if accel or compass:
-      self.auto_cal.AddPoint((accel, compass, down))
+    if points and self.auto_cal:
+      self.auto_cal.AddPoints(points)
 
     self.uptime.update()
 
@@ -439,7 +492,7 @@ class BoatIMU(object):
       self.update_alignment(self.alignmentQ.value)
       self.last_heading_off = self.heading_off.value
 
-    result = self.auto_cal.UpdatedCalibration()
+    result = self.auto_cal and self.auto_cal.UpdatedCalibration()
     
     if result:
       if result[0] == 'accel' and not self.accel_calibration.locked.value:
@@ -509,6 +562,8 @@ class BoatIMUServer():
     self.t00 = time.time()
 
 def main():
+  if '--simulate' in sys.argv:
+    simulator.enabled = True
   boatimu = BoatIMUServer()
   quiet = '-q' in sys.argv
 
@@ -25,7 +25,36 @@ def debug(*args):
 '''
 calibration_fit_period = 20  # run every 20 seconds
 
-def FitLeastSq(beta0, f, zpoints, dimensions=1):
+# a few gauss newton steps from beta0, which must already be close
+# such as the previous fit.  Each update need not converge fully, the
+# next one continues from here.  returns False if the cost increases
+def FitGaussNewton(beta0, f, jacobian, x, iterations=3):
+    beta = numpy.array(beta0, dtype=float)
+    r = f(beta, x)
+    cost = numpy.dot(r, r)
+    for i in range(iterations):
+        step = numpy.linalg.lstsq(jacobian(beta, x), -r, rcond=-1)[0]
+        if numpy.max(abs(step)) < 1e-6 * (1 + numpy.max(abs(beta))):
+            return list(map(float, beta))
+        for h in range(4): # halve the step until the cost decreases
+            nr = f(beta + step, x)
+            if numpy.dot(nr, nr) <= cost:
+                break
+            step /= 2
+        else:
+            return False
+        beta += step
+        r = nr
+        cost = numpy.dot(r, r)
+    return list(map(float, beta))
+
+# with warm, beta0 is the previous solution and gauss newton is tried first
+def FitLeastSq(beta0, f, zpoints, dimensions=1, jacobian=None, warm=False):
+    if warm and jacobian:
+        fit = FitGaussNewton(beta0, f, jacobian, zpoints)
+        if fit:
+            return fit
+
     try:
         import scipy.optimize
     except Exception as e:
@@ -33,8 +62,8 @@ def FitLeastSq(beta0, f, zpoints, dimensions=1):
         print('cannot perform calibration update!')
         return False
 
-    leastsq = scipy.optimize.leastsq(f, beta0, zpoints)
-    return list(leastsq[0])
+    leastsq = scipy.optimize.leastsq(f, beta0, (zpoints,), Dfun=jacobian)
+    return list(map(float, leastsq[0]))
 
 def FitLeastSq_odr(beta0, f, zpoints, dimensions=1):
     try:
@@ -54,89 +83,109 @@ def FitLeastSq_odr(beta0, f, zpoints, dimensions=1):
         print('exception running odr fit!')
         return False
 
+# points are rows of sensor x, y, z and down x, y, z
 def ComputeDeviation(points, fit):
-    m, d  = 0, 0
-    for p in points:
-        v = vector.sub(p[:3], fit[:3])
-        m += (1 - vector.dot(v, v) / fit[3]**2)**2
-
-        if len(fit) > 4:
-            n = vector.dot(v, p[3:]) / vector.norm(v)
-            if abs(n) <= 1:
-                ang = math.degrees(math.asin(n))
-                d += (fit[4] - ang)**2
-            else:
-                d += 1e111
-    m /= len(points)
-    d /= len(points)
-    return [m**.5, d**.5]
+    points = numpy.asarray(points, dtype=float)
+    v = points[:, :3] - fit[:3]
+    vv = numpy.sum(v**2, axis=1)
+    m = numpy.mean((1 - vv / fit[3]**2)**2)
+
+    d = 0
+    if len(fit) > 4:
+        n = numpy.sum(v*points[:, 3:6], axis=1) / numpy.sqrt(vv)
+        valid = abs(n) <= 1
+        ang = numpy.degrees(numpy.arcsin(n[valid]))
+        d = (numpy.sum((fit[4] - ang)**2) + 1e111*numpy.sum(~valid)) / len(points)
+    return [float(m**.5), float(d**.5)]
 
 def AvgPoint(points):
     # find average point
-    avg = [0.0, 0.0, 0.0]
-    for p in points:
-        for i in range(3):
-            avg[i] += p[i]
-    for i in range(3):
-        avg[i] /= len(points)
-    return avg
+    return list(numpy.mean(numpy.asarray(points, dtype=float)[:, :3], axis=0))
 
 def PointFit(points):
-    avg = AvgPoint(points)
-    dev = 0
-    max_dev = 0
-    for p in points:
-        v = vector.sub(p[:3], avg)
-        d = vector.dot(v, v)
-        max_dev = max(d, max_dev)
-        dev += d
-    dev /= len(points)
-    return avg, dev**.5, max_dev**.5
+    points = numpy.asarray(points, dtype=float)[:, :3]
+    avg = numpy.mean(points, axis=0)
+    d = numpy.sum((points - avg)**2, axis=1)
+    return list(avg), numpy.mean(d)**.5, numpy.max(d)**.5
 
 # fit points to line and plane
 def LinearFit(points):
-    zpoints = [[], [], []]
-    for i in range(3):
-        zpoints[i] = map(lambda x : x[i], points)
-        
-    data = numpy.array(list(zip(zpoints[0], zpoints[1], zpoints[2])))
-    print('zpoints', zpoints[0])
-    print('data', data)
+    data = numpy.asarray(points, dtype=float)[:, :3]
     datamean = data.mean(axis=0)
     uu, dd, vv = numpy.linalg.svd(data - datamean)
 
     line_fit = [datamean, vv[0]]
     plane_fit = [datamean, vv[2]]
 
-    line_dev = 0
-    max_line_dev = 0
-    plane_dev = 0
-    max_plane_dev = 0
-    for p in data:
-        t = vector.dot(p, line_fit[1]) - vector.dot(line_fit[0], line_fit[1])
-        q = map(lambda o, n : o + t*n, line_fit[0], line_fit[1])
-        v = vector.sub(p, q)
-        d = vector.dot(v, v)
-        max_line_dev = max(d, max_line_dev)
-        line_dev += d
-
-        t = vector.dot(p, plane_fit[1]) - vector.dot(plane_fit[0], plane_fit[1])
-        v = list(map(lambda b : t*b, plane_fit[1]))
-        d = vector.dot(v, v)
-        max_plane_dev = max(d, max_plane_dev)
-        plane_dev += d
-        
-    line_dev /= len(points)
-    plane_dev /= len(points)
+    c = data - datamean
+    # distance from line is what remains after removing the component along it
+    t = numpy.dot(c, line_fit[1])
+    d = numpy.sum((c - numpy.outer(t, line_fit[1]))**2, axis=1)
+    line = [line_fit, numpy.mean(d)**.5, numpy.max(d)**.5]
 
-    line = [line_fit, line_dev**.5, max_line_dev**.5]
-    plane = [plane_fit, plane_dev**.5, max_plane_dev**.5]
+    # distance from plane is the component along its normal
+    d = numpy.dot(c, plane_fit[1])**2
+    plane = [plane_fit, numpy.mean(d)**.5, numpy.max(d)**.5]
     return line, plane
 
-def FitPointsAccel(points):
-    zpoints = [[], [], []]
-    for i in range(3):
-        zpoints[i] = map(lambda x : x[i], points)
+# residuals of points x (N, 6) from a sphere, and a jacobian of them
+def sphere_functions():
+    def f(beta, x):
+        m = x[:, :3] - beta[:3]
+        return beta[3] - numpy.sqrt(numpy.sum(m**2, axis=1))
+
+    def jacobian(beta, x):
+        m = x[:, :3] - beta[:3]
+        d = numpy.sqrt(numpy.sum(m**2, axis=1))
+        J = numpy.empty((len(x), 4))
+        J[:, :3] = m / d[:, None]
+        J[:, 3] = 1
+        return J
+    return f, jacobian
+
+# residuals of points x (N, 6) from a sphere followed by residuals of
+# the dip of each sensor vector to its down vector, and a jacobian
+#
+# bias = initial + beta[:k] dot basis  (basis is k by 3)
+# beta[k] is the radius and beta[k+1] the sine of the dip angle
+def sphere_dip_functions(initial, basis):
+    initial = numpy.asarray(initial, dtype=float)
+    basis = numpy.asarray(basis, dtype=float)
+    k = len(basis)
+
+    def geometry(beta, x):
+        m = x[:, :3] - (initial + numpy.dot(beta[:k], basis))
+        d = numpy.sqrt(numpy.sum(m**2, axis=1))
+        dip = numpy.sum(m*x[:, 3:6], axis=1) / d
+        return m, d, dip
+
+    def f(beta, x):
+        m, d, dip = geometry(beta, x)
+        r, s = beta[k], beta[k+1]
+        return numpy.concatenate((r - d, r*(s - numpy.clip(dip, -1, 1))))
+
+    def jacobian(beta, x):
+        m, d, dip = geometry(beta, x)
+        r, s = beta[k], beta[k+1]
+        n = len(x)
+        J = numpy.zeros((2*n, k+2))
+
+        # d(d)/d(bias) = -m/d
+        J[:n, :k] = numpy.dot(m / d[:, None], basis.T)
+        J[:n, k] = 1
+
+        # d(dip)/d(bias) = (dip*m/d - down)/d, zero where clipped
+        ddip = (dip[:, None]*m/d[:, None] - x[:, 3:6]) / d[:, None]
+        ddip[abs(dip) > 1] = 0
+        J[n:, :k] = -r*numpy.dot(ddip, basis.T)
+        J[n:, k] = s - numpy.clip(dip, -1, 1)
+        J[n:, k+1] = r
+        return J
+    return f, jacobian
+
+# current is the previous fit to start from, if any
+def FitPointsAccel(points, current=False):
+    points = numpy.asarray(points, dtype=float)
         
     # determine if we have 0D, 1D, 2D, or 3D set of points
     point_fit, point_dev, point_max_dev = PointFit(points)
@@ -144,28 +193,25 @@ def FitPointsAccel(points):
         debug('insufficient data for accel fit', point_dev, point_max_dev, '< 1')
         return False
 
-    def f_sphere3(beta, x):
-        bias = beta[:3]
-        b = numpy.matrix(map(lambda a, b : a - b, x[:3], bias))
-        m = list(numpy.array(b.transpose()))
-        r0 = map(lambda y : beta[3] - vector.norm(y), m)
-        return r0
-
-    sphere3d_fit = FitLeastSq([0, 0, 0, 1], f_sphere3, zpoints)
+    f_sphere3, j_sphere3 = sphere_functions()
+    if current:
+        sphere3d_fit = FitLeastSq(list(current[:4]), f_sphere3, points, 1, j_sphere3, True)
+    else:
+        sphere3d_fit = FitLeastSq([0, 0, 0, 1], f_sphere3, points, 1, j_sphere3)
     if not sphere3d_fit or sphere3d_fit[3] < 0:
         print('FitLeastSq sphere failed!!!! ', len(points))
         return False
     #debug('sphere3 fit', sphere3d_fit, ComputeDeviation(points, sphere3d_fit))
     return sphere3d_fit
 
-def FitPointsCompass(points, current, norm):
+# with warm, start all fits from the current calibration
+def FitPointsCompass(points, current, norm, warm=False):
     # ensure current and norm are float
-    current = map(float, current)
-    norm = map(float, norm)
+    current = list(map(float, current))
+    norm = list(map(float, norm))
+    dip = math.sin(math.radians(current[4])) if warm else 0
 
-    zpoints = [[], [], [], [], [], []]
-    for i in range(6):
-        zpoints[i] = map(lambda x : x[i], points)
+    points = numpy.asarray(points, dtype=float)
         
     # determine if we have 0D, 1D, 2D, or 3D set of points
     point_fit, point_dev, point_max_dev = PointFit(points)
@@ -178,15 +224,9 @@ def FitPointsCompass(points, current, norm):
     plane_fit, plane_dev, plane_max_dev = plane
 
     # initial guess average min and max for bias, and average range for radius
-    minc = [1000, 1000, 1000]
-    maxc = [-1000, -1000, -1000]
-    for p in points:
-        minc = list(map(min, p[:3], minc))
-        maxc = list(map(max, p[:3], maxc))
-
-    guess = map(lambda a, b : (a+b)/2, minc, maxc)
-    diff = map(lambda a, b : b-a, minc, maxc)
-    guess.append((diff[0]+diff[1]+diff[2])/3)
+    minc = numpy.min(points[:, :3], axis=0)
+    maxc = numpy.max(points[:, :3], axis=0)
+    guess = list(map(float, (minc + maxc)/2)) + [float(numpy.mean(maxc - minc))]
     debug('initial guess', guess)
 
     # initial is the closest to guess on the uv plane containing current
@@ -195,39 +235,13 @@ def FitPointsCompass(points, current, norm):
     debug('initial 1d fit', initial)
 
     # attempt 'normal' fit along normal vector
-    '''
-    def f_sphere1(beta, x):
-        bias = map(lambda x, n: x + beta[0]*n, initial[:3], norm)
-        b = numpy.matrix(map(lambda a, b : a - b, x[:3], bias))
-        m = list(numpy.array(b.transpose()))
-        r0 = map(lambda y : beta[1] - vector.norm(y), m)
-        return r0
-    sphere1d_fit = FitLeastSq([0, initial[3]], f_sphere1, zpoints)
-    if not sphere1d_fit or sphere1d_fit[1] < 0:
-        print('FitLeastSq sphere1d failed!!!! ', len(points))
-        return False
-    sphere1d_fit = map(lambda x, n: x + sphere1d_fit[0]*n, initial[:3], norm) + [sphere1d_fit[1]]
-    debug('sphere1 fit', sphere1d_fit, ComputeDeviation(points, sphere1d_fit))
-    '''
-
-    def f_new_sphere1(beta, x):
-        bias = map(lambda x, n: x + beta[0]*n, initial[:3], norm)
-        b = numpy.matrix(map(lambda a, b : a - b, x[:3], bias))
-        m = list(numpy.array(b.transpose()))
-        r0 = map(lambda y : beta[1] - vector.norm(y), m)
-        g = list(numpy.array(numpy.matrix(x[3:]).transpose()))
-        fac = 1 # weight deviation
-        def dip(y, z):
-            n = min(max(vector.dot(y, z)/vector.norm(y), -1), 1)
-            return n
-        r1 = map(lambda y, z : fac*beta[1]*(beta[2]-dip(y, z)), m, g)
-        return r0 + r1
-    new_sphere1d_fit = FitLeastSq([0, initial[3], 0], f_new_sphere1, zpoints, 2)
+    f_new_sphere1, j_new_sphere1 = sphere_dip_functions(initial[:3], [norm])
+    new_sphere1d_fit = FitLeastSq([0, initial[3], dip], f_new_sphere1, points, 2, j_new_sphere1, warm)
     if not new_sphere1d_fit or new_sphere1d_fit[1] < 0 or abs(new_sphere1d_fit[2]) > 1:
         debug('FitLeastSq new_sphere1 failed!!!! ', len(points), new_sphere1d_fit)
         new_sphere1d_fit = current
     else:
-        new_sphere1d_fit = map(lambda x, a: x + new_sphere1d_fit[0]*a, initial[:3], norm) + [new_sphere1d_fit[1], math.degrees(math.asin(new_sphere1d_fit[2]))]
+        new_sphere1d_fit = list(map(lambda x, a: x + new_sphere1d_fit[0]*a, initial[:3], norm)) + [new_sphere1d_fit[1], math.degrees(math.asin(new_sphere1d_fit[2]))]
     new_sphere1d_fit = [new_sphere1d_fit, ComputeDeviation(points, new_sphere1d_fit), 1]
         #print('new sphere1 fit', new_sphere1d_fit)
 
@@ -246,40 +260,12 @@ def FitPointsCompass(points, current, norm):
     initial.append(current[3])
     debug('initial 2d fit', initial)
     
-    '''
-    def f_sphere2(beta, x):
-        bias = map(lambda x, a, b: x + beta[0]*a + beta[1]*b, initial[:3], u, v)
-        b = numpy.matrix(map(lambda a, b : a - b, x[:3], bias))
-        m = list(numpy.array(b.transpose()))
-        r0 = map(lambda y : beta[2] - vector.norm(y), m)
-        return r0
-    sphere2d_fit = FitLeastSq([0, 0, initial[3]], f_sphere2, zpoints)
-    if not sphere2d_fit or sphere2d_fit[2] < 0:
-        print('FitLeastSq sphere2d failed!!!! ', len(points))
-        new_sphere2d_fit = initial
-    else:
-        sphere2d_fit = map(lambda x, a, b: x + sphere2d_fit[0]*a + sphere2d_fit[1]*b, initial[:3], u, v) + [sphere2d_fit[2]]
-    debug('sphere2 fit', sphere2d_fit, ComputeDeviation(points, sphere2d_fit))
-    '''
-
-    def f_new_sphere2(beta, x):
-        bias = map(lambda x, a, b: x + beta[0]*a + beta[1]*b, initial[:3], u, v)
-        b = numpy.matrix(map(lambda a, b : a - b, x[:3], bias))
-        m = list(numpy.array(b.transpose()))
-        r0 = map(lambda y : beta[2] - vector.norm(y), m)
-        #r0 = map(lambda y : 1 - vector.norm(y)/beta[2], m)
-        g = list(numpy.array(numpy.matrix(x[3:]).transpose()))
-        fac = 1 # weight deviation
-        def dip(y, z):
-            n = min(max(vector.dot(y, z)/vector.norm(y), -1), 1)
-            return n
-        r1 = map(lambda y, z : fac*beta[2]*(beta[3]-dip(y, z)), m, g)
-        return r0 + r1
-    new_sphere2d_fit = FitLeastSq([0, 0, initial[3], 0], f_new_sphere2, zpoints, 2)
+    f_new_sphere2, j_new_sphere2 = sphere_dip_functions(initial[:3], [u, v])
+    new_sphere2d_fit = FitLeastSq([0, 0, initial[3], dip], f_new_sphere2, points, 2, j_new_sphere2, warm)
     if not new_sphere2d_fit or new_sphere2d_fit[2] < 0 or abs(new_sphere2d_fit[3]) >= 1:
         debug('FitLeastSq sphere2 failed!!!! ', len(points), new_sphere2d_fit)
         return False
-    new_sphere2d_fit = map(lambda x, a, b: x + new_sphere2d_fit[0]*a + new_sphere2d_fit[1]*b, initial[:3], u, v) + [new_sphere2d_fit[2], math.degrees(math.asin(new_sphere2d_fit[3]))]
+    new_sphere2d_fit = list(map(lambda x, a, b: x + new_sphere2d_fit[0]*a + new_sphere2d_fit[1]*b, initial[:3], u, v)) + [new_sphere2d_fit[2], math.degrees(math.asin(new_sphere2d_fit[3]))]
     new_sphere2d_fit = [new_sphere2d_fit, ComputeDeviation(points, new_sphere2d_fit), 2]
 
     if plane_max_dev < 1.2:
@@ -293,34 +279,9 @@ def FitPointsCompass(points, current, norm):
         return [new_sphere1d_fit, new_sphere2d_fit, False]
 
     # ok to use best guess for 3d fit
-    initial = guess
-    '''
-    def f_sphere3(beta, x):
-        bias = beta[:3]
-        b = numpy.matrix(map(lambda a, b : a - b, x[:3], bias))
-        m = list(numpy.array(b.transpose()))
-        r0 = map(lambda y : beta[3] - vector.norm(y), m)
-        return r0
-    sphere3d_fit = FitLeastSq(initial[:4], f_sphere3, zpoints)
-    if not sphere3d_fit or sphere3d_fit[3] < 0:
-        print('FitLeastSq sphere failed!!!! ', len(points))
-        return False
-    debug('sphere3 fit', sphere3d_fit, ComputeDeviation(points, sphere3d_fit))
-    '''
-    def f_new_sphere3(beta, x):
-        b = numpy.matrix(map(lambda a, b : a - b, x[:3], beta[:3]))
-        m = list(numpy.array(b.transpose()))
-        r0 = map(lambda y : beta[3] - vector.norm(y), m)
-        #r0 = map(lambda y : 1 - vector.norm(y)/beta[3], m)
-        g = list(numpy.array(numpy.matrix(x[3:]).transpose()))
-        fac = 1 # weight deviation
-        def dip(y, z):
-            n = min(max(vector.dot(y, z)/vector.norm(y), -1), 1)
-            return n
-        r1 = map(lambda y, z : fac*beta[3]*(beta[4]-dip(y, z)), m, g)
-
-        return r0 + r1
-    new_sphere3d_fit = FitLeastSq(initial[:4] + [0], f_new_sphere3, zpoints, 2)
+    initial = current if warm else guess
+    f_new_sphere3, j_new_sphere3 = sphere_dip_functions([0, 0, 0], numpy.identity(3))
+    new_sphere3d_fit = FitLeastSq(initial[:4] + [dip], f_new_sphere3, points, 2, j_new_sphere3, warm)
     if not new_sphere3d_fit or new_sphere3d_fit[3] < 0 or abs(new_sphere3d_fit[4]) >= 1:
         debug('FitLeastSq sphere3 failed!!!! ', len(points))
         return False
@@ -348,13 +309,23 @@ class SigmaPoint(object):
         self.down = avg(fac, self.down, down)
         self.time = time.time()
 
+# offsets of a voxel and its neighbors
+voxel_neighbors = [(x, y, z) for x in [-1, 0, 1] for y in [-1, 0, 1] for z in [-1, 0, 1]]
+
 # store averaged sensore measurements over time for
 # calibration curve fitting
+#
+# points are indexed by a voxel grid with cells the size of the merge
+# distance, so only neighboring cells are searched for a point to
+# merge with.  Distances between all points are cached in numpy
+# arrays and updated as points change, so finding the point to
+# replace does not compare every pair.
 class SigmaPoints(object):
     def __init__(self, sigma, max_sigma_points, min_count):
         self.sigma = sigma
         self.max_sigma_points = max_sigma_points
         self.min_count = min_count
+        self.cell = math.sqrt(sigma)
         self.Reset()
 
     # forget all knowledge of stored sensor points
@@ -362,13 +333,77 @@ class SigmaPoints(object):
         self.sigma_points = []
         self.lastpoint = False
 
+        n = self.max_sigma_points
+        self.sensors = numpy.zeros((n, 3))
+        self.counts = numpy.zeros(n)
+        self.times = numpy.zeros(n)
+        self.distances = numpy.full((n, n), numpy.inf) # between each pair of points
+        self.nearest = numpy.full(n, numpy.inf) # from each point to the closest other
+        self.voxels = []
+        self.grid = {} # voxel -> indexes of points in it
+
     def Points(self):
         p = []
         for sigma in self.sigma_points:
             p.append(sigma.sensor + sigma.down)
         return p
 
-    # store a new sensor
+    # compass sensors also carry the down vector, only the first 3 are indexed
+    def Voxel(self, sensor):
+        return tuple(map(lambda s : int(math.floor(s / self.cell)), sensor[:3]))
+
+    # index of the closest point within sigma of sensor, or -1
+    def Find(self, sensor):
+        x, y, z = self.Voxel(sensor)
+        closest, closest_dist = -1, self.sigma
+        for dx, dy, dz in voxel_neighbors:
+            for i in self.grid.get((x+dx, y+dy, z+dz), []):
+                dist = vector.dist2(self.sigma_points[i].sensor, sensor)
+                if dist < closest_dist:
+                    closest, closest_dist = i, dist
+        return closest
+
+    # refresh the index after sigma point i was added or changed
+    def Update(self, i):
+        point = self.sigma_points[i]
+        voxel = self.Voxel(point.sensor)
+        if self.voxels[i] != voxel:
+            if self.voxels[i]:
+                self.grid[self.voxels[i]].remove(i)
+            self.grid.setdefault(voxel, []).append(i)
+            self.voxels[i] = voxel
+
+        n = len(self.sigma_points)
+        self.sensors[i] = point.sensor[:3]
+        self.counts[i] = point.count
+        self.times[i] = point.time
+        dist = numpy.sqrt(numpy.sum((self.sensors[:n] - self.sensors[i])**2, axis=1))
+        dist[i] = numpy.inf
+
+        # points which were closest to i may now be closer to another
+        nearest = self.nearest[:n]
+        stale = numpy.logical_and(self.distances[i, :n] <= nearest, numpy.isfinite(nearest))
+        self.distances[i, :n] = dist
+        self.distances[:n, i] = dist
+        numpy.minimum(nearest, dist, out=nearest)
+        if stale.any():
+            nearest[stale] = numpy.min(self.distances[:n][stale, :n], axis=1)
+        nearest[i] = numpy.min(dist)
+
+    def Insert(self, point):
+        self.sigma_points.append(point)
+        self.voxels.append(False)
+        self.Update(len(self.sigma_points) - 1)
+
+    # rebuild the index from a new list of points
+    def Rebuild(self, points):
+        lastpoint = self.lastpoint
+        self.Reset()
+        self.lastpoint = lastpoint
+        for point in points:
+            self.Insert(point)
+
+    # store a new sensor, returns True if the sigma points changed
     def AddPoint(self, sensor, down):
         if not self.lastpoint:
             self.lastpoint = SigmaPoint(sensor, down)
@@ -388,57 +423,43 @@ class SigmaPoints(object):
             down[i] /= self.lastpoint.count
         self.lastpoint = False
 
-        ind = 0
-        for point in self.sigma_points:
-            if vector.dist2(point.sensor, sensor) < self.sigma:
-                point.add_measurement(sensor, down)
-                if ind > 0:
-                    # put at front of list to speed up future tests
-                    self.sigma_points = self.sigma_points[:ind-1] + [point] + \
-                                        [self.sigma_points[ind-1]] + self.sigma_points[ind+1:]
-                return
-            ind += 1
+        i = self.Find(sensor)
+        if i >= 0:
+            self.sigma_points[i].add_measurement(sensor, down)
+            self.Update(i)
+            return True
 
-        index = len(self.sigma_points)
         p = SigmaPoint(sensor, down)
-        if index == self.max_sigma_points:
+        n = len(self.sigma_points)
+        if n == self.max_sigma_points:
             # replace point that is closest to other points
-            minweighti = 0
-            minweight = 1e20
-            for i in range(len(self.sigma_points)):
-                for j in range(len(self.sigma_points)):
-                    if i == j:
-                        continue
-                    dist = vector.dist(self.sigma_points[i].sensor, self.sigma_points[j].sensor)
-                    count = min(self.sigma_points[i].count, 100)
-                    dt = time.time() - self.sigma_points[i].time
-                    weight = dist * count**.2 * 1/dt**.1
-                    #print('ij', i, j, dist, count, dt, weight)
-                    if weight < minweight:
-                        minweighti = i
-                        minweight = weight
-
-            #print('replace', minweighti, self.sigma_points[minweighti].count, time.time() - self.sigma_points[minweighti].time)
-            self.sigma_points[minweighti] = p
-            return
+            dt = numpy.maximum(time.time() - self.times[:n], 1e-3)
+            weight = self.nearest[:n] * numpy.minimum(self.counts[:n], 100)**.2 / dt**.1
+            i = int(numpy.argmin(weight))
+            #print('replace', i, self.sigma_points[i].count, time.time() - self.sigma_points[i].time)
+            self.sigma_points[i] = p
+            self.Update(i)
+            return True
 
-        self.sigma_points.append(p)
+        self.Insert(p)
+        return True
 
     def RemoveOlder(self, dt=3600):
         p = []
         for sigma in self.sigma_points:
             if time.time() - sigma.time < dt:
                 p.append(sigma)
-        self.sigma_points = p
+        if len(p) < len(self.sigma_points):
+            self.Rebuild(p)
 
     def RemoveOldest(self):
-        oldest_sigma = self.sigma_points[0]
-        for sigma in self.sigma_points:
-            if sigma.time < oldest_sigma.time:
-                oldest_sigma = sigma
+        n = len(self.sigma_points)
+        if not n:
+            return
+        i = int(numpy.argmin(self.times[:n]))
         # don't remove if < 1 minute old
-        if time.time() - oldest_sigma.time >= 60:
-            self.sigma_points.remove(oldest_sigma)
+        if time.time() - self.times[i] >= 60:
+            self.Rebuild(self.sigma_points[:i] + self.sigma_points[i+1:])
 
 # calculate the largest angle in radians between any two measurements
 # for a given calibration bias and normal vector
@@ -453,7 +474,7 @@ def ComputeCoverage(p, bias, norm):
     #, abs(math.degrees(math.acos(v[2])))
 
     spacing = 20 # 20 degrees
-    angles = [False] * (360 / spacing)
+    angles = [False] * (360 // spacing)
     count = 0
     for a in map(ang, p):
         i = int(resolv(a, 180) / spacing)
@@ -462,22 +483,23 @@ def ComputeCoverage(p, bias, norm):
             count += 1
     return count
 
-def FitAccel(accel_cal):
+def FitAccel(accel_cal, current=False):
     p = accel_cal.Points()
     debug('accelfit count', len(p))
     if len(p) < 5:
         return False
 
-    mina = map(min, *p)
-    maxa = map(max, *p)
-    diff = vector.sub(maxa[:3], mina[:3])
+    p = numpy.array(p)
+    diff = numpy.max(p[:, :3], axis=0) - numpy.min(p[:, :3], axis=0)
     #print('accelfit', diff)
 
     if min(*diff) < 1.2:
         return # require sufficient range on all axes
     if sum(diff) < 4.5:
         return # require more spread
-    fit = FitPointsAccel(p)
+    fit = FitPointsAccel(p, current)
+    if not fit:
+        return
 
     if abs(1-fit[3]) > .1:
         debug('scale factor out of range', fit)
@@ -486,14 +508,14 @@ def FitAccel(accel_cal):
     dev = ComputeDeviation(p, fit)
     return [fit, dev]
 
-def FitCompass(compass_cal, compass_calibration, norm):
+def FitCompass(compass_cal, compass_calibration, norm, warm=False):
     p = compass_cal.Points()
     #print('compassfit count', len(p))
     if len(p) < 8:
         return False
 
     debug('FitPointsCompass', p, compass_calibration, norm)
-    fit = FitPointsCompass(p, compass_calibration, norm)
+    fit = FitPointsCompass(p, compass_calibration, norm, warm)
     if not fit:
         return
     debug('compass fit', fit)
@@ -547,6 +569,8 @@ def FitCompass(compass_cal, compass_calibration, norm):
         # if compass_calibration calibration is really terrible
         if deviation[0]/curdeviation[0] + deviation[1]/curdeviation[1] < 2.5 or curdeviation[0] > .2 or curdeviation[1] > 10:
             debug('allowing bad fit')
+        elif warm: # only batch fits remove points
+            return
         else:
             compass_cal.RemoveOldest()  # remove oldest point if too much deviation
             return # don't use this fit
@@ -573,19 +597,21 @@ def CalibrationProcess(points, norm_pipe, fit_output, accel_calibration, compass
 
     norm = [0, 0, 1]
 
+    # the fits are updated from the previous fit whenever a sigma point
+    # changes, and refit from scratch every calibration_fit_period
+    t = time.time()
+    addedpoint = accel_changed = compass_changed = False
     while True:
-        t = time.time()
-        addedpoint = False
-        while time.time() - t < calibration_fit_period:
-            p = points.recv(1)
-            if p:
-                accel, compass, down = p
-                if accel:
-                    accel_cal.AddPoint(accel, list(accel))
+        p = points.recv(1)
+        if p:
+            # every imu sample since the last read
+            for accel, compass, down in p:
+                if accel and accel_cal.AddPoint(accel, list(accel)):
+                    accel_changed = True
                     #print('add', len(accel_cal.sigma_points))
-                if compass and down:
-                    compass_cal.AddPoint(compass, down)
-                addedpoint = True
+                if compass and down and compass_cal.AddPoint(compass, down):
+                    compass_changed = True
+            addedpoint = True
 
         while True:
             n = norm_pipe.recv()
@@ -593,28 +619,36 @@ def CalibrationProcess(points, norm_pipe, fit_output, accel_calibration, compass
                 break
             norm = n
             compass_cal.Reset()
+            compass_changed = False
             #print('set norm', norm)
 
-        if not addedpoint: # don't bother to run fit if no new data
-            continue
-
-        accel_cal.RemoveOlder(10*60) # 10 minutes
-        fit = FitAccel(accel_cal)
-        if fit: # reset compass sigmapoints on accel cal
-            dist = vector.dist(fit[0][:3], accel_calibration[:3])
-            if dist > .01: # only update when bias changes more than this
-                if dist > .1: # reset compass cal from large change in accel bias
-                    compass_cal.Reset()
-                accel_calibration = fit[0]
-                fit_output.send(('accel', fit, map(lambda p : p.sensor, accel_cal.sigma_points)), False)
-
-
-        compass_cal.RemoveOlder(60*60) # 60 minutes
-
-        fit = FitCompass(compass_cal, compass_calibration, norm)
-        if fit:
-            fit_output.send(('compass', fit, map(lambda p : p.sensor + p.down, compass_cal.sigma_points)), False)
-            compass_calibration = fit[0]
+        batch = time.time() - t >= calibration_fit_period
+        if batch:
+            t = time.time()
+            if not addedpoint: # don't bother to run fit if no new data
+                continue
+            addedpoint = False
+            accel_cal.RemoveOlder(10*60) # 10 minutes
+            compass_cal.RemoveOlder(60*60) # 60 minutes
+
+        if batch or accel_changed:
+            accel_changed = False
+            fit = FitAccel(accel_cal, not batch and accel_calibration)
+            if fit: # reset compass sigmapoints on accel cal
+                dist = vector.dist(fit[0][:3], accel_calibration[:3])
+                if dist > .01: # only update when bias changes more than this
+                    if dist > .1: # reset compass cal from large change in accel bias
+                        compass_cal.Reset()
+                    accel_calibration = fit[0]
+                    fit_output.send(('accel', fit, list(map(lambda p : p.sensor, accel_cal.sigma_points))), False)
+
+        if batch or compass_changed:
+            compass_changed = False
+            fit = FitCompass(compass_cal, compass_calibration, norm, not batch)
+            # between full fits only report a change in bias
+            if fit and (batch or vector.dist(fit[0][:3], compass_calibration[:3]) > .1):
+                fit_output.send(('compass', fit, list(map(lambda p : p.sensor + p.down, compass_cal.sigma_points))), False)
+                compass_calibration = fit[0]
 
 class IMUAutomaticCalibration(object):
     def __init__(self, cal_pipe, accel_calibration, compass_calibration):
@@ -631,8 +665,8 @@ class IMUAutomaticCalibration(object):
         print('terminate calibration process')
         self.process.terminate()
 
-    def AddPoint(self, point):
-        self.points.send(point, False)
+    def AddPoints(self, points):
+        self.points.send(points, False)
 
     def SetNorm(self, norm):
         self.norm_pipe.send(norm)
@@ -788,7 +822,67 @@ def ExtraFit():
     
     
 
+# compare the vectorised fits with and without analytic jacobians
+# to the per point residuals they replaced
+def benchmark(count=20):
+    import scipy.optimize # not part of the timing
+    def legacy_sphere3(beta, x):
+        b = numpy.matrix(list(map(lambda a, b : a - b, x[:3], beta[:3])))
+        m = list(numpy.array(b.transpose()))
+        return list(map(lambda y : beta[3] - vector.norm(y), m))
+
+    def legacy_new_sphere3(beta, x):
+        b = numpy.matrix(list(map(lambda a, b : a - b, x[:3], beta[:3])))
+        m = list(numpy.array(b.transpose()))
+        r0 = list(map(lambda y : beta[3] - vector.norm(y), m))
+        g = list(numpy.array(numpy.matrix(x[3:]).transpose()))
+        def dip(y, z):
+            return min(max(vector.dot(y, z)/vector.norm(y), -1), 1)
+        r1 = list(map(lambda y, z : beta[3]*(beta[4]-dip(y, z)), m, g))
+        return r0 + r1
+
+    numpy.random.seed(0)
+    bias, field, inc = numpy.array([20, -10, 5]), 45, math.radians(60)
+    print('%6s %-12s %12s %12s %12s' % ('points', 'fit', 'legacy ms', 'numeric ms', 'analytic ms'))
+    for n in [18, 100, 1000]:
+        # field vectors at the inclination around random down vectors
+        down = numpy.random.randn(n, 3)
+        down /= numpy.sqrt(numpy.sum(down**2, axis=1))[:, None]
+        side = numpy.cross(down, numpy.random.randn(n, 3))
+        side /= numpy.sqrt(numpy.sum(side**2, axis=1))[:, None]
+        sensor = field*(math.sin(inc)*down + math.cos(inc)*side) + bias + numpy.random.randn(n, 3)*.2
+        points = numpy.hstack((sensor, down))
+        columns = list(map(list, points.T))
+
+        f_sphere3, j_sphere3 = sphere_functions()
+        f_new_sphere3, j_new_sphere3 = sphere_dip_functions([0, 0, 0], numpy.identity(3))
+        for name, legacy, f, j, beta0 in [('sphere', legacy_sphere3, f_sphere3, j_sphere3, [0, 0, 0, 30]),
+                                          ('sphere+dip', legacy_new_sphere3, f_new_sphere3, j_new_sphere3, [0, 0, 0, 30, 0])]:
+            times = []
+            for args in [(legacy, columns, None), (f, points, None), (f, points, j)]:
+                t0 = time.time()
+                for i in range(count):
+                    fit = FitLeastSq(beta0, args[0], args[1], 1, args[2])
+                times.append((time.time() - t0)*1000/count)
+            print('%6d %-12s %12.2f %12.2f %12.2f' % ((n, name) + tuple(times)), ['%.2f' % b for b in fit])
+
+    # adding measurements once the sigma points are full
+    print('%6s %12s' % ('sigma', 'us/point'))
+    for n in [18, 100, 1000]:
+        sigma = SigmaPoints(1**2, n, 1)
+        measurements = numpy.random.randn(10*n, 3)
+        measurements = 45*measurements / numpy.sqrt(numpy.sum(measurements**2, axis=1))[:, None] + bias
+        t0 = time.time()
+        for m in measurements:
+            sigma.AddPoint(list(m), [0, 0, 1])
+            sigma.AddPoint(list(m), [0, 0, 1])
+        print('%6d %12.1f' % (n, (time.time() - t0)*1e6/len(measurements)))
+
 if __name__ == '__main__':
+    if 'benchmark' in sys.argv:
+        benchmark()
+        exit(0)
+
     r = 38.0
     s = math.sin(math.pi/4) * r
     points = [[ r, 0, 0, 0, 0, 1],
@@ -27,6 +27,11 @@ class GpsProcess(multiprocessing.Process):
         while True: # connection to gpsd loop
             try:
                 import gps
+            except ImportError:
+                print('gps library not detected, please install it')
+                while True: # keep the process so the autopilot keeps running
+                    time.sleep(10)
+            try:
                 self.gpsd = gps.gps(mode=gps.WATCH_ENABLE) #starting the stream of info
                 self.gpsd.next() # flush initial message
                 print('connected to gpsd')
@@ -68,7 +73,7 @@ class GpsProcess(multiprocessing.Process):
             self.read(pipe)
             
 class Gpsd(Sensor):
-    def __init__(self, server, sensors):
+    def __init__(self, server, sensors, replay=False):
         super(Gpsd, self).__init__(server, 'gps')
 
         timestamp = server.TimeStamp('gps')
@@ -79,6 +84,8 @@ class Gpsd(Sensor):
 
         self.process = False
         self.devices = []
+        if replay:
+            return
 
         self.process = GpsProcess()
         self.process.start()
@@ -106,7 +113,7 @@ class Gpsd(Sensor):
         self.sensors.write('gps', val, 'gpsd')
 
     def poll(self):
-        while True:
+        while self.process:
             events = self.poller.poll(0)
             if not events:
                 break
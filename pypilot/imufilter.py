@@ -0,0 +1,121 @@
+#!/usr/bin/env python
+#
+#   Copyright (C) 2019 Sean D'Epagnier
+#
+# This Program is free software; you can redistribute it and/or
+# modify it under the terms of the GNU General Public
+# License as published by the Free Software Foundation; either
+# version 3 of the License, or (at your option) any later version.
+
+# anti-aliasing filters run in the imu process at the sensor rate
+#
+# the autopilot only uses one sample per period, so accel, gyro and
+# the fusion pose are lowpassed below the nyquist frequency of the
+# autopilot rate before it picks the latest sample.  headingrate and
+# headingraterate are computed from every sample and filtered the
+# same way, which gives much less noisy derivatives than differencing
+# the decimated samples.
+#
+# filters are butterworth lowpass made of cascaded biquads, order is
+# the number of biquads and bandwidth the cutoff as a fraction of the
+# nyquist frequency of the output rate
+
+from __future__ import print_function
+import math, numpy
+import quaternion
+
+# q of each biquad for butterworth filters of 2*sections order
+butterworth_q = {1: [.70711], 2: [.54120, 1.30656]}
+
+# a lowpass biquad filtering a vector of channels, transposed direct form II
+class Biquad(object):
+    def __init__(self, cutoff, q):
+        w = 2*math.pi*cutoff
+        alpha = math.sin(w) / (2*q)
+        cw = math.cos(w)
+        a0 = 1 + alpha
+        self.b0 = self.b2 = (1 - cw)/2/a0
+        self.b1 = (1 - cw)/a0
+        self.a1 = -2*cw/a0
+        self.a2 = (1 - alpha)/a0
+        self.z1 = self.z2 = False
+
+    # start in steady state at x
+    def reset(self, x):
+        self.z1 = x*(1 - self.b0)
+        self.z2 = x*(self.b2 - self.a2)
+
+    def process(self, x):
+        if self.z1 is False:
+            self.reset(x)
+        y = self.b0*x + self.z1
+        self.z1 = self.b1*x - self.a1*y + self.z2
+        self.z2 = self.b2*x - self.a2*y
+        return y
+
+class Lowpass(object):
+    # cutoff is a fraction of the sample rate
+    def __init__(self, cutoff, sections):
+        self.biquads = list(map(lambda q : Biquad(cutoff, q), butterworth_q[sections]))
+
+    def process(self, x):
+        for biquad in self.biquads:
+            x = biquad.process(x)
+        return x
+
+class IMUFilter(object):
+    def __init__(self, rate, output_rate, sections=1, bandwidth=.8):
+        self.rate = rate
+        self.configure(output_rate, sections, bandwidth)
+
+    def configure(self, output_rate, sections, bandwidth):
+        cutoff = min(bandwidth*output_rate/2, .45*self.rate) / self.rate
+        self.sensors = Lowpass(cutoff, sections) # accel, gyro, fusionQPose and headingrate
+        self.headingraterate = Lowpass(cutoff, sections)
+        self.headingrate = False
+        self.q = False
+
+    # filter a sample from getIMUData in place adding headingrate
+    # and headingraterate in degrees
+    def process(self, data):
+        q = data['fusionQPose']
+        if self.q and sum(map(lambda a, b : a*b, q, self.q)) < 0:
+            q = list(map(lambda x : -x, q)) # same rotation, keep it continuous
+        headingrate = math.degrees(quaternion.rotvecquat(data['gyro'], data['fusionQPose'])[2])
+
+        x = numpy.array(list(data['accel']) + list(data['gyro']) + list(q) + [headingrate])
+        y = self.sensors.process(x)
+        data['accel'] = list(y[:3])
+        data['gyro'] = list(y[3:6])
+        data['fusionQPose'] = self.q = quaternion.normalize(list(y[6:10]))
+
+        # derivative at the full rate of the filtered rate
+        headingrate = y[10]
+        if self.headingrate is False:
+            self.headingrate = headingrate
+        headingraterate = (headingrate - self.headingrate) * self.rate
+        self.headingrate = headingrate
+        data['headingrate'] = float(headingrate)
+        data['headingraterate'] = float(self.headingraterate.process(numpy.array([headingraterate]))[0])
+        return data
+
+if __name__ == '__main__':
+    import time
+    rate, output_rate = 100, 10
+    print('%8s %10s %10s %10s %12s' % ('sections', 'gain 1hz', 'gain 5hz', 'gain 20hz', 'us/sample'))
+    for sections in sorted(butterworth_q):
+        gains = []
+        for f in [1, 5, 20]:
+            lowpass = Lowpass(.8*output_rate/2/rate, sections)
+            t = numpy.arange(0, 10, 1.0/rate)
+            y = list(map(lambda x : lowpass.process(numpy.array([x]))[0], numpy.sin(2*math.pi*f*t)))
+            gains.append(max(map(abs, y[len(y)//2:])))
+
+        imufilter = IMUFilter(rate, output_rate, sections)
+        count = 1000
+        t0 = time.time()
+        for i in range(count):
+            a = 2*math.pi*i/rate
+            q = quaternion.angvec2quat(.1*math.sin(a), [0, 0, 1])
+            imufilter.process({'accel': [0, 0, 1], 'gyro': [0, 0, .1*math.cos(a)], 'fusionQPose': q})
+        print('%8d %10.3f %10.3f %10.3f %12.1f' % tuple([sections] + gains + [(time.time()-t0)*1e6/count]))
@@ -0,0 +1,124 @@
+#!/usr/bin/env python
+#
+#   Copyright (C) 2019 Sean D'Epagnier
+#
+# This Program is free software; you can redistribute it and/or
+# modify it under the terms of the GNU General Public
+# License as published by the Free Software Foundation; either
+# version 3 of the License, or (at your option) any later version.
+
+# ring buffer of imu samples in shared memory
+#
+# the imu process writes every sample into the next slot of an
+# anonymous mmap created before it is forked, and the reader gets all
+# samples written since its last read, so none are dropped when the
+# autopilot is late.  Samples are fixed layout float64, no pickling.
+#
+# header: written:u64 (number of samples ever written)
+# slot:   seq:u64 timestamp accel[3] gyro[3] compass[3] fusionQPose[4]
+#         accel.residuals[3] gyrobias[3] headingrate headingraterate
+#
+# seq is 2*index+1 while sample index is written and 2*index+2 when
+# it is complete, so a reader can tell if the writer is busy with the
+# slot or has already wrapped around and overwritten it.
+
+from __future__ import print_function
+import mmap, struct, os, fcntl, errno
+
+fields = [('timestamp', 1), ('accel', 3), ('gyro', 3), ('compass', 3),
+          ('fusionQPose', 4), ('accel.residuals', 3), ('gyrobias', 3),
+          ('headingrate', 1), ('headingraterate', 1)]
+
+seq_struct = struct.Struct('<Q')
+frame_struct = struct.Struct('<%dd' % sum(map(lambda field : field[1], fields)))
+slot_size = seq_struct.size + frame_struct.size
+
+class IMURing(object):
+    def __init__(self, size=256):
+        self.size = size
+        self.mmap = mmap.mmap(-1, seq_struct.size + slot_size * size)
+        self.written = 0 # writer side
+        self.index = 0 # next sample to read
+        self.overruns = 0
+        self.overrunmsg = 1
+
+        # a byte written here wakes the reader
+        self.wake_read, self.wake_write = os.pipe()
+        for fd in [self.wake_read, self.wake_write]:
+            fcntl.fcntl(fd, fcntl.F_SETFL, fcntl.fcntl(fd, fcntl.F_GETFL) | os.O_NONBLOCK)
+
+    # poll this to wait for samples
+    def fileno(self):
+        return self.wake_read
+
+    def write(self, data):
+        index = self.written
+        offset = seq_struct.size + (index % self.size) * slot_size
+        values = []
+        for name, count in fields:
+            if count == 1:
+                values.append(data[name])
+            else:
+                values += data[name]
+
+        seq_struct.pack_into(self.mmap, offset, 2*index + 1)
+        frame_struct.pack_into(self.mmap, offset + seq_struct.size, *values)
+        seq_struct.pack_into(self.mmap, offset, 2*index + 2)
+        self.written = index + 1
+        seq_struct.pack_into(self.mmap, 0, self.written)
+
+        try:
+            os.write(self.wake_write, b'w')
+        except OSError as e:
+            if e.errno != errno.EAGAIN: # pipe full, reader is already awake
+                raise
+
+    # returns the values of sample index, or False if it was overwritten
+    def read_slot(self, index):
+        offset = seq_struct.size + (index % self.size) * slot_size
+        while True:
+            seq = seq_struct.unpack_from(self.mmap, offset)[0]
+            if seq == 2*index + 1:
+                continue # writer is busy
+            if seq != 2*index + 2:
+                return False
+            values = frame_struct.unpack_from(self.mmap, offset + seq_struct.size)
+            if seq == seq_struct.unpack_from(self.mmap, offset)[0]:
+                return values
+
+    # list of samples as dicts written since the last read, oldest first
+    def read(self):
+        try:
+            while os.read(self.wake_read, 4096):
+                pass
+        except OSError as e:
+            if e.errno != errno.EAGAIN:
+                raise
+
+        written = seq_struct.unpack_from(self.mmap, 0)[0]
+        lost = 0
+        if written - self.index > self.size:
+            lost = written - self.size - self.index
+            self.index = written - self.size
+
+        frames = []
+        while self.index < written:
+            values = self.read_slot(self.index)
+            self.index += 1
+            if not values:
+                lost += 1
+                continue
+            frame = {}
+            i = 0
+            for name, count in fields:
+                frame[name] = values[i] if count == 1 else list(values[i:i+count])
+                i += count
+            frames.append(frame)
+
+        if lost:
+            self.overruns += lost
+            if self.overruns >= self.overrunmsg:
+                print('imu ring overrun (%d)' % self.overruns, 'samples lost')
+                while self.overrunmsg <= self.overruns:
+                    self.overrunmsg *= 10
+        return frames
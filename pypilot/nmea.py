@@ -16,21 +16,25 @@
 # for sensor inputs such as:
 #  wind, gps, rudder
 #
-# inputs nmea: wind, rudder, autopilot commands (serial and tcp)
+# inputs nmea: gps, wind, rudder, water speed, heading, rate of turn,
+#  autopilot commands (serial and tcp)
 # outputs nmea: pitch, roll, and heading messages, wind, rudder (tcp)
+# the sentences are described in sentences.py
 
 from __future__ import print_function
 
 DEFAULT_PORT = 20220
 
-import sys, select, time, socket
+import sys, select, time, socket, errno, collections
 import multiprocessing
 import serial
 from signalk.client import SignalKClient
 from signalk.server import SignalKServer
 from signalk.values import *
 from signalk.pipeserver import NonBlockingPipe
+from signalk import tracing
 from sensors import source_priority
+from sentences import nmea_parsers, nmea_outputs
 import serialprobe
 
 import fcntl
@@ -53,124 +57,6 @@ def check_nmea_cksum(line):
     except:
         return False
 
-def parse_nmea_gps(line):
-    if line[3:6] != 'RMC':
-        return False
-
-    try:
-        data = line[7:len(line)-3].split(',')
-        timestamp = float(data[0])
-        speed = float(data[6])
-        heading = float(data[7])
-    except:
-        return False
-
-    if data[1] == 'V':
-        return False
-
-    return 'gps', {'timestamp': timestamp, 'track': heading, 'speed': speed}
-
-
-'''
-   ** MWV - Wind Speed and Angle
-   **
-   **
-   **
-   ** $--MWV,x.x,a,x.x,a*hh<CR><LF>**
-   ** Field Number:
-   **  1) Wind Angle, 0 to 360 degrees
-   **  2) Reference, R = Relative, T = True
-   **  3) Wind Speed
-   **  4) Wind Speed Units, K/M/N
-   **  5) Status, A = Data Valid
-   **  6) Checksum
-'''
-def parse_nmea_wind(line):
-    if line[3:6] != 'MWV':
-        return False
-
-    data = line.split(',')
-    msg = {}
-    try:
-        msg['direction'] = float(data[1])
-    except:
-        return False  # require direction
-
-    try:
-        speed = float(data[3])
-        speedunit = data[4]
-        if speedunit == 'K': # km/h
-            speed *= .53995
-        elif speedunit == 'M': # m/s
-            speed *= 1.94384
-        msg['speed'] = speed
-    except:
-        pass
-        
-    return 'wind', msg
-
-def parse_nmea_rudder(line):
-    if line[3:6] != 'RSA':
-        return False
-
-    data = line.split(',')
-    try:
-        angle = float(data[1])
-    except:
-        angle = False
-
-    return 'rudder', {'angle': angle}
-
-
-def parse_nmea_apb(line):
-    # also allow ap commands (should we allow via serial too??)
-    '''
-   ** APB - Autopilot Sentence "B"
-   **                                         13    15
-   **        1 2 3   4 5 6 7 8   9 10   11  12|   14|
-   **        | | |   | | | | |   | |    |   | |   | |
-   ** $--APB,A,A,x.x,a,N,A,A,x.x,a,c--c,x.x,a,x.x,a*hh<CR><LF>
-   **
-   **  1) Status
-   **     V = LORAN-C Blink or SNR warning
-   **     V = general warning flag or other navigation systems when a reliable
-   **         fix is not available
-   **  2) Status
-   **     V = Loran-C Cycle Lock warning flag
-   **     A = OK or not used
-   **  3) Cross Track Error Magnitude
-   **  4) Direction to steer, L or R
-   **  5) Cross Track Units, N = Nautical Miles
-   **  6) Status
-   **     A = Arrival Circle Entered
-   **  7) Status
-   **     A = Perpendicular passed at waypoint
-   **  8) Bearing origin to destination
-   **  9) M = Magnetic, T = True
-   ** 10) Destination Waypoint ID
-   ** 11) Bearing, present position to Destination
-   ** 12) M = Magnetic, T = True
-   ** 13) Heading to steer to destination waypoint
-   ** 14) M = Magnetic, T = True
-   ** 15) Checksum
-        '''
-    if line[3:6] != 'APB':
-        return False
-    try:
-        data = line[7:len(line)-3].split(',')
-        mode = 'compass' if data[13] == 'M' else 'gps'
-        track = float(data[12])
-        xte = float(data[2])
-        xte = min(xte, 0.15) # maximum 0.15 miles
-        if data[3] == 'L':
-            xte = -xte
-        return 'apb', {'mode': mode, 'track':  track, 'xte': xte, '**': line[1:3] == 'GP'}
-    except Exception as e:
-        print('ex', e)
-        return False
-
-nmea_parsers = {'gps': parse_nmea_gps, 'wind': parse_nmea_wind, 'rudder': parse_nmea_rudder, 'apb': parse_nmea_apb}
-
 # because serial.readline() is very slow
 class LineBufferedSerialDevice(object):
     def __init__(self, path):
@@ -209,15 +95,18 @@ class NMEASerialDevice(object):
     def close(self):
         self.device.close()
 
+# sentences waiting to be sent are kept per sentence type, so a
+# client that cannot keep up gets the latest of each rather than a
+# growing backlog of stale data
+max_queued_sentences = 32
 nmeasocketuid = 0
 class NMEASocket(object):
     def __init__(self, connection):
         connection.setblocking(0)
         self.socket = connection
         self.b = linebuffer.LineBuffer(connection.fileno())
-        self.out_buffer = ''
-        self.pollout = select.poll()
-        self.pollout.register(connection, select.POLLOUT)
+        self.queue = collections.OrderedDict() # talker and type -> line
+        self.out_buffer = b'' # partly sent data
         self.sendfailcount = 0
         self.failcountmsg = 1
 
@@ -235,37 +124,36 @@ class NMEASocket(object):
         self.socket.close()
 
     def send(self, data):
-        self.out_buffer += data
-        if len(self.out_buffer) > 4096:
-            print('nmea socket out_buffer overflow')
-            self.out_buffer = data
+        key = data[1:6]
+        if key in self.queue:
+            del self.queue[key] # drop the older sentence of this type
+        elif len(self.queue) == max_queued_sentences:
+            self.queue.popitem(False) # drop the oldest sentence
+        self.queue[key] = data
+
+    # True if data is still waiting to be sent
+    def pending(self):
+        return bool(self.out_buffer or self.queue)
 
     def flush(self):
-        if not len(self.out_buffer):
-            return
+        if not self.out_buffer:
+            if not self.queue:
+                return
+            self.out_buffer = ''.join(self.queue.values()).encode()
+            self.queue.clear()
         try:
-            if not self.pollout.poll(0):
-                self.sendfailcount += 1
+            count = self.socket.send(self.out_buffer)
+            self.out_buffer = self.out_buffer[count:]
+        except socket.error as e:
+            if e.errno in [errno.EAGAIN, errno.EWOULDBLOCK]:
+                self.sendfailcount += 1 # wait for POLLOUT
                 if self.sendfailcount == self.failcountmsg:
                     print('nmea socket', self.socket.fileno(), 'failed to send', self.sendfailcount)
                     self.failcountmsg *= 10 # print(only at 1, 10, 100 etc frequency)
-                    
-                self.out_buffer = '' # drop nmea data
-                if self.sendfailcount > 100:
-                    print('closing nmea socket', self.socket.fileno())
-                    self.socket.close() # fail to send too many times, close socket
                 return
-            count = self.socket.send(self.out_buffer.encode())
-            if count < 0:
-                print('nmea socket send error')
-                self.out_buffer = ''
-                self.socket.close()
-                return
-
-            self.out_buffer = self.out_buffer[count:]
-        except Exception as e:
             print ('excep', e)
-            self.out_buffer = ''
+            self.out_buffer = b''
+            self.queue.clear()
             self.socket.close()
 
 class Nmea(object):
@@ -280,15 +168,16 @@ class Nmea(object):
         self.device_fd = {}
 
         self.nmea_times = {}
-        self.last_imu_time = time.time()
-        self.last_rudder_time = time.time()
+        self.output_times = {}
+        self.output_rates = {} # in hz, 0 to not send
+        for sentence in nmea_outputs:
+            formatter, rate, sensor = nmea_outputs[sentence]
+            self.output_rates[sentence] = server.Register(RangeProperty('nmea.rate.' + sentence, rate, 0, 10, persistent=True))
 
         self.devices = []
         self.devices_lastmsg = {}
         self.probedevice = None
 
-        self.start_time = time.time()
-
     def __del__(self):
         print('terminate nmea process')
         self.process.terminate()
@@ -329,28 +218,26 @@ class Nmea(object):
                     self.nmea_times[nmea_name] = t
 
         self.devices_lastmsg[device] = t
-        parsers = []
+        if not line[3:6] in nmea_parsers:
+            return # only split sentences that are parsed
+        fields = device.b.nmea_fields()
+        if not fields or not fields[1] in nmea_parsers:
+            return
+        talker, sentence, data = fields
+        name, parser = nmea_parsers[sentence]
 
         # only process if
         # 1) current source is lower priority
         # 2) we do not have a source yet
         # 3) this the correct device for this data
-        for name in nmea_parsers:
-            name_device = self.sensors.sensors[name].device
-            current_source = self.sensors.sensors[name].source.value
-            if source_priority[current_source] > source_priority['serial'] or \
-               not name_device or name_device[2:] == device.path[0]:
-                parsers.append(nmea_parsers[name])
-
-        # parse the nmea line, and update serial messages
-        for parser in parsers:
-            result = parser(line)
-            if result:
-                name, msg = result
-                if name:
-                    msg['device'] = line[1:3]+device.path[0]
-                    serial_msgs[name] = msg
-                break
+        sensor = self.sensors.sensors[name]
+        if source_priority[sensor.source.value] > source_priority['serial'] or \
+           not sensor.device or sensor.device[2:] == device.path[0]:
+            # parse the nmea line, and update serial messages
+            msg = parser(talker, data)
+            if msg:
+                msg['device'] = talker + device.path[0]
+                serial_msgs[name] = msg
 
     def remove_serial_device(self, device):
         index = self.devices.index(device)
@@ -362,10 +249,11 @@ class Nmea(object):
         device.close()
             
     def poll(self):
-        t0 = time.time()
+        t0 = tracing.start()
         self.probe_serial()
+        tracing.end('nmea.probe', t0)
 
-        t1 = time.time()
+        t0 = tracing.start()
         # handle tcp nmea messages
         serial_msgs = {}
         while True:
@@ -386,11 +274,14 @@ class Nmea(object):
                 else:
                     self.remove_serial_device(self.device_fd[fd])
 
-        t2 = time.time()
+        tracing.end('nmea.read', t0)
+
+        t0 = tracing.start()
         for name in serial_msgs:
             self.sensors.write(name, serial_msgs[name], 'serial')
-        t3 = time.time()
-                
+        tracing.end('nmea.write', t0)
+
+        t0 = tracing.start()
         for device in self.devices:
             # timeout serial devices
             if not device:
@@ -402,37 +293,31 @@ class Nmea(object):
             if dt > 15: # no data for 15 seconds
                 print('serial device timed out', dt, device)
                 self.remove_serial_device(device)
-        t4 = time.time()
-
-        # send nmea messages to sockets at 2hz
-        dt = time.time() - self.last_imu_time
-        if self.process.sockets and (dt > .5 or dt < 0) and \
-           'imu.pitch' in self.server.values:
-            self.send_nmea('APXDR,A,%.3f,D,PTCH' % self.server.values['imu.pitch'].value)
-            self.send_nmea('APXDR,A,%.3f,D,ROLL' % self.server.values['imu.roll'].value)
-            self.send_nmea('APHDM,%.3f,M' % self.server.values['imu.heading_lowpass'].value)
-            self.last_imu_time = time.time()
-
-        # should we output gps?  for now no
+        tracing.end('nmea.timeout', t0)
+
+        t0 = tracing.start()
+        if self.process.sockets:
+            self.send_outputs()
+        tracing.end('nmea.output', t0)
             
-        # limit to 5hz output of wind and rudder
+    def send_outputs(self):
         t = time.time()
-        for name in ['wind', 'rudder'] if self.process.sockets else []:
-            dt = t - self.nmea_times[name] if name in self.nmea_times else -1
-            source = self.sensors.sensors[name].source.value
+        for sentence in nmea_outputs:
+            rate = self.output_rates[sentence].value
+            if not rate:
+                continue
+            dt = t - self.output_times[sentence] if sentence in self.output_times else -1
+            if dt < 1.0/rate and dt >= 0:
+                continue
+            formatter, default_rate, sensor = nmea_outputs[sentence]
             # only output to tcp if we have a better source
-            if (dt > .2 or dt < 0) and source_priority[source] < source_priority['tcp']:
-                if name == 'wind':
-                    wind = self.sensors.wind
-                    self.send_nmea('APMWV,%.3f,R,%.3f,N,A' % (wind.direction.value, wind.speed.value))
-                else:
-                    self.send_nmea('APRSA,%.3f,A,,' % self.sensors.rudder.angle.value)
-                self.nmea_times[name] = t
-            
-        t5 = time.time()
-        if t5 - t0 > .1 and self.start_time - t0 > 1:
-            print('nmea poll times', self.start_time-t0, t1-t0, t2-t1, t3-t2, t4-t3, t5-t4)
-            
+            if sensor and source_priority[self.sensors.sensors[sensor].source.value] >= source_priority['tcp']:
+                continue
+            msg = formatter(self.server.values)
+            if msg:
+                self.send_nmea(msg)
+                self.output_times[sentence] = t
+
     def probe_serial(self):
         # probe new nmea data devices
         if not self.probedevice:
@@ -479,28 +364,25 @@ class NmeaBridgeProcess(multiprocessing.Process):
         super(NmeaBridgeProcess, self).__init__(target=self.process, args=(pipe,))
 
     def setup_watches(self, watch=True):
-        watchlist = ['gps.source', 'wind.source', 'rudder.source', 'apb.source']
-        for name in watchlist:
+        for name in self.last_values:
             self.client.watch(name, watch)
 
-    def receive_nmea(self, line, device, msgs):
-        parsers = []
+    def receive_nmea(self, fields, device, msgs):
+        if not fields or not fields[1] in nmea_parsers:
+            return
+        talker, sentence, data = fields
+        name, parser = nmea_parsers[sentence]
 
         # optimization to only to parse sentences here that would be discarded
         # in the main process anyway because they are already handled by a source
         # with a higher priority than tcp
-        tcp_priority = source_priority['tcp']
-        for name in nmea_parsers:
-            if source_priority[self.last_values[name + '.source']] >= tcp_priority:
-                parsers.append(nmea_parsers[name])
-
-        for parser in  parsers:
-            result = parser(line)
-            if result:
-                name, msg = result
-                msg['device'] = device + line[1:3]
-                msgs[name] = msg
-                return
+        if source_priority[self.last_values[name + '.source']] < source_priority['tcp']:
+            return
+
+        msg = parser(talker, data)
+        if msg:
+            msg['device'] = device + talker
+            msgs[name] = msg
 
     def new_socket_connection(self, server):
         connection, address = server.accept()
@@ -537,6 +419,7 @@ class NmeaBridgeProcess(multiprocessing.Process):
             self.setup_watches(False)
             self.pipe.send('nosockets')
 
+        self.pollout_fds.discard(fd)
         try:
             self.poller.unregister(fd)
         except Exception as e:
@@ -554,6 +437,7 @@ class NmeaBridgeProcess(multiprocessing.Process):
 
     def process(self, pipe):
         import os
+        tracing.init('nmea')
         self.pipe = pipe
         self.sockets = []
         def on_con(client):
@@ -583,7 +467,9 @@ class NmeaBridgeProcess(multiprocessing.Process):
 
         server.listen(5)
 
-        self.last_values = {'gps.source' : 'none', 'wind.source' : 'none', 'rudder.source': 'none', 'apb.source': 'none'}
+        self.last_values = {}
+        for sensor, parser in nmea_parsers.values():
+            self.last_values[sensor + '.source'] = 'none'
         self.addresses = {}
         cnt = 0
 
@@ -591,15 +477,25 @@ class NmeaBridgeProcess(multiprocessing.Process):
         self.poller.register(server, select.POLLIN)
         self.poller.register(pipe, select.POLLIN)
         self.fd_to_socket = {server.fileno() : server, pipe.fileno() : pipe}
+        self.pollout_fds = set()
+        self.client_fd = None
+        self.register_client()
 
+        # block until there is something to do, sentences from the
+        # autopilot are forwarded to the sockets as soon as they arrive
         msgs = {}
+        trace_time = time.time()
         while True:
-            timeout = 100 if self.sockets else 10000
-            t0 = time.time()
+            timeout = 1000 if tracing.tracer else -1
             events = self.poller.poll(timeout)
-            t1 = time.time()
+            ts = tracing.start()
             while events:
                 fd, flag = events.pop()
+                if fd == self.client_fd:
+                    self.receive_client()
+                    continue
+                if not fd in self.fd_to_socket:
+                    continue # removed by an earlier event
                 sock = self.fd_to_socket[fd]
 
                 if flag & (select.POLLHUP | select.POLLERR | select.POLLNVAL):
@@ -620,7 +516,6 @@ class NmeaBridgeProcess(multiprocessing.Process):
                         msg += '\r\n'
                         for sock in self.sockets:
                             sock.send(msg)
-                            pass
                 elif flag & select.POLLIN:
                     if not sock.recv():
                         self.socket_lost(sock, fd)
@@ -629,31 +524,64 @@ class NmeaBridgeProcess(multiprocessing.Process):
                             line = sock.readline()
                             if not line:
                                 break
-                            self.receive_nmea(line, 'socket' + str(sock.uid), msgs)
-                else:
+                            if line[3:6] in nmea_parsers:
+                                self.receive_nmea(sock.b.nmea_fields(), 'socket' + str(sock.uid), msgs)
+                elif not flag & select.POLLOUT: # writable sockets are flushed below
                     print('nmea bridge unhandled poll flag', flag)
 
-            t2 = time.time()
+            tracing.end('nmea_bridge.events', ts)
+
+            ts = tracing.start()
             if msgs:
                 if self.pipe.send(msgs): ## try , False
                     msgs = {}
-
-            t3 = time.time()
+            tracing.end('nmea_bridge.pipe', ts)
+
+            t = time.time()
+            if tracing.tracer and t - trace_time > 1:
+                self.client.send({'method': 'set', 'name': 'trace.nmea', 'value': tracing.summary()})
+                trace_time = t
+
+            ts = tracing.start()
+            self.client.socket.flush()
+            self.flush_sockets()
+            tracing.end('nmea_bridge.flush', ts)
+
+    # register the signalk client socket, which is replaced on reconnect
+    def register_client(self):
+        fd = self.client.socket.socket.fileno()
+        if fd == self.client_fd:
+            return
+        if self.client_fd is not None:
             try:
-                signalk_msgs = self.client.receive()
-                for name in signalk_msgs:
-                    self.client_message(name, signalk_msgs[name]['value'])
-            except Exception as e:
-                print('nmea exception receiving:', e)
-
-            t4 = time.time()
-            for sock in self.sockets:
-                sock.flush()
-            t5 = time.time()
-
-            if t5-t1 > .1:
-                print('nmea process loop too slow:', t1-t0, t2-t1, t3-t2, t4-t3, t5-t4)
-            else:
-                dt = .1 - (t5 - t0)
-                if dt > 0 and dt < .1:
-                    time.sleep(dt)
+                self.poller.unregister(self.client_fd)
+            except Exception:
+                pass # closed on disconnect
+        self.client_fd = fd
+        self.poller.register(fd, select.POLLIN)
+
+    def receive_client(self):
+        ts = tracing.start()
+        try:
+            signalk_msgs = self.client.receive()
+            for name in signalk_msgs:
+                self.client_message(name, signalk_msgs[name]['value'])
+        except Exception as e:
+            print('nmea exception receiving:', e)
+        self.register_client()
+        tracing.end('nmea_bridge.client', ts)
+
+    # wait for POLLOUT only on sockets with data the kernel did not take
+    def flush_sockets(self):
+        for sock in self.sockets:
+            sock.flush()
+            fd = sock.socket.fileno()
+            if fd < 0:
+                continue # closed on error, POLLNVAL will remove it
+            if sock.pending():
+                if not fd in self.pollout_fds:
+                    self.poller.modify(fd, select.POLLIN | select.POLLOUT)
+                    self.pollout_fds.add(fd)
+            elif fd in self.pollout_fds:
+                self.poller.modify(fd, select.POLLIN)
+                self.pollout_fds.remove(fd)
@@ -9,6 +9,14 @@
 
 from pypilot import vector
 import math
+try:
+    import numpy
+except ImportError:
+    numpy = False # only needed by the _many functions
+
+# quaternions are [w, x, y, z].  The _many functions take arrays of
+# quaternions (N, 4) and vectors (N, 3), either may be a single one
+# which is applied to all of the other, and return numpy arrays
 
 def angvec2quat(angle, v):
     n = vector.norm(v)
@@ -41,10 +49,16 @@ def multiply(q1, q2):
 
 
 # take a vector and quaternion, and rotate the vector by the quaternion
+# same as multiply(multiply(q, [0] + v), conjugate(q))[1:] with less work
 def rotvecquat(v, q):
-    w = [0, v[0], v[1], v[2]]
-    r = [q[0], -q[1], -q[2], -q[3]]
-    return multiply(multiply(q, w), r)[1:]
+    # t = 2 * cross(q[1:], v)
+    tx = 2*(q[2]*v[2] - q[3]*v[1])
+    ty = 2*(q[3]*v[0] - q[1]*v[2])
+    tz = 2*(q[1]*v[1] - q[2]*v[0])
+    # v + q[0]*t + cross(q[1:], t)
+    return [v[0] + q[0]*tx + q[2]*tz - q[3]*ty,
+            v[1] + q[0]*ty + q[3]*tx - q[1]*tz,
+            v[2] + q[0]*tz + q[1]*ty - q[2]*tx]
 
 def toeuler(q):
     roll = math.atan2(2.0 * (q[2] * q[3] + q[0] * q[1]), \
@@ -63,3 +77,93 @@ def normalize(q):
         total += v*v
     d = math.sqrt(total)
     return [q[0] / d, q[1] / d, q[2] / d, q[3] / d]
+
+def angvec2quat_many(angle, v):
+    angle = numpy.asarray(angle, dtype=float)
+    n = vector.norm_many(v)
+    fac = numpy.where(n == 0, 0, numpy.sin(angle/2) / numpy.where(n == 0, 1, n))
+    v = numpy.multiply(v, fac[..., None])
+    w = numpy.broadcast_to(numpy.cos(angle/2), v.shape[:-1])
+    return numpy.concatenate((w[..., None], v), axis=-1)
+
+def vec2vec2quat_many(a, b):
+    n = vector.cross_many(a, b)
+    fac = vector.dot_many(a, b) / vector.norm_many(a) / vector.norm_many(b)
+    return angvec2quat_many(numpy.arccos(numpy.clip(fac, -1, 1)), n)
+
+def multiply_many(q1, q2):
+    q1, q2 = numpy.asarray(q1, dtype=float), numpy.asarray(q2, dtype=float)
+    w1, x1, y1, z1 = q1[..., 0], q1[..., 1], q1[..., 2], q1[..., 3]
+    w2, x2, y2, z2 = q2[..., 0], q2[..., 1], q2[..., 2], q2[..., 3]
+    return numpy.stack((w1*w2 - x1*x2 - y1*y2 - z1*z2,
+                        w1*x2 + x1*w2 + y1*z2 - z1*y2,
+                        w1*y2 - x1*z2 + y1*w2 + z1*x2,
+                        w1*z2 + x1*y2 - y1*x2 + z1*w2), axis=-1)
+
+def rotvecquat_many(v, q):
+    v, q = numpy.asarray(v, dtype=float), numpy.asarray(q, dtype=float)
+    u = q[..., 1:]
+    t = 2*vector.cross_many(u, v)
+    return v + q[..., :1]*t + vector.cross_many(u, t)
+
+def toeuler_many(q):
+    q = numpy.asarray(q, dtype=float)
+    w, x, y, z = q[..., 0], q[..., 1], q[..., 2], q[..., 3]
+    roll = numpy.arctan2(2.0 * (y * z + w * x), 1 - 2.0 * (x * x + y * y))
+    pitch = numpy.arcsin(numpy.clip(2.0 * (w * y - x * z), -1, 1))
+    heading = numpy.arctan2(2.0 * (x * y + w * z), 1 - 2.0 * (y * y + z * z))
+    return numpy.stack((roll, pitch, heading), axis=-1)
+
+def conjugate_many(q):
+    return numpy.multiply(q, [1, -1, -1, -1])
+
+def normalize_many(q):
+    q = numpy.asarray(q, dtype=float)
+    return q / numpy.sqrt(numpy.sum(q**2, axis=-1))[..., None]
+
+# compare the scalar functions applied point by point to the _many functions
+def benchmark(count=1000):
+    import time
+    numpy.random.seed(0)
+    def legacy_rotvecquat(v, q):
+        w = [0, v[0], v[1], v[2]]
+        return multiply(multiply(q, w), conjugate(q))[1:]
+
+    def coverage(p, q):
+        c = rotvecquat(p[:3], q)
+        d = rotvecquat(p[3:6], q)
+        return rotvecquat(c, vec2vec2quat(d, [0, 0, 1]))
+
+    def coverage_many(p, q):
+        c = rotvecquat_many(p[:, :3], q)
+        d = rotvecquat_many(p[:, 3:6], q)
+        return rotvecquat_many(c, vec2vec2quat_many(d, [0, 0, 1]))
+
+    print('%6s %-14s %12s %12s %8s' % ('count', 'function', 'scalar us', 'many us', 'speedup'))
+    for n in [1, 18, 1000]:
+        v = numpy.random.randn(n, 3)
+        p = numpy.random.randn(n, 6)
+        q = normalize_many(numpy.random.randn(n, 4))
+        vl, pl, ql = v.tolist(), p.tolist(), q.tolist()
+        q0 = ql[0]
+        cases = [('rotvecquat', lambda : list(map(legacy_rotvecquat, vl, ql)), lambda : rotvecquat_many(v, q)),
+                 ('rotvecquat fast', lambda : list(map(rotvecquat, vl, ql)), lambda : rotvecquat_many(v, q)),
+                 ('multiply', lambda : list(map(multiply, ql, ql)), lambda : multiply_many(q, q)),
+                 ('toeuler', lambda : list(map(toeuler, ql)), lambda : toeuler_many(q)),
+                 ('normalize', lambda : list(map(normalize, ql)), lambda : normalize_many(q)),
+                 ('vec2vec2quat', lambda : list(map(vec2vec2quat, vl, pl)), lambda : vec2vec2quat_many(v, p[:, :3])),
+                 ('coverage', lambda : list(map(lambda x : coverage(x, q0), pl)), lambda : coverage_many(p, q0))]
+        for name, scalar, many in cases:
+            if not numpy.allclose(scalar(), many()):
+                print(name, 'results differ!')
+            times = []
+            for f in [scalar, many]:
+                iterations = max(count // n, 10)
+                t0 = time.time()
+                for i in range(iterations):
+                    f()
+                times.append((time.time() - t0)*1e6/iterations)
+            print('%6d %-14s %12.1f %12.1f %8.1f' % (n, name, times[0], times[1], times[0]/times[1]))
+
+if __name__ == '__main__':
+    benchmark()
@@ -0,0 +1,384 @@
+#!/usr/bin/env python
+#
+#   Copyright (C) 2019 Sean D'Epagnier
+#
+# This Program is free software; you can redistribute it and/or
+# modify it under the terms of the GNU General Public
+# License as published by the Free Software Foundation; either
+# version 3 of the License, or (at your option) any later version.
+
+# replay recordings (see signalk/recorder.py) through the autopilot
+#
+# BoatIMU, Sensors and the servo telemetry are fed from the recording
+# while the pilots, tacking and servo run unchanged on a virtual clock,
+# as fast as possible.  Each recorded imu sample is one iteration.
+#
+#   python -m pypilot.replay -s ap.pilot.basic.D=.12 [FILE]...
+#
+# the replay is open loop: the boat moves as recorded whatever the
+# servo is commanded, so gain changes show up in servo.command, which
+# is compared to the recorded command.  With -m a ResponseModel closes
+# the loop so the heading responds to the commands.  Persistent values
+# start as recorded, and the user commands (enable, mode, heading
+# command, pilot and tacking) are applied as they changed in the
+# recording unless they are set.
+
+from __future__ import print_function
+import os, sys, time, getopt, math
+import numpy
+from signalk import recorder, kjson
+from signalk.server import SignalKServer
+from pypilot.autopilot import Autopilot
+from pypilot import quaternion
+from pypilot.servo import ServoFlags, ServoTelemetry
+
+root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+# recorded imu values and their defaults if not recorded
+imu_fields = {'accel': False, 'gyro': False, 'fusionQPose': False, 'headingrate': False,
+              'compass': [0, 0, 0], 'accel.residuals': [0, 0, 0], 'gyrobias': [0, 0, 0],
+              'headingraterate': 0}
+
+sensor_fields = {'gps': ['track', 'speed'], 'wind': ['direction', 'speed'], 'rudder': ['angle']}
+servo_fields = {'current': ServoTelemetry.CURRENT, 'voltage': ServoTelemetry.VOLTAGE,
+                'controller_temp': ServoTelemetry.CONTROLLER_TEMP, 'motor_temp': ServoTelemetry.MOTOR_TEMP}
+
+inputs = ['ap.enabled', 'ap.mode', 'ap.pilot', 'ap.heading_command', 'ap.tack.direction', 'ap.tack.state']
+
+# the recording holds corrected values, so corrections are removed
+identity = {'wind.offset': 0, 'rudder.offset': 0, 'rudder.scale': 1, 'rudder.nonlinearity': 0,
+            'servo.current.factor': 1, 'servo.current.offset': 0,
+            'servo.voltage.factor': 1, 'servo.voltage.offset': 0}
+
+outputs = ['ap.enabled', 'ap.heading', 'ap.heading_command', 'ap.heading_error', 'servo.command', 'servo.watts']
+
+# stands in for the time module of every pypilot and signalk module
+class VirtualClock(object):
+    def __init__(self, t=0):
+        self.t = t
+
+    def time(self):
+        return self.t
+
+    def monotonic(self):
+        return self.t
+
+    def sleep(self, dt):
+        self.t += max(dt, 0)
+
+    def __getattr__(self, name): # strftime, localtime...
+        return getattr(time, name)
+
+    def install(self):
+        for module in list(sys.modules.values()):
+            t = getattr(module, 'time', None)
+            if module.__name__ != __name__ and (t is time or isinstance(t, VirtualClock)) and \
+               (getattr(module, '__file__', None) or '').startswith(root):
+                module.time = self
+
+# no clients, nothing stored or recorded
+class ReplayServer(SignalKServer):
+    def __init__(self):
+        super(ReplayServer, self).__init__(persistent_path=False)
+        self.recorder = False
+
+    def HandleRequests(self, timeout=0):
+        pass
+
+# the autopilot never waits, replay advances the clock instead
+class ReplayScheduler(object):
+    def wait(self, fd):
+        return True
+
+    def stage(self, name):
+        pass
+
+    def finish(self):
+        pass
+
+# takes the place of ArduinoServo (and its device) reporting recorded telemetry
+class ReplayServoDriver(object):
+    def __init__(self):
+        self.path = 'replay'
+        self.voltage = self.current = self.controller_temp = self.motor_temp = 0
+        self.rudder = False
+        self.flags = 0
+        self.telemetry = 0
+        self.speed = 0
+
+    def command(self, command):
+        self.speed = command
+        self.flags |= ServoFlags.ENGAGED
+
+    def disengage(self):
+        self.speed = 0
+        self.flags &= ~ServoFlags.ENGAGED
+
+    def params(self, *args):
+        pass
+
+    def reset(self):
+        pass
+
+    def fault(self):
+        return False
+
+    def close(self):
+        pass
+
+    def poll(self):
+        result = self.telemetry | ServoTelemetry.FLAGS
+        self.telemetry = 0
+        return result
+
+# closes the loop around a recording: the boat responds to the
+# difference between the replayed and recorded servo commands, and
+# the recorded motion acts as the disturbance.  The rudder moves slew
+# degrees per second at full command, and positive rudder turns the
+# boat to port at yaw_gain degrees per second per degree of rudder per
+# knot, responding with time constant tau.  The servo draws current
+# amps at full command.
+class ResponseModel(object):
+    def __init__(self, slew=5.0, yaw_gain=.1, tau=2.0, current=4.0, speed=5.0):
+        self.slew = slew
+        self.yaw_gain = yaw_gain
+        self.tau = tau
+        self.current = current
+        self.speed = speed # knots without gps
+        self.rudder = self.heading = self.rate = self.accel = 0
+
+    def update(self, dt, command, recorded_command, speed):
+        rudder = self.rudder + (command - recorded_command)*self.slew*dt
+        self.rudder = min(max(rudder, -45), 45)
+        self.accel = (-self.yaw_gain*speed*self.rudder - self.rate) / self.tau
+        self.rate += self.accel*dt
+        self.heading += self.rate*dt
+
+# recorded value as it was set, nan (recorded False) is False
+def sample(track, i):
+    value = track['value'][i]
+    if hasattr(value, 'tolist'):
+        value = value.tolist()
+    if type(value) == list:
+        if value and type(value[0]) == float and math.isnan(value[0]):
+            return False
+    elif type(value) == float and math.isnan(value):
+        return False
+    return value
+
+class Replay(object):
+    # data is from recorder.read, settings override recorded values
+    # and model is a ResponseModel to close the loop
+    def __init__(self, data, settings={}, model=False):
+        if not 'imu.fusionQPose' in data:
+            raise Exception('recording has no imu data')
+        self.data = data
+        self.times = data['imu.fusionQPose']['time']
+        self.model = model
+        self.inputs = [name for name in inputs if not name in settings]
+
+        self.clock = VirtualClock(self.times[0])
+        self.clock.install()
+        self.server = ReplayServer()
+        self.scheduler = ReplayScheduler()
+        self.ap = Autopilot(self)
+
+        servo = self.ap.servo
+        self.driver = servo.driver = servo.device = ReplayServoDriver()
+        servo.controller.set('replay')
+        servo.lastpolltime = self.clock.time()
+
+        for name, value in self.server.values.items():
+            if value.persistent and name in data:
+                v = sample(data[name], 0)
+                if not v is False:
+                    value.set(v)
+        for name, v in list(identity.items()) + list(settings.items()):
+            if name in self.server.values:
+                self.server.values[name].set(v)
+            else:
+                print('replay: unknown value', name)
+
+        # index of the latest sample of each value at every frame, the
+        # imu values are set together so allow some slack in their times
+        self.indexes = {}
+        names = ['imu.' + name for name in imu_fields] + inputs + ['servo.command', 'servo.raw_command']
+        names += ['servo.' + name for name in servo_fields]
+        for sensor, fields in sensor_fields.items():
+            names += [sensor + '.' + field for field in fields + ['source']]
+        for name in names:
+            if name in data:
+                slack = .01 if name.startswith('imu.') else 0
+                self.indexes[name] = numpy.searchsorted(data[name]['time'], self.times + slack, 'right') - 1
+
+    def value(self, name, i, default=None):
+        if not name in self.indexes or self.indexes[name][i] < 0:
+            return default
+        return sample(self.data[name], self.indexes[name][i])
+
+    # the value of name if it changed since the last frame, otherwise None
+    def changed(self, name, i):
+        if not name in self.indexes:
+            return None
+        index = self.indexes[name]
+        if index[i] < 0 or (i and index[i-1] == index[i]):
+            return None
+        return sample(self.data[name], index[i])
+
+    # imu sample as the imu process writes it
+    def frame(self, i):
+        data = {'timestamp': self.times[i]}
+        for name, default in imu_fields.items():
+            value = self.value('imu.' + name, i)
+            if value is None or value is False:
+                if default is False:
+                    return False
+                value = default
+            data[name] = value
+
+        alignment = quaternion.conjugate(self.ap.boatimu.alignmentQ.value)
+        data['fusionQPose'] = quaternion.normalize(quaternion.multiply(data['fusionQPose'], alignment))
+        data['gyro'] = list(map(math.radians, data['gyro']))
+        data['gyrobias'] = list(map(math.radians, data['gyrobias']))
+
+        # gyro is left as recorded as only pitch and roll rates use it
+        model = self.model
+        if model:
+            q = quaternion.angvec2quat(math.radians(model.heading), [0, 0, 1])
+            data['fusionQPose'] = quaternion.normalize(quaternion.multiply(q, data['fusionQPose']))
+            data['headingrate'] += model.rate
+            data['headingraterate'] += model.accel
+        return data
+
+    def update_model(self, i):
+        model, driver = self.model, self.driver
+        speed = self.value('gps.speed', i)
+        if not speed:
+            speed = model.speed
+        recorded = self.value('servo.raw_command', i, 0) or 0
+        if i:
+            model.update(self.times[i] - self.times[i-1], driver.speed, recorded, speed)
+
+        driver.current = model.current*abs(driver.speed)
+        driver.voltage = self.value('servo.voltage', i, 12) or 12
+        driver.telemetry |= ServoTelemetry.CURRENT | ServoTelemetry.VOLTAGE
+
+    def step(self, i):
+        self.clock.t = self.times[i]
+        for name in self.inputs:
+            value = self.changed(name, i)
+            if value is None or (name == 'ap.tack.state' and value != 'begin'):
+                continue
+            self.server.values[name].set(value)
+
+        for sensor, fields in sensor_fields.items():
+            if not any(map(lambda field : self.changed(sensor + '.' + field, i) is not None, fields)):
+                continue
+            source = self.value(sensor + '.source', i, 'none')
+            if source == 'none':
+                continue
+            data = {'device': 'replay'}
+            for field in fields:
+                data[field] = self.value(sensor + '.' + field, i)
+            if any(map(lambda field : data[field] is None or data[field] is False, fields)):
+                continue
+            if self.model and sensor == 'gps':
+                data['track'] = (data['track'] + self.model.heading) % 360
+            elif self.model and sensor == 'wind':
+                data['direction'] -= self.model.heading
+            self.ap.sensors.write(sensor, data, source)
+
+        for name, bit in servo_fields.items():
+            value = self.changed('servo.' + name, i)
+            if value is not None and value is not False:
+                setattr(self.driver, name, value)
+                self.driver.telemetry |= bit
+        if self.model:
+            self.update_model(i)
+
+        data = self.frame(i)
+        if data:
+            self.ap.boatimu.ring.write(data)
+        self.ap.iteration()
+
+    # returns {name: array} of outputs at every frame
+    def run(self, outputs=outputs):
+        results = dict(map(lambda name : (name, []), outputs))
+        t0 = time.time()
+        for i in range(len(self.times)):
+            self.step(i)
+            for name in outputs:
+                value = self.server.values[name].value
+                results[name].append(float('nan') if value is False else float(value))
+        self.walltime = time.time() - t0
+        for name in results:
+            results[name] = numpy.array(results[name])
+        return results
+
+    # recorded servo command at every frame
+    def recorded_command(self):
+        if not 'servo.command' in self.indexes:
+            return False
+        index = self.indexes['servo.command']
+        values = numpy.array(self.data['servo.command']['value'], dtype=float)
+        return numpy.where(index >= 0, values[numpy.maximum(index, 0)], numpy.nan)
+
+def rms(x):
+    x = x[numpy.isfinite(x)]
+    return math.sqrt(numpy.mean(x**2)) if len(x) else float('nan')
+
+def summary(replay, results):
+    duration = replay.times[-1] - replay.times[0]
+    print('replayed %d iterations, %.1f seconds in %.2f seconds, %.0f times real time' %
+          (len(replay.times), duration, replay.walltime, duration / max(replay.walltime, 1e-6)))
+    enabled = results['ap.enabled'] > 0
+    print('enabled %.1f%%' % (100.0*numpy.mean(enabled)))
+    if numpy.any(enabled):
+        print('heading error rms %.3f' % rms(results['ap.heading_error'][enabled]))
+        print('servo command rms %.4f' % rms(results['servo.command'][enabled]))
+        recorded = replay.recorded_command()
+        if recorded is not False:
+            print('servo command rms from recording %.4f' % rms((results['servo.command'] - recorded)[enabled]))
+
+# values given on the command line, json rejects numbers such as .12
+def parse_value(value):
+    for number in [int, float]:
+        try:
+            return number(value)
+        except ValueError:
+            pass
+    try:
+        return kjson.loads(value)
+    except Exception:
+        return value # plain string
+
+def main():
+    try:
+        opts, args = getopt.getopt(sys.argv[1:], 's:mh', ['set=', 'model', 'help'])
+    except getopt.GetoptError as e:
+        print(e)
+        opts, args = [('-h', '')], []
+
+    settings = {}
+    model = False
+    for o, a in opts:
+        if o in ['-h', '--help']:
+            print('usage: python -m pypilot.replay [-m] [-s name=value]... [FILE]...')
+            print('replays FILEs, by default all recordings, with values set as given')
+            print('-m  closes the loop with a model of the boat response')
+            exit(0)
+        if o in ['-m', '--model']:
+            model = ResponseModel()
+            continue
+        name, value = a.split('=', 1)
+        settings[name] = parse_value(value)
+
+    data = recorder.read(args)
+    if not data:
+        print('no recordings')
+        exit(1)
+    replay = Replay(data, settings, model)
+    summary(replay, replay.run())
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,141 @@
+#!/usr/bin/env python
+#
+#   Copyright (C) 2019 Sean D'Epagnier
+#
+# This Program is free software; you can redistribute it and/or
+# modify it under the terms of the GNU General Public
+# License as published by the Free Software Foundation; either
+# version 3 of the License, or (at your option) any later version.
+
+# fixed rate scheduler for the autopilot loop
+#
+# iterations are timed from absolute deadlines on the monotonic clock
+# so errors do not accumulate.  Each iteration starts when imu data
+# arrives near its deadline, and the deadline is slowly pulled toward
+# the imu to keep the two processes in phase.  Data already waiting
+# (the imu runs faster than the loop) starts the iteration at the
+# deadline without moving it.
+#
+# the duration of each stage, the loop jitter (start relative to the
+# deadline) and deadline misses are published as ap.timing.* values
+# once per window as histograms with bucket edges in ap.timing.buckets
+
+from __future__ import print_function
+import time, select
+from signalk.values import *
+from signalk import tracing
+
+try:
+    monotonic = time.monotonic
+except AttributeError: # python 2
+    monotonic = time.time
+
+# upper bucket edges as a fraction of the period, the last
+# bucket counts anything longer than a whole period
+bucket_edges = [.02, .05, .1, .2, .3, .5, .75, 1]
+
+class TimingHistogram(JSONValue):
+    def __init__(self, name):
+        super(TimingHistogram, self).__init__(name, False)
+        self.reset()
+
+    def reset(self):
+        self.counts = [0] * (len(bucket_edges) + 1)
+        self.total = self.max = 0
+
+    def add(self, fraction):
+        for i in range(len(bucket_edges)):
+            if fraction <= bucket_edges[i]:
+                break
+        else:
+            i = len(bucket_edges)
+        self.counts[i] += 1
+        self.total += fraction
+        self.max = max(self.max, fraction)
+
+    # publish window in milliseconds and start a new one
+    def publish(self, period):
+        count = sum(self.counts)
+        if count:
+            self.set({'histogram': self.counts,
+                      'mean': round(1000*period*self.total/count, 3),
+                      'max': round(1000*period*self.max, 3)})
+        self.reset()
+
+class LoopScheduler(object):
+    def __init__(self, server, period, stages, window=10):
+        self.period = period
+        self.stages = stages
+        self.window = window
+        self.histograms = {}
+        for name in stages + ['total', 'jitter']:
+            self.histograms[name] = server.Register(TimingHistogram('ap.timing.' + name))
+        self.buckets = server.Register(JSONValue('ap.timing.buckets', [round(1000*period*edge, 1) for edge in bucket_edges]))
+        self.misses = server.Register(ResettableValue('ap.timing.misses', 0))
+        self.imu_timeouts = server.Register(ResettableValue('ap.timing.imu_timeouts', 0))
+
+        self.deadline = monotonic() + period
+        self.window_time = monotonic() + window
+        self.poller = select.poll()
+        self.fd = False
+        self.start = self.mark = 0
+
+    # sleep until half a period before the deadline, then wait on fd
+    # until it is readable or half a period after the deadline
+    # returns False if fd never became readable
+    def wait(self, fd):
+        if fd != self.fd:
+            if self.fd:
+                self.poller.unregister(self.fd)
+            self.poller.register(fd, select.POLLIN)
+            self.fd = fd
+
+        t = monotonic()
+        dt = self.deadline - self.period/2 - t
+        if dt > 0:
+            time.sleep(dt)
+        waiting = self.poller.poll(0)
+        if waiting:
+            # arrived before this wait, only data arriving
+            # during the wait tells the phase of the imu
+            dt = self.deadline - monotonic()
+            if dt > 0:
+                time.sleep(dt)
+            ready = waiting
+        else:
+            timeout = max(self.deadline + self.period/2 - monotonic(), 0)
+            ready = self.poller.poll(1000*timeout)
+
+        self.start = self.mark = monotonic()
+        jitter = self.start - self.deadline
+        self.histograms['jitter'].add(abs(jitter) / self.period)
+        if ready and not waiting:
+            # phase lock to the imu, filtered to reject its jitter
+            self.deadline += jitter / 4
+        elif not ready:
+            self.imu_timeouts.set(self.imu_timeouts.value + 1)
+        return bool(ready)
+
+    # record the time since the last stage ended
+    def stage(self, name):
+        t = monotonic()
+        self.histograms[name].add((t - self.mark) / self.period)
+        tracing.end('ap.' + name, self.mark)
+        self.mark = t
+
+    def finish(self):
+        t = monotonic()
+        self.histograms['total'].add((t - self.start) / self.period)
+
+        self.deadline += self.period
+        if t > self.deadline:
+            # missed the next deadline, skip ahead rather
+            # than running several iterations late
+            self.misses.set(self.misses.value + 1)
+            while self.deadline < t:
+                self.deadline += self.period
+
+        if t >= self.window_time:
+            self.window_time = t + self.window
+            for name in self.histograms:
+                self.histograms[name].publish(self.period)
@@ -109,8 +109,13 @@ class APB(Sensor):
             return
 
         self.last_time = t
-        self.track.update(data['track'])
         self.xte.update(data['xte'])
+        if 'track' in data:
+            self.track.update(data['track'])
+        elif type(self.track.value) == bool:
+            return # XTE before a track is known
+        else: # XTE, steer to the last track
+            data['track'] = self.track.value
 
         if not 'ap.enabled' in self.server.values:
             print('ERROR, parsing apb without autopilot')
@@ -120,9 +125,9 @@ class APB(Sensor):
             return
 
         mode = self.server.values['ap.mode']
-        if mode.value != data['mode']:
+        if 'mode' in data and mode.value != data['mode']:
             # for GPAPB, ignore message on wrong mode
-            if data['**'] != 'GP':
+            if data.get('**') != 'GP':
                 mode.set(data['mode'])
 
         command = data['track'] + self.gain.value*data['xte']
@@ -131,25 +136,94 @@ class APB(Sensor):
         if abs(heading_command.value - command) > .1:
             heading_command.set(command)
 
-    
-class Sensors(object):
+
+# speed through water
+class Water(Sensor):
+    def __init__(self, server):
+        super(Water, self).__init__(server, 'water')
+        timestamp = server.TimeStamp('water')
+        self.speed = self.Register(SensorValue, 'speed', timestamp)
+
+    def update(self, data):
+        self.speed.set(data['speed'])
+
+    def reset(self):
+        self.speed.set(False)
+
+# heading from HDG and HDT sentences
+class Heading(Sensor):
+    def __init__(self, server):
+        super(Heading, self).__init__(server, 'heading')
+        timestamp = server.TimeStamp('heading')
+        self.magnetic = self.Register(SensorValue, 'magnetic', timestamp, directional=True)
+        self.true = self.Register(SensorValue, 'true', timestamp, directional=True)
+
+    def update(self, data):
+        if 'magnetic' in data:
+            self.magnetic.set(data['magnetic'])
+        if 'true' in data:
+            self.true.set(data['true'])
+
+    def reset(self):
+        self.magnetic.set(False)
+        self.true.set(False)
+
+# rate of turn in degrees per second, positive to starboard
+class RateOfTurn(Sensor):
+    def __init__(self, server):
+        super(RateOfTurn, self).__init__(server, 'rot')
+        timestamp = server.TimeStamp('rot')
+        self.rate = self.Register(SensorValue, 'rate', timestamp)
+
+    def update(self, data):
+        self.rate.set(data['rate'])
+
+    def reset(self):
+        self.rate.set(False)
+
+# true wind direction relative to north
+class TrueWind(Sensor):
     def __init__(self, server):
+        super(TrueWind, self).__init__(server, 'truewind')
+        timestamp = server.TimeStamp('truewind')
+        self.direction = self.Register(SensorValue, 'direction', timestamp, directional=True)
+        self.speed = self.Register(SensorValue, 'speed', timestamp)
+
+    def update(self, data):
+        self.direction.set(data['direction'])
+        if 'speed' in data:
+            self.speed.set(data['speed'])
+
+    def reset(self):
+        self.direction.set(False)
+        self.speed.set(False)
+
+class Sensors(object):
+    # with replay, data is written by replay.py instead of nmea and gpsd
+    def __init__(self, server, replay=False):
         from gpsd import Gpsd
         from rudder import Rudder
         from nmea import Nmea
         
         self.server = server
-        self.nmea = Nmea(server, self)
-        self.gps = Gpsd(server, self)
+        self.nmea = False if replay else Nmea(server, self)
+        self.gps = Gpsd(server, self, replay)
         self.wind = Wind(server)
         self.rudder = Rudder(server)
         self.apb = APB(server)
+        self.water = Water(server)
+        self.heading = Heading(server)
+        self.rot = RateOfTurn(server)
+        self.truewind = TrueWind(server)
 
-        self.sensors = {'gps': self.gps, 'wind': self.wind, 'rudder': self.rudder, 'apb': self.apb}
+        self.sensors = {'gps': self.gps, 'wind': self.wind, 'rudder': self.rudder, 'apb': self.apb,
+                        'water': self.water, 'heading': self.heading, 'rot': self.rot,
+                        'truewind': self.truewind}
 
     def poll(self):
         self.gps.poll()
-        self.nmea.poll()
+        if self.nmea:
+            self.nmea.poll()
         self.rudder.poll()
 
         # timeout sources
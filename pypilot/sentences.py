@@ -0,0 +1,237 @@
+#!/usr/bin/env python
+#
+#   Copyright (C) 2019 Sean D'Epagnier
+#
+# This Program is free software; you can redistribute it and/or
+# modify it under the terms of the GNU General Public
+# License as published by the Free Software Foundation; either
+# version 3 of the License, or (at your option) any later version.
+
+# nmea sentences pypilot reads and writes
+#
+# each input sentence is described by the sensor it feeds and its fields
+# in order after the sentence type, the parser is generated from this
+# as python source so no time is spent interpreting the description
+# for each sentence received.  A field is one of:
+#
+#   -             ignored
+#   valid         status, the sentence is discarded if it is V or N
+#   name          number
+#   name:text     string
+#   name:knots    speed with units in the next field, converted to knots
+#   name:lr       magnitude with L or R in the next field, L is negative
+#   name:ew       magnitude with E or W in the next field, W is negative
+#   name:minute   rate per minute, converted to per second
+#
+# parsers take the talker and fields as split by LineBuffer.nmea_fields
+# where numbers are already float and empty fields None, they return
+# a dict of the named fields present or False.
+#
+# output sentences are a template of the fields with signalk value
+# names and formats in braces, sent at a rate set by nmea.rate.TYPE
+
+from __future__ import print_function
+import re
+
+# units of speed fields
+speed_units = {'N': 1, 'K': .53995, 'M': 1.94384}
+
+invalid_status = ('V', 'N')
+
+# fields using the next field for units or sign
+paired_kinds = ['knots', 'lr', 'ew']
+
+def parser_source(sentence, fields, required):
+    count = 0
+    for token in fields.split():
+        count += 2 if token.split(':')[-1] in paired_kinds else 1
+
+    lines = ['def parse_%s(talker, data):' % sentence,
+             '    if len(data) < %d:' % count,
+             '        data = list(data) + [None]*(%d - len(data))' % count,
+             '    msg = {}']
+    index = 0
+    for token in fields.split():
+        name, kind = (token.split(':') + [''])[:2]
+        if token == 'valid':
+            lines.append('    if data[%d] in invalid_status: return False' % index)
+        elif kind == 'text':
+            lines += ['    if data[%d] is not None:' % index,
+                      "        msg['%s'] = data[%d]" % (name, index)]
+        elif name != '-':
+            value = {'': 'v',
+                     'knots': 'v*speed_units.get(data[%d], 1)' % (index+1),
+                     'lr': "-v if data[%d] == 'L' else v" % (index+1),
+                     'ew': "-v if data[%d] == 'W' else v" % (index+1),
+                     'minute': 'v/60.0'}[kind]
+            lines.append('    v = data[%d]' % index)
+            if name in required:
+                lines += ['    if type(v) != float: return False',
+                          "    msg['%s'] = %s" % (name, value)]
+            else:
+                lines += ['    if type(v) == float:',
+                          "        msg['%s'] = %s" % (name, value)]
+        index += 2 if kind in paired_kinds else 1
+
+    lines.append('    return post(talker, msg) if post else msg')
+    return '\n'.join(lines) + '\n'
+
+def make_parser(sentence, fields, required=[], post=None):
+    for name in required:
+        if not name in [token.split(':')[0] for token in fields.split()]:
+            raise ValueError('required field %s not in %s fields' % (name, sentence))
+
+    source = parser_source(sentence, fields, required)
+    namespace = {'invalid_status': invalid_status, 'speed_units': speed_units, 'post': post}
+    exec(compile(source, '<nmea %s>' % sentence, 'exec'), namespace)
+    parser = namespace['parse_' + sentence]
+    parser.source = source
+    return parser
+
+# output templates are converted once to a % format and the value names
+class Formatter(object):
+    def __init__(self, sentence, template):
+        self.sentence = sentence
+        field = re.compile(r'\{([\w.]+):([^}]*)\}')
+        self.names = [name for name, format in field.findall(template)]
+        self.format = 'AP' + sentence + ',' + field.sub(lambda m : '%' + m.group(2), template)
+
+    # returns False if a value is not registered or not valid
+    def __call__(self, values):
+        args = []
+        for name in self.names:
+            if not name in values:
+                return False
+            value = values[name].value
+            if type(value) == bool:
+                return False
+            args.append(value)
+        return self.format % tuple(args)
+
+# sentence type -> sensor name, parser
+nmea_parsers = {}
+
+# sentence type -> formatter, default rate in hz, sensor name or False
+# sentences of a sensor are only sent if its source is better than tcp
+nmea_outputs = {}
+
+def register_sentence(sentence, sensor, fields, required=[], post=None):
+    nmea_parsers[sentence] = sensor, make_parser(sentence, fields, required, post)
+
+def register_output(sentence, template, rate, sensor=False):
+    nmea_outputs[sentence] = Formatter(sentence, template), rate, sensor
+
+def limit_xte(talker, msg):
+    if 'xte' in msg:
+        msg['xte'] = min(max(msg['xte'], -.15), .15) # maximum 0.15 miles
+    return msg
+
+def apb_post(talker, msg):
+    msg['mode'] = 'compass' if msg.get('mode') == 'M' else 'gps'
+    msg['**'] = talker == 'GP'
+    return limit_xte(talker, msg)
+
+def rmb_post(talker, msg):
+    msg['mode'] = 'gps' # bearing to destination is true
+    return limit_xte(talker, msg)
+
+def rsa_post(talker, msg):
+    if not 'angle' in msg:
+        msg['angle'] = False # no rudder angle
+    return msg
+
+def hdg_post(talker, msg):
+    magnetic = msg['magnetic'] + msg.pop('deviation', 0)
+    msg['magnetic'] = magnetic % 360
+    if 'variation' in msg:
+        msg['true'] = (magnetic + msg.pop('variation')) % 360
+    return msg
+
+# $--RMC,hhmmss.ss,A,llll.ll,a,yyyyy.yy,a,x.x,x.x,xxxx,x.x,a*hh
+#        time,status,lat,N/S,lon,E/W,speed knots,track true,date,variation,E/W
+register_sentence('RMC', 'gps', 'timestamp valid - - - - speed track',
+                  ['timestamp', 'speed', 'track'])
+
+# $--VTG,x.x,T,x.x,M,x.x,N,x.x,K,a*hh
+#        track true,T,track magnetic,M,speed knots,N,speed km/h,K,mode
+# course and speed over ground
+register_sentence('VTG', 'gps', 'track - - - speed:knots - - valid', ['track', 'speed'])
+
+# $--MWV,x.x,a,x.x,a,a*hh
+#        wind angle,R/T,wind speed,K/M/N,status
+register_sentence('MWV', 'wind', 'direction - speed:knots valid', ['direction'])
+
+# $--VWR,x.x,a,x.x,N,x.x,M,x.x,K*hh
+#        wind angle,L/R of bow,speed knots,N,speed m/s,M,speed km/h,K
+register_sentence('VWR', 'wind', 'direction:lr speed:knots', ['direction'])
+
+# $--MWD,x.x,T,x.x,M,x.x,N,x.x,M*hh
+#        true wind direction,T,magnetic direction,M,speed knots,N,speed m/s,M
+register_sentence('MWD', 'truewind', 'direction - - - speed:knots', ['direction'])
+
+# $--RSA,x.x,A,x.x,A*hh
+#        starboard rudder angle,status,port rudder angle,status
+register_sentence('RSA', 'rudder', 'angle', [], rsa_post)
+
+# $--VHW,x.x,T,x.x,M,x.x,N,x.x,K*hh
+#        heading true,T,heading magnetic,M,speed knots,N,speed km/h,K
+# speed through water
+register_sentence('VHW', 'water', '- - - - speed:knots', ['speed'])
+
+# $--HDG,x.x,x.x,a,x.x,a*hh
+#        magnetic sensor heading,deviation,E/W,variation,E/W
+register_sentence('HDG', 'heading', 'magnetic deviation:ew variation:ew', ['magnetic'], hdg_post)
+
+# $--HDT,x.x,T*hh
+register_sentence('HDT', 'heading', 'true', ['true'])
+
+# $--ROT,x.x,A*hh
+#        rate of turn degrees per minute, negative to port,status
+register_sentence('ROT', 'rot', 'rate:minute valid', ['rate'])
+
+# $--APB,A,A,x.x,a,N,A,A,x.x,a,c--c,x.x,a,x.x,a*hh
+#        status,status,xte,L/R to steer,N,arrival status,perpendicular status,
+#        bearing origin to destination,M/T,destination id,
+#        bearing position to destination,M/T,heading to steer,M/T
+register_sentence('APB', 'apb', '- - xte:lr - - - - - - - - track mode:text',
+                  ['xte', 'track'], apb_post)
+
+# $--RMB,A,x.x,a,c--c,c--c,llll.ll,a,yyyyy.yy,a,x.x,x.x,x.x,A*hh
+#        status,xte,L/R to steer,origin id,destination id,lat,N/S,lon,E/W,
+#        range,bearing true to destination,closing velocity,arrival status
+register_sentence('RMB', 'apb', 'valid xte:lr - - - - - - - track', ['xte', 'track'], rmb_post)
+
+# $--XTE,A,A,x.x,a,N,a*hh
+#        status,status,xte,L/R to steer,N,mode
+# steers to the last track received
+register_sentence('XTE', 'apb', 'valid valid xte:lr - valid', ['xte'], limit_xte)
+
+# one XDR with both transducers since sockets keep the latest sentence of each type
+register_output('XDR', 'A,{imu.pitch:.3f},D,PTCH,A,{imu.roll:.3f},D,ROLL', 2)
+register_output('HDM', '{imu.heading_lowpass:.3f},M', 2)
+register_output('MWV', '{wind.direction:.3f},R,{wind.speed:.3f},N,A', 5, 'wind')
+register_output('RSA', '{rudder.angle:.3f},A,,', 5, 'rudder')
+
+if __name__ == '__main__':
+    import sys, time
+    for sentence in sorted(nmea_parsers):
+        print(nmea_parsers[sentence][1].source)
+
+    # python sentences.py '$IIVHW,,T,,M,6.1,N,11.3,K*55'
+    for line in sys.argv[1:]:
+        fields = line.split('*')[0].split(',')
+        data = []
+        for field in fields[1:]:
+            try:
+                data.append(float(field))
+            except ValueError:
+                data.append(field if field else None)
+        sensor, parser = nmea_parsers[fields[0][3:]]
+        print(sensor, parser(fields[0][1:3], data))
+
+    data = [12.5, 'L', 5.5, 'N', 2.8, 'M', 10.2, 'K']
+    count = 100000
+    t0 = time.time()
+    for i in range(count):
+        nmea_parsers['VWR'][1]('II', data)
+    print('VWR %.2f us per parse' % (1e6*(time.time() - t0)/count))
@@ -526,6 +526,14 @@ class Servo(object):
                            self.gain.value)
 
     def poll(self):
+        if not self.driver:
+            import simulator # imports this module
+            if simulator.enabled:
+                self.driver = self.device = simulator.SimulatedServo()
+                self.controller.set('simulator')
+                self.send_driver_params()
+                self.lastpolltime = time.time()
+
         if not self.driver:
             device_path = serialprobe.probe('servo', [38400], 1)
             if device_path:
@@ -0,0 +1,223 @@
+#!/usr/bin/env python
+#
+#   Copyright (C) 2019 Sean D'Epagnier
+#
+# This Program is free software; you can redistribute it and/or
+# modify it under the terms of the GNU General Public
+# License as published by the Free Software Foundation; either
+# version 3 of the License, or (at your option) any later version.
+
+# simulated boat and servo so the autopilot runs without hardware
+#
+# enabled by autopilot.py --simulate or PYPILOT_SIMULATE=1 in the
+# environment.  The imu process then uses this module in place of
+# RTIMU, producing getIMUData frames from a model of the boat yawing
+# in waves, and the servo uses SimulatedServo in place of ArduinoServo,
+# moving a rudder at a limited rate with a motor current model.
+#
+# the rudder angle is shared from the servo in the autopilot process
+# to the boat in the imu process, so the whole process tree runs
+# closed loop in real time and can be benchmarked with ap.timing.*
+
+from __future__ import print_function
+import os, time, math, random, multiprocessing
+import quaternion
+from servo import ServoFlags, ServoTelemetry
+
+enabled = os.getenv('PYPILOT_SIMULATE', '0') not in ('', '0')
+
+# created before the imu process forks
+rudder = multiprocessing.RawValue('d', 0)
+
+# yaw follows the rudder with time constant tau at yaw_gain degrees
+# per second per degree of rudder per knot, positive rudder turns to
+# port.  Waves are a sum of sinusoids in yaw acceleration, roll and
+# pitch, and gusts a random yaw acceleration that decays in 10 seconds
+class BoatModel(object):
+    def __init__(self, speed=5.0, yaw_gain=.1, tau=2.0, waves=1.0, seed=None):
+        self.random = random.Random(seed)
+        self.speed = speed
+        self.yaw_gain = yaw_gain
+        self.tau = tau
+        self.waves = waves
+
+        self.t = 0
+        self.heading = self.random.uniform(0, 360)
+        self.rate = self.accel = self.gust = 0
+        self.roll = self.pitch = self.rollrate = self.pitchrate = 0
+
+        def component():
+            return self.random.uniform(.5, 1.5), self.random.uniform(4, 9), self.random.uniform(0, 2*math.pi)
+        self.yaw_waves = [component() for i in range(4)]
+        self.roll_wave = component()
+        self.pitch_wave = component()
+        self.compass_field = [25, 0, 40] # microtesla
+        self.residuals = [0, 0, 0]
+
+    def step(self, dt, rudder):
+        self.t += dt
+        w = lambda period : 2*math.pi/period
+        wave = sum([a*math.sin(w(p)*self.t + phase) for a, p, phase in self.yaw_waves])
+        self.gust += -self.gust*dt/10 + self.random.gauss(0, 2)*math.sqrt(dt)
+
+        self.accel = (-self.yaw_gain*self.speed*rudder - self.rate)/self.tau + self.waves*(wave + self.gust)
+        self.rate += self.accel*dt
+        self.heading = (self.heading + self.rate*dt) % 360
+
+        a, p, phase = self.roll_wave
+        self.roll = 8*self.waves*a*math.sin(w(p)*self.t + phase)
+        self.rollrate = 8*self.waves*a*w(p)*math.cos(w(p)*self.t + phase)
+        a, p, phase = self.pitch_wave
+        self.pitch = 3*self.waves*a*math.sin(w(p)*self.t + phase)
+        self.pitchrate = 3*self.waves*a*w(p)*math.cos(w(p)*self.t + phase)
+
+    # what RTIMU.getIMUData returns, in radians and g
+    def data(self):
+        roll, pitch, heading = map(math.radians, (self.roll, self.pitch, self.heading))
+        q = quaternion.multiply(quaternion.angvec2quat(heading, [0, 0, 1]),
+                                quaternion.multiply(quaternion.angvec2quat(pitch, [0, 1, 0]),
+                                                    quaternion.angvec2quat(roll, [1, 0, 0])))
+        q = quaternion.normalize(q)
+        iq = quaternion.conjugate(q)
+
+        noise = lambda v, s : tuple(map(lambda x : x + self.random.gauss(0, s), v))
+        rates = list(map(math.radians, (self.rollrate, self.pitchrate, self.rate)))
+        gyro = noise(quaternion.rotvecquat(rates, iq), .002)
+        accel = noise(quaternion.rotvecquat([0, 0, 1], iq), .01)
+        compass = noise(quaternion.rotvecquat(self.compass_field, iq), .3)
+        self.residuals = list(noise([0, 0, 0], .01))
+        return {'timestamp': int(time.time()*1e6),
+                'fusionPoseValid': True, 'fusionPose': (roll, pitch, heading),
+                'fusionQPoseValid': True, 'fusionQPose': tuple(q),
+                'gyroValid': True, 'gyro': gyro,
+                'accelValid': True, 'accel': accel,
+                'compassValid': True, 'compass': compass}
+
+# stands in for RTIMU.Settings, imu_process sets the attributes
+class Settings(object):
+    def __init__(self, filename):
+        self.filename = filename
+
+# stands in for RTIMU.RTIMU, new samples are ready at the sample rate
+class RTIMU(object):
+    def __init__(self, settings):
+        self.rate = getattr(settings, 'MPU925xGyroAccelSampleRate', 100)
+        self.boat = BoatModel()
+        self.time = time.time()
+
+    def IMUName(self):
+        return 'Simulated IMU'
+
+    def IMUInit(self):
+        self.time = time.time()
+        return True
+
+    def IMUGetPollInterval(self):
+        return 1000 // self.rate
+
+    def setSlerpPower(self, power):
+        pass
+
+    def setGyroEnable(self, enable):
+        pass
+
+    def setAccelEnable(self, enable):
+        pass
+
+    def setCompassEnable(self, enable):
+        pass
+
+    def IMURead(self):
+        t = time.time()
+        if t < self.time:
+            return False
+        if t - self.time > 1: # fell behind, skip ahead
+            self.time = t
+        dt = 1.0/self.rate
+        self.time += dt
+        self.boat.step(dt, rudder.value)
+        return True
+
+    def getIMUData(self):
+        return self.boat.data()
+
+    def getAccelResiduals(self):
+        return self.boat.residuals
+
+# stands in for ArduinoServo (and its device).  The motor moves the
+# rudder slew degrees per second at full command to the stops at
+# stop degrees.  Current rises with rudder load and stalls at the
+# stops, faulting above the raw max current from params.
+class SimulatedServo(object):
+    def __init__(self, slew=6.0, stop=40.0, current=2.0, stall_current=12.0):
+        self.path = 'simulator'
+        self.slew = slew
+        self.stop = stop
+        self.full_current = current
+        self.stall_current = stall_current
+
+        self.speed = 0
+        self.angle = 0
+        self.voltage = 12.6
+        self.current = 0
+        self.controller_temp = self.motor_temp = 25
+        self.rudder = 0 # raw, as calibrated by rudder offset and scale
+        self.flags = ServoFlags.SYNC
+
+        self.raw_max_current = 7
+        self.rudder_offset, self.rudder_scale = 0, 100
+        self.time = self.temp_time = time.time()
+
+    def params(self, raw_max_current, rudder_min, rudder_max, max_current, max_controller_temp,
+               max_motor_temp, rudder_range, rudder_offset, rudder_scale, *args):
+        self.raw_max_current = raw_max_current
+        self.rudder_offset, self.rudder_scale = rudder_offset, rudder_scale
+
+    def command(self, speed):
+        self.speed = min(max(speed, -1), 1)
+        self.flags |= ServoFlags.ENGAGED
+
+    def disengage(self):
+        self.speed = 0
+        self.flags &= ~ServoFlags.ENGAGED
+
+    def reset(self):
+        self.flags &= ~ServoFlags.OVERCURRENT_FAULT
+
+    def fault(self):
+        return bool(self.flags & ServoFlags.OVERCURRENT_FAULT)
+
+    def close(self):
+        pass
+
+    def poll(self):
+        t = time.time()
+        dt = min(t - self.time, 1)
+        self.time = t
+
+        speed = 0 if self.fault() else self.speed
+        angle = self.angle + speed*self.slew*dt
+        self.angle = min(max(angle, -self.stop), self.stop)
+        if speed and angle != self.angle:
+            self.current = self.stall_current
+        elif speed:
+            self.current = abs(speed)*self.full_current*(1 + abs(self.angle)/self.stop)
+        else:
+            self.current = 0
+        if self.current > self.raw_max_current:
+            self.flags |= ServoFlags.OVERCURRENT_FAULT
+        self.voltage = 12.6 - .1*self.current
+
+        rudder.value = self.angle
+        if self.rudder_scale:
+            self.rudder = (self.angle - self.rudder_offset) / self.rudder_scale
+
+        result = ServoTelemetry.FLAGS | ServoTelemetry.CURRENT | ServoTelemetry.VOLTAGE | ServoTelemetry.RUDDER
+        if t - self.temp_time > 1:
+            # heats with current squared, cools toward 25C in 5 minutes
+            d = (t - self.temp_time)/300
+            self.controller_temp += d*(25 + .5*self.current**2 - self.controller_temp)
+            self.motor_temp += d*(25 + 2*self.current**2 - self.motor_temp)
+            self.temp_time = t
+            result |= ServoTelemetry.CONTROLLER_TEMP | ServoTelemetry.MOTOR_TEMP
+        return result
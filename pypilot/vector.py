@@ -8,6 +8,13 @@
 # version 3 of the License, or (at your option) any later version.  
 
 import math
+try:
+    import numpy
+except ImportError:
+    numpy = False # only needed by the _many functions
+
+# the _many functions take arrays of vectors (N, 3) and broadcast
+# against single vectors, returning numpy arrays
 
 def norm(v):
     return math.sqrt(v[0]**2 + v[1]**2 + v[2]**2)
@@ -43,3 +50,27 @@ def dist(a, b):
 
 def dist2(a, b):
     return (a[0] - b[0])**2 + (a[1] - b[1])**2 + (a[2] - b[2])**2
+
+def norm_many(v):
+    return numpy.sqrt(numpy.sum(numpy.square(v), axis=-1))
+
+def normalize_many(v):
+    v = numpy.asarray(v, dtype=float)
+    n = norm_many(v)
+    n = numpy.where(n == 0, 1, n)
+    return v / n[..., None]
+
+def cross_many(a, b):
+    a, b = numpy.asarray(a, dtype=float), numpy.asarray(b, dtype=float)
+    return numpy.stack((a[..., 1]*b[..., 2] - a[..., 2]*b[..., 1],
+                        a[..., 2]*b[..., 0] - a[..., 0]*b[..., 2],
+                        a[..., 0]*b[..., 1] - a[..., 1]*b[..., 0]), axis=-1)
+
+def dot_many(a, b):
+    return numpy.sum(numpy.multiply(a, b), axis=-1)
+
+def dist_many(a, b):
+    return norm_many(numpy.subtract(a, b))
+
+def dist2_many(a, b):
+    return numpy.sum(numpy.square(numpy.subtract(a, b)), axis=-1)
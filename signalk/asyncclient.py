@@ -0,0 +1,299 @@
+#!/usr/bin/env python
+#
+#   Copyright (C) 2019 Sean D'Epagnier
+#
+# This Program is free software; you can redistribute it and/or
+# modify it under the terms of the GNU General Public
+# License as published by the Free Software Foundation; either
+# version 3 of the License, or (at your option) any later version.
+
+# asyncio signalk client, requires python 3
+#
+#   client = AsyncSignalKClient('pypilot')
+#   await client.connect()
+#   heading = await client.get('ap.heading')
+#   client.set('ap.heading_command', heading + 10)
+#   async for value in client.watch('ap.heading', period=.5):
+#       print(value)
+#
+# requests are queued and written together once per loop iteration,
+# gets issued in the same iteration go to the server as one request
+# for a list of names, and only the last of several sets is sent.
+# Watches are kept here and sent again after reconnecting, as are
+# gets still waiting for a value.
+
+import os, sys, re, asyncio
+from signalk import kjson
+
+DEFAULT_PORT = 21311
+
+def default_host():
+    try:
+        file = open(os.getenv('HOME') + '/.pypilot/signalk.conf')
+        host = kjson.loads(file.readline())['host']
+        file.close()
+        return host
+    except Exception:
+        return '127.0.0.1'
+
+# async iterator of the values of one name, only the latest
+# queue_size values are kept if the consumer falls behind
+class Watch(object):
+    def __init__(self, client, name, period, queue_size):
+        self.client = client
+        self.name = name
+        self.period = period
+        self.queue = asyncio.Queue(queue_size)
+
+    def put(self, value):
+        if self.queue.full():
+            self.queue.get_nowait() # drop oldest
+        self.queue.put_nowait(value)
+
+    def __aiter__(self):
+        return self
+
+    async def __anext__(self):
+        if not self.client:
+            raise StopAsyncIteration
+        value = await self.queue.get()
+        if value is StopAsyncIteration:
+            raise StopAsyncIteration
+        return value
+
+    def close(self):
+        if self.client:
+            self.client.unwatch(self)
+            self.client = False
+            self.put(StopAsyncIteration)
+
+class AsyncSignalKClient(object):
+    def __init__(self, host=False, port=False, reconnect_delay=3):
+        if not host:
+            host = default_host()
+        if ':' in host:
+            host, port = host.split(':')
+        self.host = host
+        self.port = int(port) if port else DEFAULT_PORT
+        self.reconnect_delay = reconnect_delay
+
+        self.reader = self.writer = False
+        self.connected = asyncio.Event()
+        self.task = False
+        self.requests = []
+        self.sets = {} # name -> latest value to set
+        self.flush_pending = False
+        self.gets = {} # name -> futures waiting for a value
+        self.get_names = [] # to request in the next flush
+        self.lists = [] # futures waiting for a list of values
+        self.watches = {} # name -> [Watch]
+        self.periods = {} # name -> period requested from the server
+        self.values = {} # latest value of each name received
+
+    async def connect(self):
+        self.reader, self.writer = await asyncio.open_connection(self.host, self.port)
+        self.connected.set()
+        if not self.task:
+            self.task = asyncio.ensure_future(self.run())
+
+        # subscribe again after reconnecting, only sets are kept
+        self.requests = []
+        self.periods = {}
+        for name in self.watches:
+            self.send_watch(name) # also gets the current value
+        for name in self.gets:
+            if not name in self.get_names:
+                self.get_names.append(name)
+        if self.lists:
+            self.send({'method': 'list'})
+        self.schedule_flush()
+
+    async def close(self):
+        if self.task:
+            self.task.cancel()
+            self.task = False
+        if self.writer:
+            self.writer.close()
+        self.connected.clear()
+        for futures in list(self.gets.values()) + [self.lists]:
+            for future in futures:
+                if not future.done():
+                    future.cancel()
+        for watches in list(self.watches.values()):
+            for watch in list(watches):
+                watch.close()
+
+    def send(self, request):
+        self.requests.append(kjson.dumps(request) + '\n')
+        self.schedule_flush()
+
+    def schedule_flush(self):
+        if not self.flush_pending:
+            self.flush_pending = True
+            asyncio.get_event_loop().call_soon(self.flush)
+
+    # write everything requested since the last flush at once
+    def flush(self):
+        self.flush_pending = False
+        if not self.connected.is_set():
+            return # sent again once connected
+        for name, value in self.sets.items():
+            self.requests.append(kjson.dumps({'method': 'set', 'name': name, 'value': value}) + '\n')
+        self.sets = {}
+        if self.get_names: # after sets so a get sees them
+            names = self.get_names
+            self.requests.append(kjson.dumps({'method': 'get', 'name': names if len(names) > 1 else names[0]}) + '\n')
+            self.get_names = []
+        if self.requests:
+            self.writer.write(''.join(self.requests).encode())
+            self.requests = []
+
+    async def get(self, name, timeout=10):
+        future = asyncio.get_event_loop().create_future()
+        if not name in self.gets:
+            self.gets[name] = []
+            self.get_names.append(name)
+            self.schedule_flush()
+        self.gets[name].append(future)
+        try:
+            return await asyncio.wait_for(future, timeout)
+        finally:
+            if name in self.gets and future in self.gets[name]:
+                self.gets[name].remove(future)
+                if not self.gets[name]:
+                    del self.gets[name]
+
+    # returns {name: type info} for every value on the server
+    async def list_values(self, timeout=10):
+        future = asyncio.get_event_loop().create_future()
+        self.lists.append(future)
+        self.send({'method': 'list'})
+        try:
+            return await asyncio.wait_for(future, timeout)
+        finally:
+            if future in self.lists:
+                self.lists.remove(future)
+
+    # only the last value set to a name before the next flush is sent
+    def set(self, name, value):
+        self.sets[name] = value
+        self.schedule_flush()
+
+    # with a period the server sends the latest value at most once per period
+    def watch(self, name, period=0, queue_size=1):
+        watch = Watch(self, name, period, queue_size)
+        if not name in self.watches:
+            self.watches[name] = []
+        self.watches[name].append(watch)
+        # a watched name is kept current, otherwise send_watch gets it
+        if name in self.periods and name in self.values:
+            watch.put(self.values[name])
+        self.send_watch(name)
+        return watch
+
+    def unwatch(self, watch):
+        watches = self.watches[watch.name]
+        watches.remove(watch)
+        if watches:
+            self.send_watch(watch.name)
+        else:
+            del self.watches[watch.name]
+            self.periods.pop(watch.name, None)
+            self.send({'method': 'watch', 'name': watch.name, 'value': False})
+
+    # the fastest watcher decides the period
+    def send_watch(self, name):
+        period = min([watch.period for watch in self.watches[name]])
+        if self.periods.get(name) == period and self.connected.is_set():
+            return
+        if not name in self.periods and not name in self.get_names:
+            self.get_names.append(name) # the current value
+        self.periods[name] = period
+        request = {'method': 'watch', 'name': name, 'value': True}
+        if period:
+            request['period'] = period
+        self.send(request)
+
+    def receive(self, name, msg):
+        if 'type' in msg and not 'value' in msg:
+            return False # part of a list response
+        value = msg['value']
+        self.values[name] = value
+        for future in self.gets.pop(name, []):
+            if not future.done():
+                future.set_result(value)
+        for watch in self.watches.get(name, []):
+            watch.put(value)
+        return True
+
+    def handle_line(self, line):
+        try:
+            msg = kjson.loads(line)
+        except ValueError:
+            # error message such as: invalid request: get unknown value: name
+            if 'unknown value: ' in line:
+                name = line.split('unknown value: ', 1)[1].strip()
+                for future in self.gets.pop(name, []):
+                    if not future.done():
+                        future.set_exception(KeyError(name))
+            else:
+                print('signalk server:', line.strip())
+            return
+
+        listing = {}
+        for name in msg:
+            if not self.receive(name, msg[name]):
+                listing[name] = msg[name]
+        if listing and self.lists:
+            future = self.lists.pop(0)
+            if not future.done():
+                future.set_result(listing)
+
+    async def run(self):
+        while True:
+            try:
+                line = await self.reader.readline()
+            except (ConnectionError, OSError):
+                line = b''
+            if line:
+                self.handle_line(line.decode())
+                continue
+
+            # disconnected, wait without blocking other tasks
+            self.connected.clear()
+            self.writer.close()
+            while True:
+                print('Disconnected.  Reconnecting in %d...' % self.reconnect_delay)
+                await asyncio.sleep(self.reconnect_delay)
+                try:
+                    await self.connect()
+                    print('Connected.')
+                    break
+                except (ConnectionError, OSError):
+                    continue
+
+# python -m signalk.asyncclient [host:port or address] NAME...
+# prints each value and then every change
+async def watch_values(host, names):
+    client = AsyncSignalKClient(host)
+    await client.connect()
+    async def print_changes(name):
+        async for value in client.watch(name):
+            print(name, '=', value)
+    await asyncio.gather(*map(print_changes, names))
+
+def main():
+    args = sys.argv[1:]
+    host = False
+    if args and (':' in args[0] or re.match(r'^\d+\.\d+\.\d+\.\d+$', args[0])):
+        host = args.pop(0)
+    if not args:
+        print('usage: python -m signalk.asyncclient [host:port or address] NAME...')
+        exit(1)
+    try:
+        asyncio.run(watch_values(host, args))
+    except KeyboardInterrupt:
+        pass
+
+if __name__ == '__main__':
+    main()
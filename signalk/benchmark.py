@@ -0,0 +1,245 @@
+#!/usr/bin/env python
+#
+#   Copyright (C) 2019 Sean D'Epagnier
+#
+# This Program is free software; you can redistribute it and/or
+# modify it under the terms of the GNU General Public
+# License as published by the Free Software Foundation; either
+# version 3 of the License, or (at your option) any later version.
+
+# end to end benchmark of the signalk server
+#
+# a SignalKPipeServer is started with N values which are set to the
+# current time at a given rate, and M SignalKClient processes watch
+# all of them.  Each client also sets its own ping value and waits
+# for it to come back through its watch, the same path a set from a
+# control client takes: client -> server process -> pipe -> autopilot
+# process -> pipe -> server process -> client
+#
+# measured:
+#   update     latency from set in the autopilot process to a client
+#   roundtrip  latency of the client ping set back to its watch
+#   messages per second received by all clients
+#   cpu of the server process and of the autopilot process
+#   pipe backlog in bytes (both directions) and sets waiting to send
+#
+# python -m signalk.benchmark [-n values] [-m clients] [-r rate] [-t seconds]
+#                             [-p period] [-c codec] [-o report.json]
+
+from __future__ import print_function
+import os, sys, time, getopt, json, select, socket, platform
+import fcntl, termios, multiprocessing
+from signalk.pipeserver import SignalKPipeServer
+from signalk.client import SignalKClient
+from signalk.values import *
+
+BENCHMARK_PORT = 21312 # not to disturb a running server
+ping_interval = .05
+
+def percentiles(samples):
+    samples = sorted(samples)
+    if not samples:
+        return {'count': 0}
+    def p(x):
+        return samples[min(int(x*len(samples)), len(samples)-1)]
+    return {'count': len(samples), 'mean': sum(samples)/len(samples),
+            'p50': p(.5), 'p90': p(.9), 'p99': p(.99), 'max': samples[-1]}
+
+# user and system cpu seconds of a process
+def process_cpu(pid):
+    try:
+        f = open('/proc/%d/stat' % pid)
+        fields = f.read().rsplit(')', 1)[1].split()
+        f.close()
+    except Exception:
+        return 0
+    return (int(fields[11]) + int(fields[12])) / float(os.sysconf('SC_CLK_TCK'))
+
+# bytes waiting to be read from and sent through a pipe end
+def pipe_backlog(pipe):
+    fd = pipe.fileno()
+    def ioctl(request):
+        try:
+            buf = fcntl.ioctl(fd, request, b'\0\0\0\0')
+            return int.from_bytes(buf, sys.byteorder)
+        except Exception:
+            return 0
+    return ioctl(termios.FIONREAD), ioctl(termios.TIOCOUTQ)
+
+def client_process(index, names, port, period, start, end, results):
+    ping = 'bench.ping%d' % index
+    def on_connected(client):
+        for name in names:
+            client.watch(name, True, period)
+        client.watch(ping)
+
+    time.sleep(max(start - 1.5 - time.time(), 0)) # until the server listens
+    client = False
+    while not client:
+        try:
+            client = SignalKClient(on_connected, 'localhost', port)
+        except Exception:
+            if time.time() > start:
+                results.put({'error': 'client %d failed to connect' % index})
+                return
+            time.sleep(.1)
+
+    updates, roundtrips = [], []
+    messages = 0
+    ping_time = 0
+    while time.time() < start:
+        client.receive(.1) # discard initial values
+
+    t = time.time()
+    while t < end:
+        if not ping_time and t - start > ping_interval*len(roundtrips):
+            ping_time = time.time()
+            client.set(ping, ping_time)
+        msgs = client.receive(.01)
+        t = time.time()
+        for name, msg in msgs.items():
+            messages += 1
+            value = msg['value']
+            if name == ping:
+                if abs(value - ping_time) < 1e-4:
+                    roundtrips.append(t - value)
+                    ping_time = 0
+            elif value:
+                updates.append(t - value)
+    results.put({'updates': updates, 'roundtrips': roundtrips, 'messages': messages})
+
+def benchmark(count=20, clients=4, rate=10, duration=10, period=0, codec=False, port=BENCHMARK_PORT):
+    server = SignalKPipeServer(port, False, codec)
+    values = [server.Register(Value('bench.value%d' % i, 0)) for i in range(count)]
+    for i in range(clients):
+        server.Register(Property('bench.ping%d' % i, 0))
+
+    # the server process listens after 2 seconds, leave time to connect
+    start = time.time() + 4
+    end = start + duration
+    results = multiprocessing.Queue()
+    names = [value.name for value in values]
+    processes = []
+    for i in range(clients):
+        process = multiprocessing.Process(target=client_process,
+                                          args=(i, names, port, period, start, end, results))
+        process.start()
+        processes.append(process)
+
+    poller = select.poll()
+    poller.register(server.pipe.fileno(), select.POLLIN)
+    backlog_in, backlog_out, pending = [], [], []
+    cpu = False
+    t = next_update = time.time()
+    while t < end:
+        if t >= next_update:
+            for value in values:
+                value.set(time.time())
+            next_update += 1.0/rate
+            if next_update < t: # fell behind
+                next_update = t
+        if not cpu and t >= start:
+            cpu = time.time(), process_cpu(server.process.pid), sum(os.times()[:2])
+        server.HandleRequests()
+        if t >= start:
+            i, o = pipe_backlog(server.pipe)
+            backlog_in.append(i)
+            backlog_out.append(o)
+            pending.append(len(server.sets))
+        poller.poll(1000.0*max(next_update - time.time(), 0))
+        t = time.time()
+
+    elapsed = time.time() - cpu[0]
+    server_cpu = process_cpu(server.process.pid) - cpu[1]
+    autopilot_cpu = sum(os.times()[:2]) - cpu[2]
+
+    updates, roundtrips, messages, errors = [], [], 0, []
+    for process in processes:
+        result = results.get(timeout=10)
+        if 'error' in result:
+            errors.append(result['error'])
+            continue
+        updates += result['updates']
+        roundtrips += result['roundtrips']
+        messages += result['messages']
+    for process in processes:
+        process.join()
+    server.process.terminate()
+    server.process.join()
+
+    mean = lambda l : float(sum(l))/len(l) if l else 0
+    return {'parameters': {'values': count, 'clients': clients, 'rate': rate,
+                           'duration': duration, 'period': period, 'codec': codec or 'pickle'},
+            'system': {'python': platform.python_version(), 'machine': platform.machine(),
+                       'host': socket.gethostname(), 'time': time.time()},
+            'update': percentiles(updates),
+            'roundtrip': percentiles(roundtrips),
+            'messages_per_second': messages / elapsed,
+            'expected_per_second': float(count*clients*rate) if not period else
+                                   count*clients*min(rate, 1.0/period),
+            'cpu': {'server': 100*server_cpu/elapsed, 'autopilot': 100*autopilot_cpu/elapsed},
+            'backlog': {'pipe_in_max': max(backlog_in or [0]), 'pipe_in_mean': mean(backlog_in),
+                        'pipe_out_max': max(backlog_out or [0]), 'pipe_out_mean': mean(backlog_out),
+                        'sets_max': max(pending or [0]), 'sets_mean': mean(pending)},
+            'errors': errors}
+
+def print_report(report):
+    p = report['parameters']
+    print('%d values at %gHz, %d clients, %g seconds, codec %s' %
+          (p['values'], p['rate'], p['clients'], p['duration'], p['codec']))
+    for name in ['update', 'roundtrip']:
+        l = report[name]
+        if not l['count']:
+            print('%-10s no samples' % name)
+            continue
+        print('%-10s %6d samples  ms: mean %7.2f  p50 %7.2f  p90 %7.2f  p99 %7.2f  max %7.2f' %
+              (name, l['count'], 1e3*l['mean'], 1e3*l['p50'], 1e3*l['p90'], 1e3*l['p99'], 1e3*l['max']))
+    print('messages %.0f/s (%.0f/s value updates expected)' % (report['messages_per_second'], report['expected_per_second']))
+    print('cpu server %.1f%% autopilot %.1f%%' % (report['cpu']['server'], report['cpu']['autopilot']))
+    b = report['backlog']
+    print('pipe backlog bytes in max %d mean %.0f, out max %d mean %.0f, sets waiting max %d' %
+          (b['pipe_in_max'], b['pipe_in_mean'], b['pipe_out_max'], b['pipe_out_mean'], b['sets_max']))
+    for error in report['errors']:
+        print(error)
+
+def main():
+    try:
+        opts, args = getopt.getopt(sys.argv[1:], 'n:m:r:t:p:c:o:h', ['help'])
+    except getopt.GetoptError as e:
+        print(e)
+        opts = [('-h', '')]
+
+    kwargs = {}
+    output = False
+    for o, a in opts:
+        if o in ['-h', '--help']:
+            print('usage: python -m signalk.benchmark [-n values] [-m clients] [-r rate] [-t seconds]')
+            print('                                   [-p period] [-c codec] [-o report.json]')
+            print('-p  watch period of the clients, default every change')
+            print('-c  pipe codec: binary or pickle')
+            print('-o  write the report as json to a file')
+            exit(0)
+        elif o == '-n':
+            kwargs['count'] = int(a)
+        elif o == '-m':
+            kwargs['clients'] = int(a)
+        elif o == '-r':
+            kwargs['rate'] = float(a)
+        elif o == '-t':
+            kwargs['duration'] = float(a)
+        elif o == '-p':
+            kwargs['period'] = float(a)
+        elif o == '-c':
+            kwargs['codec'] = False if a == 'pickle' else a
+        elif o == '-o':
+            output = a
+
+    report = benchmark(**kwargs)
+    print_report(report)
+    if output:
+        f = open(output, 'w')
+        f.write(json.dumps(report, indent=2, sort_keys=True) + '\n')
+        f.close()
+
+if __name__ == '__main__':
+    main()
@@ -8,8 +8,19 @@
 # version 3 of the License, or (at your option) any later version.  
 
 from __future__ import print_function
-import time, select
+import time, socket, errno, collections, itertools
 from signalk.linebuffer import linebuffer
+from signalk import tracing
+
+# outbound data is a queue of encoded chunks sent together with
+# sendmsg, so a partial send only advances a memoryview of the first
+# chunk rather than copying what is left.  The server keeps value
+# updates in its ClientWatch while out_size is above backlog_size,
+# newer values replacing stale ones, so the queue only grows past it
+# with other replies.  Beyond max_out_size the client is hopeless.
+backlog_size = 16384
+max_out_size = 262144
+max_chunks = 64 # per sendmsg call
 
 #class LineBufferedNonBlockingSocket(linebuffer.LineBuffer):
 class LineBufferedNonBlockingSocket(object):
@@ -21,9 +32,9 @@ class LineBufferedNonBlockingSocket(object):
         self.b = linebuffer.LineBuffer(connection.fileno())
 
         self.socket = connection
-        self.out_buffer = ''
-        self.pollout = select.poll()
-        self.pollout.register(connection, select.POLLOUT)
+        self.out_buffer = collections.deque()
+        self.out_size = 0
+        self.sendmsg = getattr(connection, 'sendmsg', False)
         self.sendfail_msg = 1
         self.sendfail_cnt = 0
 
@@ -34,37 +45,57 @@ class LineBufferedNonBlockingSocket(object):
         return self.b.line()
 
     def send(self, data):
-        self.out_buffer += data
-        if len(self.out_buffer) > 65536:
-            print('overflow in signalk socket')
-            self.socket.close()
+        if not isinstance(data, bytes):
+            data = data.encode()
+        self.out_buffer.append(data)
+        self.out_size += len(data)
+        if self.out_size > max_out_size:
+            print('overflow in signalk socket', self.out_size)
+            self.close()
+
+    def backlogged(self):
+        return self.out_size > backlog_size
+
+    def close(self):
+        self.out_buffer.clear()
+        self.out_size = 0
+        self.socket.close()
     
     def flush(self):
         if not self.out_buffer:
             return
         try:
-            if not self.pollout.poll(0):
+            t0 = tracing.start()
+            if self.sendmsg:
+                count = self.sendmsg(itertools.islice(self.out_buffer, max_chunks))
+            else:
+                count = self.socket.send(self.out_buffer[0])
+            tracing.end('socket.send', t0)
+        except socket.error as e:
+            if e.errno in [errno.EAGAIN, errno.EWOULDBLOCK]:
+                # kernel buffer full, wait for POLLOUT
                 if self.sendfail_cnt >= self.sendfail_msg:
-                    print('signalk socket failed to send', self.sendfail_cnt)
+                    print('signalk socket failed to send', self.sendfail_cnt, self.out_size)
                     self.sendfail_msg *= 10
                 self.sendfail_cnt += 1
-
-                if self.sendfail_cnt > 100:
-                    self.socket.close()
                 return
-            t0 = time.time()
-            count = self.socket.send(self.out_buffer.encode())
-            t1 = time.time()
-
-            if t1-t0 > .1:
-                print('socket send took too long!?!?', t1-t0)
-            if count < 0:
-                print('socket send error', count)
-                self.socket.close()
-            self.out_buffer = self.out_buffer[count:]
+            print('signalk socket exception', e)
+            self.close()
+            return
         except Exception as e:
             print('signalk socket exception', e)
-            self.socket.close()
+            self.close()
+            return
+
+        self.out_size -= count
+        while count:
+            chunk = self.out_buffer[0]
+            l = len(chunk)
+            if count < l:
+                self.out_buffer[0] = memoryview(chunk)[count:]
+                break
+            self.out_buffer.popleft()
+            count -= l
 
 class LineBufferedNonBlockingSocketPython(object):
     def __init__(self, connection):
@@ -169,20 +169,19 @@ class SignalKClient(object):
 
         self.onconnected(connection)
 
+    # the server combines all values sent in one flush into one line
     def receive(self, timeout = 0):
-        ret = {}
-        msg = self.receive_single(timeout)
-        while msg:
-            name, value = msg
-            ret[name] = value
-            msg = self.receive_single(-1)
+        ret = dict(self.msg_queue)
+        self.msg_queue = []
+        line = self.receive_line(-1 if ret else timeout)
+        while line:
+            ret.update(self.flatten_line(line))
+            line = self.receive_line(-1)
         return ret
 
     def receive_single(self, timeout = 0):
-        if len(self.msg_queue) > 0:
-            msg = self.msg_queue[0]
-            self.msg_queue = self.msg_queue[1:]
-            return msg
+        if self.msg_queue:
+            return self.msg_queue.pop(0)
         
         line = self.receive_line(timeout)
         if line:
@@ -214,6 +213,7 @@ class SignalKClient(object):
                 print(e)
         return False
 
+    # name may be a list of names
     def get(self, name):
         request = {'method' : 'get', 'name' : name}
         self.send(request)
@@ -228,9 +228,12 @@ class SignalKClient(object):
         request = '{"method": "set", "name": "' + name + '", "value": ' + str(value) + '}\n'
         self.socket.send(request)
 
-    def watch(self, name, value=True):
+    # with a period the server sends the latest value at most once per period
+    def watch(self, name, value=True, period=0):
         self.get(name)
         request = {'method' : 'watch', 'name' : name, 'value' : value}
+        if period:
+            request['period'] = period
         self.send(request)
 
     def print_values(self, timeout, info=False):
@@ -290,12 +293,11 @@ def SignalKClientFromArgs(argv, watch, f_con=False):
                 watches = watches[1:]
 
     def on_con(client):
-        for arg in watches:
+        if watches:
             if watch:
-                #print('watch', arg)
-                client.watch(arg)
+                client.watch(watches)
             else:
-                client.get(arg)
+                client.get(watches)
         if f_con:
             f_con(client)
             
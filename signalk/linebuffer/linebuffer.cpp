@@ -20,6 +20,7 @@ LineBuffer::LineBuffer(int _fd)
     : fd(_fd)
 {
     pos = len = b = 0;
+    nfields = 0;
 }
 
 const char *LineBuffer::line()
@@ -105,6 +106,30 @@ bool LineBuffer::readline_buf_nmea()
     return false;
 }
 
+// split the line last returned by readline_nmea in place, the
+// first field is the talker and sentence type, followed by each
+// comma separated field up to the checksum
+int LineBuffer::split_nmea()
+{
+    char *p = buf[!b];
+    nfields = 0;
+    if(*p != '$')
+        return 0;
+    fields[nfields++] = ++p;
+    for(; *p; p++) {
+        if(*p == ',') {
+            *p = 0;
+            if(nfields == MAX_NMEA_FIELDS)
+                break;
+            fields[nfields++] = p+1;
+        } else if(*p == '*') {
+            *p = 0;
+            break;
+        }
+    }
+    return nfields;
+}
+
 /* return length if a line is in buf[!b] */
 int LineBuffer::readline_buf()
 {
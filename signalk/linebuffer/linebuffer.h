@@ -15,6 +15,12 @@ public:
     bool recv();
 
     const char *readline_nmea();
+
+    // fields of the last nmea line, after split_nmea
+    enum {MAX_NMEA_FIELDS = 40};
+    int split_nmea();
+    char *fields[MAX_NMEA_FIELDS];
+    int nfields;
 private:
     bool next_nmea();
 #if 0    
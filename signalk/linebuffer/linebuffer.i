@@ -3,6 +3,42 @@
 
 %{
 #include "linebuffer.h"
+
+#if PY_MAJOR_VERSION >= 3
+#define PyNmeaString_FromStringAndSize PyUnicode_FromStringAndSize
+#else
+#define PyNmeaString_FromStringAndSize PyString_FromStringAndSize
+#endif
+
+// nmea numbers are plain decimals, dividing all their digits as an
+// integer by a power of ten rounds exactly like strtod does
+static bool nmea_decimal(const char *p, double &d)
+{
+    static const double pow10[] = {1, 1e1, 1e2, 1e3, 1e4, 1e5, 1e6, 1e7, 1e8,
+                                   1e9, 1e10, 1e11, 1e12, 1e13, 1e14, 1e15};
+    bool negative = *p == '-';
+    if(negative || *p == '+')
+        p++;
+    long long m = 0;
+    int digits = 0, decimals = -1;
+    for(; *p; p++) {
+        if(*p >= '0' && *p <= '9') {
+            m = m*10 + (*p - '0');
+            digits++;
+            if(decimals >= 0)
+                decimals++;
+        } else if(*p == '.' && decimals < 0)
+            decimals = 0;
+        else
+            return false;
+    }
+    if(!digits || digits > 15)
+        return false;
+    d = decimals > 0 ? m / pow10[decimals] : m;
+    if(negative)
+        d = -d;
+    return true;
+}
 %}
 
 class LineBuffer {
@@ -14,3 +50,40 @@ public:
     bool recv();
     const char *readline_nmea();
 };
+
+// (talker, sentence type, fields) of the line last returned by
+// readline_nmea, numeric fields are converted to float and empty
+// fields are None, so python only looks up the sentence type
+%extend LineBuffer {
+    PyObject *nmea_fields() {
+        if(!$self->split_nmea())
+            Py_RETURN_NONE;
+
+        const char *header = $self->fields[0];
+        int hlen = strlen(header);
+        int tlen = hlen > 2 ? 2 : hlen;
+        PyObject *fields = PyList_New($self->nfields-1);
+        for(int i=1; i<$self->nfields; i++) {
+            const char *field = $self->fields[i];
+            PyObject *value;
+            double d;
+            char *end;
+            if(!*field) {
+                Py_INCREF(Py_None);
+                value = Py_None;
+            } else if(nmea_decimal(field, d))
+                value = PyFloat_FromDouble(d);
+            else if(!field[strspn(field, "0123456789+-.eE")] &&
+                    (d = strtod(field, &end), !*end)) // exponents and long numbers
+                value = PyFloat_FromDouble(d);
+            else
+                value = PyNmeaString_FromStringAndSize(field, strlen(field));
+            PyList_SET_ITEM(fields, i-1, value);
+        }
+        PyObject *result = PyTuple_New(3);
+        PyTuple_SET_ITEM(result, 0, PyNmeaString_FromStringAndSize(header, tlen));
+        PyTuple_SET_ITEM(result, 1, PyNmeaString_FromStringAndSize(header + tlen, hlen - tlen));
+        PyTuple_SET_ITEM(result, 2, fields);
+        return result;
+    }
+}
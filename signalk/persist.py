@@ -0,0 +1,163 @@
+#!/usr/bin/env python
+#
+#   Copyright (C) 2019 Sean D'Epagnier
+#
+# This Program is free software; you can redistribute it and/or
+# modify it under the terms of the GNU General Public
+# License as published by the Free Software Foundation; either
+# version 3 of the License, or (at your option) any later version.
+
+# persistent values are kept in pypilot.conf as one json object, and
+# each change since is a line {"name": value} appended to pypilot.conf.log
+#
+# a persistent value marks itself dirty in the store when it changes,
+# so nothing is scanned.  The server appends dirty values to the log
+# every store_period, and once the log grows past compact_size the whole
+# table is written to a temporary file and renamed over pypilot.conf,
+# then the log is emptied.  Writes are fsynced in a background thread
+# so a stalled sd card never holds up the server.
+#
+# the conf file is only ever replaced whole, and a partly written last
+# line of the log is ignored, so a power cut loses at most the changes
+# of the last store_period.  Replaying the log over a newer conf
+# (power cut between rename and emptying the log) gives the same values.
+
+from __future__ import print_function
+import os, time, threading
+from signalk import kjson
+
+try:
+    import queue
+except ImportError:
+    import Queue as queue # python 2
+
+store_period = 5 # seconds between appending changes
+compact_size = 65536 # bytes of log before rewriting the conf file
+
+def read_json(filename):
+    f = open(filename)
+    data = kjson.loads(f.read())
+    f.close()
+    return data
+
+# returns the stored values and the size of the log, the server
+# records failures to load in ~/.pypilot/persist_fail
+def load(path, server=False):
+    try:
+        data = read_json(path)
+    except Exception as e:
+        try:
+            data = read_json(path + '.bak') # written by older versions
+            print('failed to load', path, e, 'loaded backup')
+        except Exception:
+            data = {} # everything may be in the log
+            if not os.path.exists(path + '.log'):
+                print('failed to load', path, e)
+                print('WARNING Alignment and other data lost!!!!!!!!!')
+                if server:
+                    try:
+                        file = open(os.path.join(os.path.dirname(path), 'persist_fail'), 'a')
+                        file.write(str(time.time()) + ' ' + str(e) + '\n')
+                        file.close()
+                    except IOError:
+                        pass
+
+    size = 0
+    try:
+        f = open(path + '.log')
+        for line in f:
+            size += len(line)
+            try:
+                data.update(kjson.loads(line))
+            except Exception:
+                print('ignoring invalid line in', path + '.log')
+        f.close()
+    except IOError:
+        pass # no changes since the conf was written
+    return data, size
+
+def fsync_dir(path):
+    try:
+        fd = os.open(os.path.dirname(os.path.abspath(path)), os.O_RDONLY)
+        os.fsync(fd)
+        os.close(fd)
+    except OSError:
+        pass # not supported on this filesystem
+
+class PersistentStore(object):
+    def __init__(self, path):
+        self.path = path
+        self.data, self.log_size = load(path, True)
+        self.values = {}
+        self.dirty = set()
+
+        self.queue = queue.Queue()
+        self.thread = threading.Thread(target=self.writer)
+        self.thread.daemon = True
+        self.thread.start()
+        if self.log_size: # start from a clean log
+            self.compact()
+
+    # value.store is set so that each change marks it dirty
+    def Register(self, value):
+        self.values[value.name] = value
+        value.store = self
+        if not value.name in self.data:
+            self.dirty.add(value.name) # store the default
+
+    def changed(self, value):
+        self.dirty.add(value.name)
+
+    def store(self):
+        lines = []
+        for name in self.dirty:
+            value = self.values[name].value
+            if not name in self.data or self.data[name] != value:
+                self.data[name] = value
+                lines.append(kjson.dumps({name: value}) + '\n')
+        self.dirty = set()
+        if not lines:
+            return
+
+        data = ''.join(lines)
+        self.log_size += len(data)
+        if self.log_size > compact_size:
+            self.compact()
+        else:
+            self.queue.put(('append', data))
+
+    def compact(self):
+        lines = [kjson.dumps({name: self.data[name]})[1:-1] for name in sorted(self.data)]
+        self.queue.put(('compact', '{' + ',\n'.join(lines) + '}\n'))
+        self.log_size = 0
+
+    # store anything dirty and wait for it to be written
+    def close(self):
+        self.store()
+        self.queue.put(False)
+        self.thread.join()
+
+    def writer(self):
+        while True:
+            item = self.queue.get()
+            if not item:
+                break
+            kind, data = item
+            try:
+                if kind == 'append':
+                    self.write(self.path + '.log', data, 'a')
+                else:
+                    tmp = self.path + '.tmp'
+                    self.write(tmp, data, 'w')
+                    os.rename(tmp, self.path)
+                    fsync_dir(self.path)
+                    self.write(self.path + '.log', '', 'w')
+            except Exception as e:
+                print('failed to write', self.path, e)
+
+    def write(self, filename, data, mode):
+        f = open(filename, mode)
+        f.write(data)
+        f.flush()
+        os.fsync(f.fileno())
+        f.close()
@@ -11,15 +11,19 @@
 # offload socket and parsing work to a separate process
 
 from __future__ import print_function
-import time
+import time, signal
 from signalk.server import SignalKServer, DEFAULT_PORT, default_persistent_path, LoadPersistentData
 from signalk.values import *
+from signalk import pipecodec
+from signalk.sharedvalues import SharedValueTable
+from signalk import tracing
 import multiprocessing
 import select
 
 class NonBlockingPipeEnd(object):
-    def __init__(self, pipe, name, recvfailok):
+    def __init__(self, pipe, name, recvfailok, codec=False):
         self.pipe = pipe
+        self.codec = pipecodec.codecs[codec]() if codec else False
         self.pollin = select.poll()
         self.pollin.register(self.pipe, select.POLLIN)
         self.pollout = select.poll()
@@ -34,6 +38,8 @@ class NonBlockingPipeEnd(object):
         
     def recv(self, timeout=0):
         if self.pollin.poll(1000.0*timeout):
+            if self.codec:
+                return self.codec.decode(self.pipe.recv_bytes())
             return self.pipe.recv()
         if not self.recvfailok:
             print('error pipe block on recv!', self.name)
@@ -41,7 +47,10 @@ class NonBlockingPipeEnd(object):
 
     def send(self, value, block=True):
         if block or self.pollout.poll(0):
-            self.pipe.send(value)
+            if self.codec:
+                self.pipe.send_bytes(self.codec.encode(value))
+            else:
+                self.pipe.send(value)
             return True
         
         self.sendfailcount += 1
@@ -51,16 +60,25 @@ class NonBlockingPipeEnd(object):
         return False
 
 
-def NonBlockingPipe(name, recvfailok=False):
+# codec is False to send pickled objects, or a name from pipecodec.codecs
+def NonBlockingPipe(name, recvfailok=False, codec=False):
   pipe = multiprocessing.Pipe()
-  return NonBlockingPipeEnd(pipe[0], name+'[0]', recvfailok), NonBlockingPipeEnd(pipe[1], name+'[1]', recvfailok)
+  return NonBlockingPipeEnd(pipe[0], name+'[0]', recvfailok, codec), NonBlockingPipeEnd(pipe[1], name+'[1]', recvfailok, codec)
 
 class SignalKPipeServerClient(SignalKServer):
-    def __init__(self, pipe, port, persistent_path):
+    def __init__(self, pipe, port, persistent_path, shared=False):
       super(SignalKPipeServerClient, self).__init__(port, persistent_path)
       self.watches = {}
       self.gets = {}
       self.pipe = pipe
+      # wake up as soon as the autopilot process sends anything
+      self.AddPollFd(pipe.fileno(), self.HandlePipeMessages)
+
+      self.shared = shared
+      self.shared_slots = {} # name -> slot for values in shared memory
+      self.shared_seqs = {} # name -> sequence last sent to watchers
+      if shared:
+        self.AddPollFd(shared.wake_read, self.HandleSharedValues)
 
     def __del__(self):
       while self.HandlePipeMessage():
@@ -68,12 +86,15 @@ class SignalKPipeServerClient(SignalKServer):
       super(SignalKPipeServerClient, self).__del__()
 
     def Register(self, value):
-      super(SignalKPipeServerClient, self).Register(value)
-      self.gets[value.name] = []
       try:
         value.timestamp = self.TimeStamp(value.timestamp)
       except:
         pass
+      super(SignalKPipeServerClient, self).Register(value)
+      self.gets[value.name] = []
+      if value.watchers and not value.name in self.watches: # recorded
+        self.watches[value.name] = True
+        self.pipe.send({'method': 'watch', 'name': value.name, 'value': True})
       return value
     
     def RemoveSocket(self, socket):
@@ -89,8 +110,10 @@ class SignalKPipeServerClient(SignalKServer):
         value = self.values[name]
 
         if method == 'get':
-          if name in self.watches: # already have recent value in this process
-            socket.send(value.get_signalk() + '\n')
+          if name in self.shared_slots and self.ReadSharedValue(name):
+            self.GetClientWatch(socket).send(value.get_signalk_line())
+          elif name in self.watches: # already have recent value in this process
+            self.GetClientWatch(socket).send(value.get_signalk_line())
           else:
             self.gets[name].append(socket)
             self.pipe.send(data)
@@ -120,6 +143,8 @@ class SignalKPipeServerClient(SignalKServer):
             value = msgs[name]
             if name == '_register':
                 self.Register(value)
+            elif name == '_shared':
+                self.shared_slots[value[0]] = value[1]
             elif name in self.timestamps:
                 self.TimeStamp(name, value)
             else:
@@ -134,15 +159,47 @@ class SignalKPipeServerClient(SignalKServer):
 
           # send to any clients who requested this value (get request)
           if self.gets[name]:
-              response = self.values[name].get_signalk() + '\n'
+              response = self.values[name].get_signalk_line()
               for socket in self.gets[name]:
-                  socket.send(response)
+                  if socket in self.sockets: # may have disconnected
+                      self.GetClientWatch(socket).send(response)
               self.gets[name] = []
         return True
 
-def pipe_server_process(pipe, port, persistent_path):
+    def HandlePipeMessages(self):
+        t0 = tracing.start()
+        while self.HandlePipeMessage():
+            pass
+        tracing.end('server.pipe', t0)
+
+    # update value from shared memory, returns the sequence number
+    def ReadSharedValue(self, name):
+        data = self.shared.read(self.shared_slots[name])
+        if not data:
+            return False # not valid in shared memory, pipe is used
+        seq, v, t = data
+        value = self.values[name]
+        value.value = v
+        self.TimeStamp(value.timestamp[1], t)
+        return seq
+
+    def HandleSharedValues(self):
+        self.shared.clear_wake()
+        for name in self.shared_slots:
+            value = self.values[name]
+            if not value.watchers:
+                continue
+            seq = self.shared.sequence(self.shared_slots[name])
+            if seq != self.shared_seqs.get(name):
+                seq = self.ReadSharedValue(name)
+                if seq:
+                    self.shared_seqs[name] = seq
+                    value.send()
+
+def pipe_server_process(pipe, port, persistent_path, shared):
     #print('pipe server on', os.getpid())
-    server = SignalKPipeServerClient(pipe, port, persistent_path)
+    tracing.init('server')
+    server = SignalKPipeServerClient(pipe, port, persistent_path, shared)
     # handle only pipe messages (to get all registrations) for first second
     t0 = time.time()
     while time.time() - t0 < 2:
@@ -150,29 +207,57 @@ def pipe_server_process(pipe, port, persistent_path):
         pass
       time.sleep(.1)
 
-    while True:
-        while server.HandlePipeMessage():
-            pass
-        server.HandleRequests()
-        time.sleep(.1)
+    # block until the pipe or any socket is ready rather than polling,
+    # the timeout only bounds the wait between persistent stores
+    trace_time = time.time()
+    try:
+      while True:
+        server.HandleRequests(1)
+        if not server.init: # not listening yet, still drain the pipe
+            server.HandlePipeMessages()
+
+        if tracing.tracer and time.time() - trace_time > 1:
+            pipe.send({'method': 'set', 'name': 'trace.server', 'value': tracing.summary()})
+            trace_time = time.time()
+    finally:
+      # the autopilot signals again while cleaning up, finish writing first
+      while True:
+        try:
+          signal.signal(signal.SIGINT, signal.SIG_IGN)
+          signal.signal(signal.SIGTERM, signal.SIG_IGN)
+          break
+        except KeyboardInterrupt:
+          pass
+      if server.recorder: # write what is left of the last block
+        server.recorder.close()
+      if server.persistent_store: # wait for changes to be written
+        server.persistent_store.close()
 
 
 class SignalKPipeServer(object):
-    def __init__(self, port=DEFAULT_PORT, persistent_path=default_persistent_path):
-        self.pipe, process_pipe = NonBlockingPipe('signalkpipeserver', True)
+    def __init__(self, port=DEFAULT_PORT, persistent_path=default_persistent_path, codec=False, shared=False):
+        # codec 'binary' packs values natively instead of pickling, see pipecodec.py
+        self.pipe, process_pipe = NonBlockingPipe('signalkpipeserver', True, codec)
+
+        # with shared, numeric sensor values are read by the server
+        # process from shared memory rather than sent down the pipe
+        self.shared = SharedValueTable() if shared else False
+        self.shared_changed = False
     
         self.values = {}
         self.sets = {}
         self.timestamps = {}
         self.last_recv = time.time()
 
-        self.persistent_data = LoadPersistentData(persistent_path, False)
+        self.persistent_data = LoadPersistentData(persistent_path, False) if persistent_path else {}
         self.ResetPersistentState()
         
-        self.process = multiprocessing.Process(target=pipe_server_process, args=(process_pipe, port, persistent_path))
+        self.process = multiprocessing.Process(target=pipe_server_process, args=(process_pipe, port, persistent_path, self.shared))
         self.process.start()
           
     def __del__(self):
+      if not self.process.is_alive():
+          return # already stopped
       # ensure persistent values get sent to server process
       self.SetPersistentValues()
       self.pipe.send(self.sets, False)
@@ -199,12 +284,26 @@ class SignalKPipeServer(object):
         if value.persistent and value.name in self.persistent_data:
             value.set(self.persistent_data[value.name])
       
-        self.pipe.send({'_register': value})
+        if self.pipe.codec:
+            self.pipe.codec.assign(value.name)
+
+        msg = {'_register': value}
+        slot = False
+        if self.shared and isinstance(value, SensorValue) and \
+           value.timestamp in self.timestamps and not value.persistent:
+            slot = self.shared.allocate()
+            if slot is not False:
+                msg['_shared'] = [value.name, slot]
+        self.pipe.send(msg)
         self.values[value.name] = value
 
         def make_send():
             def send():
-              if value.watchers:
+              if slot is not False and \
+                 self.shared.write(slot, value.value, self.timestamps[value.timestamp]):
+                if value.watchers:
+                  self.shared_changed = True
+              elif value.watchers:
                 self.queue_send(value)
               elif value.persistent:
                 self.persistent_sets[value.name] = True
@@ -219,6 +318,8 @@ class SignalKPipeServer(object):
     def HandleRequest(self, request):
       method = request['method']
       name = request['name']
+      if not name in self.values:
+        return # such as trace.server when TraceValues is not registered
 
       if method == 'get':
         self.queue_send(self.values[name])
@@ -233,6 +334,10 @@ class SignalKPipeServer(object):
         if t0 >= self.persistent_timeout:
             self.SetPersistentValues()
 
+        if self.shared_changed:
+            self.shared.wake()
+            self.shared_changed = False
+
         if self.sets:
             ta = time.time()
             # should we break up sets if there are many!?!
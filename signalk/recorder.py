@@ -0,0 +1,335 @@
+#!/usr/bin/env python
+#
+#   Copyright (C) 2019 Sean D'Epagnier
+#
+# This Program is free software; you can redistribute it and/or
+# modify it under the terms of the GNU General Public
+# License as published by the Free Software Foundation; either
+# version 3 of the License, or (at your option) any later version.
+
+# record every change of signalk values in the server process
+#
+# set PYPILOT_RECORD=1 in the environment to record all values, or to
+# a comma separated list of name prefixes such as imu.,ap.heading
+# Files are written to ~/.pypilot/record/ and rotated by size.
+#
+# the recorder watches each value like a client would, so the
+# autopilot process sends it every change.  Changes are kept in
+# memory and written every block_period as one compressed block:
+#
+#   block:  'PREC' codec:u8 compressed_len:u32
+#   data:   header_len:u32 header (json) columns...
+#
+# the header lists the columns of each value: its name, kind, sample
+# count, vector length and TimeStamp group.  Columns are
+#   time       int64 microseconds, delta encoded
+#   timestamp  float64 (only for values with a TimeStamp group)
+#   value      float64 (kind 'f') or json lines (kind 'j')
+# float64 columns are xor delta encoded and byte shuffled so they
+# compress well.  False in a numeric column is stored as nan.
+#
+# python -m signalk.recorder [FILE]... summarizes recordings
+
+from __future__ import print_function
+import os, sys, time, struct, json, zlib
+from signalk import kjson
+from signalk import tracing
+
+try:
+    import numpy
+except ImportError:
+    numpy = False
+    print('recorder requires numpy')
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = False # zlib is used instead
+
+CODEC_ZLIB, CODEC_ZSTD = 0, 1
+frame = struct.Struct('<4sBI')
+u32 = struct.Struct('<I')
+
+default_record_path = os.getenv('HOME') + '/.pypilot/record/'
+block_period = 10 # seconds between writes
+max_block_samples = 50000
+max_file_size = 8*1024*1024
+max_total_size = 256*1024*1024
+
+def encode_times(times):
+    us = numpy.round(numpy.array(times)*1e6).astype(numpy.int64)
+    return numpy.diff(us, prepend=0).tobytes()
+
+def decode_times(data):
+    return numpy.cumsum(numpy.frombuffer(data, dtype=numpy.int64)) / 1e6
+
+# xor each float with the previous and group the bytes by significance
+def encode_floats(a):
+    u = numpy.ascontiguousarray(a, dtype=numpy.float64).view(numpy.uint64)
+    x = u.copy()
+    x[1:] ^= u[:-1]
+    return x.view(numpy.uint8).reshape(-1, 8).T.tobytes()
+
+def decode_floats(data, shape):
+    x = numpy.frombuffer(data, dtype=numpy.uint8).reshape(8, -1).T.copy()
+    x = x.view(numpy.uint64).reshape(shape)
+    return numpy.bitwise_xor.accumulate(x, axis=0).view(numpy.float64)
+
+def is_number(x):
+    t = type(x)
+    return t == float or t == int
+
+# vector length if every value is numeric (or False) with the same
+# shape, 0 for scalars, otherwise None
+def numeric_length(values):
+    length = None
+    for value in values:
+        if value is False:
+            continue
+        if type(value) == list:
+            l = len(value)
+            if not l or not all(map(is_number, value)):
+                return None
+        elif is_number(value):
+            l = 0
+        else:
+            return None
+        if length is None:
+            length = l
+        elif length != l:
+            return None
+    return length
+
+class Column(object):
+    def __init__(self, value):
+        self.value = value
+        self.times = []
+        self.stamps = []
+        self.values = []
+
+    # the TimeStamp group, which is [t, name] in the server
+    def group(self):
+        timestamp = self.value.timestamp
+        return timestamp[1] if type(timestamp) == list and timestamp[1] else None
+
+    def append(self, t):
+        value = self.value
+        self.times.append(t)
+        if self.group():
+            self.stamps.append(value.timestamp[0] or 0)
+        self.values.append(value.value)
+
+    def encode(self):
+        value = self.value
+        count = len(self.times)
+        info = {'name': value.name, 'count': count, 'timestamp': self.group()}
+        data = [encode_times(self.times)]
+        if info['timestamp']:
+            data.append(encode_floats(self.stamps))
+
+        length = numeric_length(self.values)
+        if length is None:
+            info['kind'] = 'j'
+            data.append('\n'.join(map(kjson.dumps, self.values)).encode())
+        else:
+            info['kind'] = 'f'
+            info['length'] = length
+            nan = [float('nan')]*length if length else float('nan')
+            data.append(encode_floats([nan if v is False else v for v in self.values]))
+
+        info['sizes'] = list(map(len, data))
+        self.times, self.stamps, self.values = [], [], []
+        return info, b''.join(data)
+
+# takes the place of a socket in value.watchers
+class RecordWatch(object):
+    def __init__(self, recorder, value):
+        self.socket = recorder
+        self.column = Column(value)
+        self.recorder = recorder
+
+    def send(self, line):
+        self.column.append(time.time())
+        self.recorder.samples += 1
+
+class Recorder(object):
+    def __init__(self, prefixes=False, path=default_record_path):
+        self.prefixes = prefixes # record only names starting with these
+        self.path = path
+        self.watches = []
+        self.samples = 0
+        self.block_time = time.time()
+        self.file = False
+        try:
+            os.makedirs(path)
+        except OSError:
+            pass # already exists
+
+        if zstandard:
+            self.codec = CODEC_ZSTD
+            self.compressor = zstandard.ZstdCompressor(level=3)
+        else:
+            self.codec = CODEC_ZLIB
+
+    # start recording value if it matches, returns True if recording
+    def Register(self, value):
+        if self.prefixes and not any(map(value.name.startswith, self.prefixes)):
+            return False
+        watch = RecordWatch(self, value)
+        self.watches.append(watch)
+        value.watchers.append(watch)
+        watch.send(False) # initial value
+        return True
+
+    def poll(self):
+        t = time.time()
+        if self.samples >= max_block_samples or (self.samples and t - self.block_time >= block_period):
+            t0 = tracing.start()
+            self.write_block()
+            tracing.end('server.record', t0)
+            self.block_time = t
+
+    def write_block(self):
+        columns, data = [], []
+        for watch in self.watches:
+            if watch.column.times:
+                info, d = watch.column.encode()
+                columns.append(info)
+                data.append(d)
+        self.samples = 0
+        if not columns:
+            return
+
+        header = json.dumps({'columns': columns}).encode()
+        raw = u32.pack(len(header)) + header + b''.join(data)
+        if self.codec == CODEC_ZSTD:
+            compressed = self.compressor.compress(raw)
+        else:
+            compressed = zlib.compress(raw, 6)
+
+        try:
+            self.rotate(len(compressed))
+            self.file.write(frame.pack(b'PREC', self.codec, len(compressed)) + compressed)
+            self.file.flush()
+        except Exception as e:
+            print('failed to write recording', e)
+            self.file = False
+
+    # start a new file when the current one is full, and remove
+    # the oldest recordings to stay within max_total_size
+    def rotate(self, size):
+        if self.file and self.file.tell() + size <= max_file_size:
+            return
+        if self.file:
+            self.file.close()
+
+        files = recordings(self.path)
+        total = sum(map(os.path.getsize, files))
+        while files and total + max_file_size > max_total_size:
+            total -= os.path.getsize(files[0])
+            os.remove(files.pop(0))
+
+        name = time.strftime('pypilot-%Y%m%d-%H%M%S', time.localtime())
+        self.file = open(os.path.join(self.path, name + '.rec'), 'ab')
+
+    def close(self):
+        self.write_block()
+        if self.file:
+            self.file.close()
+            self.file = False
+
+def init():
+    prefixes = os.getenv('PYPILOT_RECORD')
+    if not prefixes or not numpy:
+        return False
+    if prefixes == '1':
+        return Recorder()
+    return Recorder(prefixes.split(','))
+
+def recordings(path=default_record_path):
+    try:
+        names = sorted(os.listdir(path))
+    except OSError:
+        return []
+    return [os.path.join(path, name) for name in names if name.endswith('.rec')]
+
+def read_blocks(filename):
+    f = open(filename, 'rb')
+    while True:
+        head = f.read(frame.size)
+        if len(head) < frame.size:
+            break
+        magic, codec, size = frame.unpack(head)
+        data = f.read(size)
+        if magic != b'PREC' or len(data) < size:
+            print('corrupt recording', filename)
+            break
+        if codec == CODEC_ZSTD:
+            if not zstandard:
+                print('zstandard needed to read', filename)
+                break
+            data = zstandard.ZstdDecompressor().decompress(data)
+        else:
+            data = zlib.decompress(data)
+        l = u32.unpack_from(data)[0]
+        yield json.loads(data[u32.size:u32.size+l].decode()), data, u32.size + l
+    f.close()
+
+# returns {name: {'time': array, 'value': array or list, 'timestamp': array}}
+# for the given recordings (default all) and names (default all)
+def read(filenames=False, names=False):
+    if not filenames:
+        filenames = recordings()
+    parts = {}
+    for filename in filenames:
+        for header, data, pos in read_blocks(filename):
+            for info in header['columns']:
+                sizes = info['sizes']
+                start = pos
+                pos += sum(sizes)
+                name = info['name']
+                if names and not name in names:
+                    continue
+                count = info['count']
+                d = data[start:start+sizes[0]]
+                start += sizes[0]
+                part = {'time': decode_times(d)}
+                if info['timestamp']:
+                    part['timestamp'] = decode_floats(data[start:start+sizes[1]], (count,))
+                    start += sizes[1]
+                d = data[start:pos]
+                if info['kind'] == 'f':
+                    shape = (count, info['length']) if info['length'] else (count,)
+                    part['value'] = decode_floats(d, shape)
+                else:
+                    part['value'] = list(map(kjson.loads, d.decode().split('\n')))
+                parts.setdefault(name, []).append(part)
+
+    ret = {}
+    for name, name_parts in parts.items():
+        ret[name] = {}
+        for key in name_parts[0]:
+            if key == 'value' and type(name_parts[0][key]) == list:
+                ret[name][key] = sum([part[key] for part in name_parts], [])
+            else:
+                try:
+                    ret[name][key] = numpy.concatenate([part[key] for part in name_parts])
+                except ValueError: # vector length changed between blocks
+                    ret[name][key] = sum([list(part[key]) for part in name_parts], [])
+    return ret
+
+def main():
+    filenames = sys.argv[1:]
+    data = read(filenames)
+    size = sum(map(os.path.getsize, filenames or recordings()))
+    samples = 0
+    for name in sorted(data):
+        d = data[name]
+        samples += len(d['time'])
+        print('%-40s %8d samples  %s' % (name, len(d['time']),
+              time.strftime('%Y-%m-%d %H:%M:%S', time.localtime(d['time'][0]))))
+    if samples:
+        print('%d samples in %d bytes, %.1f bytes per sample' % (samples, size, float(size)/samples))
+
+if __name__ == '__main__':
+    main()
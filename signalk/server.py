@@ -13,42 +13,47 @@ import signalk.kjson
 import fcntl, os
 from signalk.values import *
 from signalk.bufferedsocket import LineBufferedNonBlockingSocket
+from signalk import tracing
+from signalk import recorder
+from signalk import persist
 
 DEFAULT_PORT = 21311
 max_connections = 20
 default_persistent_path = os.getenv('HOME') + '/.pypilot/pypilot.conf'
 
 def LoadPersistentData(persistent_path, server=True):
-    try:
-        file = open(persistent_path)
-        persistent_data = kjson.loads(file.read())
-        file.close()
-    except Exception as e:
-        print('failed to load', persistent_path, e)
-        print('WARNING Alignment and other data lost!!!!!!!!!')
-
-        if server:
-            # log failing to load persistent data
-            persist_fail = os.getenv('HOME') + '/.pypilot/persist_fail'
-            file = open(persist_fail, 'a')
-            file.write(str(time.time()) + ' ' + str(e) + '\n')
-            file.close()
-
-        try:
-            file = open(persistent_path + '.bak')
-            persistent_data = kjson.loads(file.read())
-            file.close()
-            return persistent_data
-        except Exception as e:
-            print('backup data failed as well', e)
-        return {}
-
-    if server:
-        # backup persistent_data if it loaded with success
-        file = open(persistent_path + '.bak', 'w')
-        file.write(kjson.dumps(persistent_data)+'\n')
-        file.close()
-    return persistent_data
+    return persist.load(persistent_path, server)[0]
+
+# takes the place of a socket in value.watchers, only the latest line
+# of each value is kept and all of them are sent to the client together
+# as one json object, every flush or at most once per period
+#
+# while the client socket is backlogged (a slow wifi client in a
+# burst) lines wait here, so stale values are replaced by newer ones
+# rather than queued behind them, and are sent once it drains
+class ClientWatch(object):
+    def __init__(self, socket, period):
+        self.socket = socket
+        self.period = period
+        self.time = 0 # last time sent
+        self.lines = {}
+
+    def send(self, line):
+        # line is {"name": {...}}\n, keyed by name
+        self.lines[line[2:line.index('"', 2)]] = line
+
+    def ready(self):
+        return self.lines and not self.socket.backlogged()
+
+    def flush(self, t):
+        if self.ready() and t >= self.time + self.period:
+            if len(self.lines) == 1:
+                for line in self.lines.values():
+                    self.socket.send(line)
+            else:
+                self.socket.send('{' + ', '.join([line[1:-2] for line in self.lines.values()]) + '}\n')
+            self.lines = {}
+            self.time = t
     
 class SignalKServer(object):
     def __init__(self, port=DEFAULT_PORT, persistent_path=default_persistent_path):
@@ -62,36 +67,33 @@ class SignalKServer(object):
         self.values = {}
         self.timestamps = {}
 
-        self.persistent_path = persistent_path
-        self.persistent_timeout = time.time() + 300
-        self.persistent_data = LoadPersistentData(persistent_path)
+        # every fd the server waits on: the listening socket, clients
+        # and any extra fds (such as a pipe) added with AddPollFd
+        self.poller = select.poll()
+        self.fd_to_socket = {}
+        self.fd_callbacks = {}
+        self.pollout_fds = set()
+        self.client_watches = {} # (socket, period) -> ClientWatch
+
+        # False to not load or store
+        self.persistent_store = persist.PersistentStore(persistent_path) if persistent_path else False
+        self.persistent_timeout = time.time() + persist.store_period
+        self.persistent_data = self.persistent_store.data if persistent_path else {}
+        self.recorder = recorder.init() # PYPILOT_RECORD in the environment
 
     def __del__(self):
-        self.StorePersistentValues()
+        if self.persistent_store:
+            self.persistent_store.close()
+        if self.recorder:
+            self.recorder.close()
         self.server_socket.close()
         for socket in self.sockets:
             socket.socket.close()
             
     def StorePersistentValues(self):
-        self.persistent_timeout = time.time() + 30 # 30 seconds
-        need_store = False
-        for name in self.values:
-            value = self.values[name]
-            if not value.persistent:
-                continue
-            if not name in self.persistent_data or value.value != self.persistent_data[name]:
-                self.persistent_data[name] = value.value
-                need_store = True
-
-        if not need_store:
-            return
-                
-        try:
-            file = open(self.persistent_path, 'w')
-            file.write(kjson.dumps(self.persistent_data).replace(',', ',\n')+'\n')
-            file.close()
-        except Exception as e:
-            print('failed to write', self.persistent_path, e)
+        self.persistent_timeout = time.time() + persist.store_period
+        if self.persistent_store:
+            self.persistent_store.store()
 
     def Register(self, value):
         if value.persistent and value.name in self.persistent_data:
@@ -101,11 +103,15 @@ class SignalKServer(object):
                 v = float(v) # convert any numeric to floating point
             value.set(v)
             #print('persist', value.name, ' = ', value.value)
+        if value.persistent and self.persistent_store:
+            self.persistent_store.Register(value)
 
         if value.name in self.values:
             print('warning, registering existing value:', value.name)
             
         self.values[value.name] = value
+        if self.recorder:
+            self.recorder.Register(value)
         return value
 
     def TimeStamp(self, name, t=False):
@@ -130,7 +136,7 @@ class SignalKServer(object):
         value = self.values[name]
 
         if method == 'get':
-            socket.send(value.get_signalk() + '\n')
+            self.GetClientWatch(socket).send(value.get_signalk_line())
         elif method == 'set':
             if value.client_can_set:
                 value.set(data['value'])
@@ -138,24 +144,47 @@ class SignalKServer(object):
                 socket.send('value: ' + name + ' is readonly\n')
         elif method == 'watch':
             watch = data['value'] if 'value' in data else True
-            if socket in value.watchers:
-                if not watch:
-                    value.watchers.remove(socket)
-            elif watch:
-                value.watchers.append(socket)
+            period = float(data['period']) if 'period' in data else 0
+            self.Unwatch(socket, value)
+            if watch:
+                value.watchers.append(self.GetClientWatch(socket, max(period, 0)))
         else:
             socket.send('invalid method: ' + method + ' for ' + name + '\n')
         
+    # everything sent to a client in one flush goes through a ClientWatch
+    # with period 0 so it is combined into one line
+    def GetClientWatch(self, socket, period=0):
+        key = socket, period
+        if not key in self.client_watches:
+            self.client_watches[key] = ClientWatch(socket, period)
+        return self.client_watches[key]
+
+    def Unwatch(self, socket, value):
+        for watcher in value.watchers:
+            if watcher.socket == socket:
+                value.watchers.remove(watcher)
+                break
+
     def HandleRequest(self, socket, request):
         data = kjson.loads(request)
         if data['method'] == 'list':
             self.ListValues(socket)
         else:
-            name = data['name']
-            if not name in self.values:
-                socket.send('invalid request: ' + data['method'] + ' unknown value: ' + name + '\n')
-            else:
-                self.HandleNamedRequest(socket, data)
+            # name may be a list to make the same request for many values
+            names = data['name']
+            if type(names) != type([]):
+                names = [names]
+            for name in names:
+                if not name in self.values:
+                    socket.send('invalid request: ' + data['method'] + ' unknown value: ' + str(name) + '\n')
+                else:
+                    data['name'] = name
+                    self.HandleNamedRequest(socket, dict(data))
+
+    def AddPollFd(self, fd, callback):
+        # callback is called whenever fd is readable
+        self.fd_callbacks[fd] = callback
+        self.poller.register(fd, select.POLLIN)
 
     def RemoveSocket(self, socket):
         self.sockets.remove(socket)
@@ -164,6 +193,7 @@ class SignalKServer(object):
         for fd in self.fd_to_socket:
             if socket == self.fd_to_socket[fd]:
                 del self.fd_to_socket[fd]
+                self.pollout_fds.discard(fd)
                 self.poller.unregister(fd)
                 found = True
                 break
@@ -174,14 +204,21 @@ class SignalKServer(object):
             print('socket not found in fd_to_socket')
 
         for name in self.values:
-            if socket in self.values[name].watchers:
-                self.values[name].watchers.remove(socket)
+            self.Unwatch(socket, self.values[name])
+        for key in list(self.client_watches):
+            if key[0] == socket:
+                del self.client_watches[key]
 
-    def PollSockets(self):
-        events = self.poller.poll(0)
+    def PollSockets(self, timeout=0):
+        events = self.poller.poll(1000.0*timeout)
         while events:
             event = events.pop()
             fd, flag = event
+            if fd in self.fd_callbacks:
+                self.fd_callbacks[fd]()
+                continue
+            if not fd in self.fd_to_socket:
+                continue # removed by an earlier event
             socket = self.fd_to_socket[fd]
             if socket == self.server_socket:
                 connection, address = socket.accept()
@@ -197,24 +234,50 @@ class SignalKServer(object):
                 self.poller.register(fd, select.POLLIN)
             elif flag & (select.POLLHUP | select.POLLERR | select.POLLNVAL):
                 self.RemoveSocket(socket)
-            elif flag & select.POLLIN:
-                if not socket.recv():
-                    self.RemoveSocket(socket)
-                while True:
-                    line = socket.readline()
-                    if not line:
-                        break
-                    try:
-                        self.HandleRequest(socket, line)
-                    except Exception as e:
-                        print('invalid request from socket', line, e)
-                        socket.send('invalid request: ' + line + '\n')
-
-        # flush all sockets
+            else:
+                if flag & select.POLLOUT:
+                    socket.flush()
+                if flag & select.POLLIN:
+                    if not socket.recv():
+                        self.RemoveSocket(socket)
+                    while True:
+                        line = socket.readline()
+                        if not line:
+                            break
+                        try:
+                            t0 = tracing.start()
+                            self.HandleRequest(socket, line)
+                            tracing.end('server.request', t0)
+                        except Exception as e:
+                            print('invalid request from socket', line, e)
+                            socket.send('invalid request: ' + line + '\n')
+
+        t0 = tracing.start()
+        t = time.time()
+        for watch in self.client_watches.values():
+            watch.flush(t)
+        self.FlushSockets()
+        tracing.end('server.flush', t0)
+
+    def FlushSockets(self):
+        # try to send immediately, and only wait for POLLOUT
+        # on sockets the kernel could not take all the data from
         for socket in self.sockets:
             socket.flush()
-                
-    def HandleRequests(self):
+            fd = socket.socket.fileno()
+            if fd < 0:
+                continue # closed on error, POLLNVAL will remove it
+            if socket.out_buffer:
+                if not fd in self.pollout_fds:
+                    self.poller.modify(fd, select.POLLIN | select.POLLOUT)
+                    self.pollout_fds.add(fd)
+            elif fd in self.pollout_fds:
+                self.poller.modify(fd, select.POLLIN)
+                self.pollout_fds.remove(fd)
+
+    # timeout is the maximum time in seconds to wait for a socket
+    # or other registered fd to become ready, 0 does not wait
+    def HandleRequests(self, timeout=0):
       if not self.init:
           try:
               self.server_socket.bind(('0.0.0.0', self.port))
@@ -225,19 +288,28 @@ class SignalKServer(object):
 
           self.server_socket.listen(5)
           self.init = True
-          self.fd_to_socket = {self.server_socket.fileno() : self.server_socket}
-          self.poller = select.poll()
+          self.fd_to_socket[self.server_socket.fileno()] = self.server_socket
           self.poller.register(self.server_socket, select.POLLIN)
         
       t1 = time.time()
       #print('store', t1 - self.persistent_timeout)
       if t1 >= self.persistent_timeout:
+          t0 = tracing.start()
           self.StorePersistentValues()
+          tracing.end('server.store', t0)
           if time.time() - t1 > .1:
-              print('persistent store took too long!', time.time() - t1)
               return
 
-      self.PollSockets()
+      if self.recorder:
+          self.recorder.poll()
+
+      # never sleep past the next persistent store
+      timeout = min(timeout, max(self.persistent_timeout - t1, 0))
+      # or the next client watch that has values waiting
+      for watch in self.client_watches.values():
+          if watch.ready():
+              timeout = min(timeout, max(watch.time + watch.period - t1, 0))
+      self.PollSockets(timeout)
 
 if __name__ == '__main__':
     server = SignalKServer()
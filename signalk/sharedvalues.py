@@ -0,0 +1,112 @@
+#!/usr/bin/env python
+#
+#   Copyright (C) 2019 Sean D'Epagnier
+#
+# This Program is free software; you can redistribute it and/or
+# modify it under the terms of the GNU General Public
+# License as published by the Free Software Foundation; either
+# version 3 of the License, or (at your option) any later version.
+
+# table of numeric sensor values in shared memory so the server
+# process can read them without the autopilot process sending
+# every change down the pipe
+#
+# the table is an anonymous mmap created before the server process
+# is forked.  Each slot is protected by a sequence lock: the writer
+# makes the sequence odd while it writes, and readers retry until
+# they see the same even sequence before and after reading.
+#
+# slot: seq:u64 timestamp:f64 count:i64 values[4]:f64
+# count is -1 for False, 0 for a scalar, or the vector length
+
+from __future__ import print_function
+import mmap, struct, os, fcntl, errno
+
+seq_struct = struct.Struct('<Q')
+data_struct = struct.Struct('<dq4d')
+slot_size = seq_struct.size + data_struct.size
+max_vector_len = 4
+INVALID = -2 # value did not fit, the pipe is used instead
+
+class SharedValueTable(object):
+    def __init__(self, max_values=256):
+        self.max_values = max_values
+        self.mmap = mmap.mmap(-1, slot_size * max_values)
+        self.count = 0
+        self.seqs = [0] * max_values # writer side sequence numbers
+
+        # a byte written here wakes the server process
+        self.wake_read, self.wake_write = os.pipe()
+        for fd in [self.wake_read, self.wake_write]:
+            fcntl.fcntl(fd, fcntl.F_SETFL, fcntl.fcntl(fd, fcntl.F_GETFL) | os.O_NONBLOCK)
+
+    def allocate(self):
+        if self.count == self.max_values:
+            print('shared value table full')
+            return False
+        self.count += 1
+        return self.count - 1
+
+    # returns False if value cannot be stored in the table
+    def write(self, slot, value, timestamp):
+        t = type(value)
+        if t == float or t == int:
+            count, v = 0, (value, 0, 0, 0)
+        elif value is False:
+            count, v = -1, (0, 0, 0, 0)
+        elif (t == list or t == tuple) and 0 < len(value) <= max_vector_len:
+            count, v = len(value), tuple(value) + (0,)*(max_vector_len - len(value))
+        else:
+            count, v = INVALID, (0, 0, 0, 0)
+
+        offset = slot * slot_size
+        seq = self.seqs[slot]
+        seq_struct.pack_into(self.mmap, offset, seq + 1)
+        try:
+            data_struct.pack_into(self.mmap, offset + seq_struct.size, timestamp or 0, count, *v)
+        except struct.error:
+            count = INVALID
+            data_struct.pack_into(self.mmap, offset + seq_struct.size, 0, count, 0, 0, 0, 0)
+        self.seqs[slot] = seq + 2
+        seq_struct.pack_into(self.mmap, offset, seq + 2)
+        return count != INVALID
+
+    def sequence(self, slot):
+        return seq_struct.unpack_from(self.mmap, slot * slot_size)[0]
+
+    # returns (seq, value, timestamp) or False if the slot is not valid
+    def read(self, slot):
+        offset = slot * slot_size
+        while True:
+            seq = seq_struct.unpack_from(self.mmap, offset)[0]
+            if seq & 1:
+                continue # writer is busy
+            data = data_struct.unpack_from(self.mmap, offset + seq_struct.size)
+            if seq == seq_struct.unpack_from(self.mmap, offset)[0]:
+                break
+
+        timestamp, count = data[:2]
+        if count == INVALID or not seq:
+            return False
+        if count == -1:
+            value = False
+        elif count == 0:
+            value = data[2]
+        else:
+            value = list(data[2:2+count])
+        return seq, value, timestamp
+
+    def wake(self):
+        try:
+            os.write(self.wake_write, b'w')
+        except OSError as e:
+            if e.errno != errno.EAGAIN: # pipe full, reader is already awake
+                raise
+
+    def clear_wake(self):
+        try:
+            while os.read(self.wake_read, 4096):
+                pass
+        except OSError as e:
+            if e.errno != errno.EAGAIN:
+                raise
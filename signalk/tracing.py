@@ -0,0 +1,148 @@
+#!/usr/bin/env python
+#
+#   Copyright (C) 2019 Sean D'Epagnier
+#
+# This Program is free software; you can redistribute it and/or
+# modify it under the terms of the GNU General Public
+# License as published by the Free Software Foundation; either
+# version 3 of the License, or (at your option) any later version.
+
+# record named spans of time in a per process ring buffer
+#
+# set PYPILOT_TRACE=1 in the environment to enable, each process
+# calls init with its name.  When disabled start and end do nothing,
+# so always call them through the module:
+#
+#   t0 = tracing.start()
+#   ...
+#   tracing.end('nmea.read', t0)
+#
+# SIGUSR2 makes each traced process write its spans as chrome trace
+# json (load in chrome://tracing or perfetto) to
+# ~/.pypilot/trace-<process>-<pid>.json
+#
+# percentiles of each span are published as trace.<process> values
+
+from __future__ import print_function
+import os, time, json, signal
+from array import array
+from signalk.values import *
+
+try:
+    monotonic = time.monotonic
+except AttributeError: # python 2
+    monotonic = time.time
+
+ring_size = 8192
+tracer = False
+
+class Tracer(object):
+    def __init__(self, process, size=ring_size):
+        self.process = process
+        self.pid = os.getpid()
+        self.size = size
+        self.names = [None] * size
+        self.starts = array('d', [0]) * size
+        self.durations = array('d', [0]) * size
+        self.index = 0
+        self.count = 0
+
+    def end(self, name, t0):
+        i = self.index
+        self.names[i] = name
+        self.starts[i] = t0
+        self.durations[i] = monotonic() - t0
+        i += 1
+        self.index = i if i < self.size else 0
+        self.count += 1
+
+    # spans in the buffer, oldest first
+    def spans(self):
+        n = min(self.count, self.size)
+        for j in range(self.index - n, self.index):
+            yield self.names[j], self.starts[j], self.durations[j]
+
+    # percentiles in milliseconds for each name
+    def summary(self):
+        durations = {}
+        for name, t0, duration in self.spans():
+            if not name in durations:
+                durations[name] = []
+            durations[name].append(duration)
+
+        ret = {}
+        for name in durations:
+            d = sorted(durations[name])
+            n = len(d)
+            ms = lambda p : round(d[min(int(n*p), n-1)]*1000, 3)
+            ret[name] = {'count': n, 'p50': ms(.5), 'p90': ms(.9), 'p99': ms(.99), 'max': ms(1)}
+        return ret
+
+    def dump(self, path=False):
+        if not path:
+            path = os.getenv('HOME') + '/.pypilot/trace-%s-%d.json' % (self.process, self.pid)
+        events = [{'name': 'process_name', 'ph': 'M', 'pid': self.pid, 'args': {'name': self.process}}]
+        for name, t0, duration in self.spans():
+            events.append({'name': name, 'ph': 'X', 'pid': self.pid, 'tid': 0,
+                           'ts': round(t0*1e6, 1), 'dur': round(duration*1e6, 1)})
+        try:
+            file = open(path, 'w')
+            json.dump({'traceEvents': events, 'displayTimeUnit': 'ms'}, file)
+            file.close()
+            print('wrote trace', path)
+        except Exception as e:
+            print('failed to write trace', path, e)
+
+# replaced when enabled
+def start():
+    return 0
+
+def end(name, t0):
+    pass
+
+def summary():
+    return tracer.summary() if tracer else False
+
+def dump_handler(signum, frame):
+    # forked processes which never called init inherit the handler
+    if tracer and tracer.pid == os.getpid():
+        tracer.dump()
+
+def enable(process):
+    global tracer, start, end
+    tracer = Tracer(process)
+    start = monotonic
+    end = tracer.end
+    signal.signal(signal.SIGUSR2, dump_handler)
+
+def init(process):
+    if os.getenv('PYPILOT_TRACE'):
+        enable(process)
+    return tracer
+
+# in the main process: values for the summary of each process and
+# trace.dump, which signals every process to dump when set
+class TraceValues(object):
+    def __init__(self, server, processes):
+        self.values = {}
+        for process in processes:
+            value = server.Register(JSONValue('trace.' + process, False))
+            value.client_can_set = True # child processes send their summary
+            self.values[process] = value
+        self.dump = server.Register(BooleanProperty('trace.dump', False))
+        self.process = tracer.process
+        self.time = 0
+
+    def poll(self, pids):
+        if self.dump.value:
+            self.dump.set(False)
+            for pid in [os.getpid()] + pids:
+                try:
+                    os.kill(pid, signal.SIGUSR2)
+                except Exception as e:
+                    print('failed to signal', pid, 'to dump trace', e)
+
+        t = time.time()
+        if t - self.time > 1:
+            self.values[self.process].set(summary())
+            self.time = t
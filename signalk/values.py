@@ -15,7 +15,9 @@ class Value(object):
         self.name = name
         self.timestamp = False
         self.watchers = []
+        self.signalk_cache = None, None
         self.persistent = False
+        self.store = False # PersistentStore in the server process
         self.set(initial)
         self.client_can_set = False
 
@@ -35,13 +37,30 @@ class Value(object):
             return '{"' + self.name + '": {"value": "' + self.value + '"}}'
         return '{"' + self.name + '": {"value": ' + str(self.value) + '}}'
 
+    # identifies the output of get_signalk, None disables caching
+    # values must be replaced rather than modified in place
+    def cache_key(self):
+        return type(self.value), self.value
+
+    # format each change only once no matter how many watchers
+    # and get requests see it
+    def get_signalk_line(self):
+        key = self.cache_key()
+        if key is None:
+            return self.get_signalk() + '\n'
+        if key != self.signalk_cache[0]:
+            self.signalk_cache = key, self.get_signalk() + '\n'
+        return self.signalk_cache[1]
+
     def set(self, value):
         self.value = value
         self.send()
 
     def send(self):
+        if self.store:
+            self.store.changed(self)
         if self.watchers:
-            request = self.get_signalk() + '\n'
+            request = self.get_signalk_line()
             for socket in self.watchers:
                 socket.send(request)
 
@@ -53,8 +72,23 @@ class JSONValue(Value):
         return '{"' + self.name + '": {"value": ' + kjson.dumps(self.value) + '}}'
 
 
+list_formats = {}
+def list_format(fmt, count):
+    key = fmt, count
+    if not key in list_formats:
+        list_formats[key] = '[' + ', '.join([fmt] * count) + ']'
+    return list_formats[key]
+
 def round_value(value, fmt):
     if type(value) == type([]):
+        # format a list of numbers in one operation
+        if not bool in list(map(type, value)):
+            try:
+                ret = list_format(fmt, len(value)) % tuple(value)
+                if not 'nan' in ret:
+                    return ret
+            except TypeError:
+                pass # nested or not numeric
         ret = '['
         if len(value):
             ret += round_value(value[0], fmt)
@@ -110,6 +144,9 @@ class SensorValue(Value): # same as Value with added timestamp
         if type(value) == type(tuple()):
             value = list(value)
         return '{"' + self.name + '": {"value": ' + round_value(value, self.fmt) + ', "timestamp": %.3f }}' % self.timestamp[0]
+
+    def cache_key(self):
+        return type(self.value), self.value, self.timestamp[0]
     
 # a value that may be modified by external clients
 class Property(Value):
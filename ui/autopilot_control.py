@@ -108,9 +108,7 @@ class AutopilotControl(autopilot_control_ui.AutopilotControlBase):
         if not 'ap.heading' in value_list:
             self.watchlist.append('servo.current')
         
-        for name in self.watchlist:
-            if name in value_list:
-                client.watch(name)
+        client.watch([name for name in self.watchlist if name in value_list])
 
     def watch(self, name):
         if not name in self.watchlist: